@@ -0,0 +1,243 @@
+import asyncio
+import json
+import logging
+import socket
+import struct
+from typing import Dict, List, Optional, Tuple, Type, Union
+from .libs import (
+    FEATURES,
+    TunnelProtocol,
+    StreamMixin,
+    IdleMixin,
+    DatagramBatchMixin,
+    run,
+)
+from zomboid_forward.selectors.libs import (
+    PortType,
+    Command,
+    pack_head,
+    unpack_head,
+    unpack_addr,
+    BUFFER_LIMIT,
+    HEAD_SIZE,
+)
+from zomboid_forward.utils import decrypt_token
+from zomboid_forward.config import TIME_OUT
+
+
+class VirtualTCPClient(IdleMixin, StreamMixin, asyncio.Protocol):
+    """
+    Connection to the local service on behalf of a remote player, data arriving before it is connected is kept in `_pending`.
+    """
+
+    def __init__(self, client: 'ZomboidForwardClient', head: bytes, addr: 'socket._RetAddress', local_addr: 'socket._RetAddress') -> None:
+        super().__init__(client, head)
+        self._client = client
+        self._addr = addr
+        self.server_addr = local_addr
+        self._pending: List[bytes] = []
+        self._closing = False
+
+    async def start(self) -> None:
+        loop = asyncio.get_event_loop()
+        try:
+            await asyncio.wait_for(loop.create_connection(lambda: self, *self.server_addr), self._client._timeout)
+        except Exception as e:
+            logging.error('Unable to connect %s for %s', self.server_addr, self._addr, exc_info=e)
+            self.connection_lost(e)
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        super().connection_made(transport)
+        logging.info('Successfully connected to server %s<==>%s', self._addr, self.server_addr)
+        if self._pending:
+            transport.writelines(self._pending)
+            self._pending = []
+        if self._closing:
+            transport.close()
+
+    def data_received(self, data: bytes) -> None:
+        self.touch()
+        super().data_received(data)
+
+    def forward(self, data: bytes) -> None:
+        self.touch()
+        if data == b'':
+            self._closing = True
+            if self._transport is not None:
+                # The buffered data is still sent
+                self._transport.close()
+            return
+        if self._transport is None:
+            self._pending.append(data)
+            return
+        self._transport.write(data)
+
+    def abort(self) -> None:
+        if self._transport is not None:
+            self._transport.abort()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.cancel_idle()
+        self._client.unregister_client((PortType.TCP, self._addr))
+        super().connection_lost(exc)
+
+
+class VirtualUDPClient(IdleMixin, DatagramBatchMixin, asyncio.DatagramProtocol):
+    """
+    Datagrams are dropped instead of pausing anything when the datagram budget of the tunnel or the socket is full.
+    """
+
+    def __init__(self, client: 'ZomboidForwardClient', head: bytes, addr: 'socket._RetAddress', local_addr: 'socket._RetAddress') -> None:
+        super().__init__()
+        self._client = client
+        self._head = head
+        self._addr = addr
+        self.server_addr = local_addr
+        self._transport: Optional[asyncio.DatagramTransport] = None
+        self._pending: List[bytes] = []
+
+    async def start(self) -> None:
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.create_datagram_endpoint(lambda: self, remote_addr=self.server_addr)
+        except Exception as e:
+            logging.error('Unable to connect %s for %s', self.server_addr, self._addr, exc_info=e)
+            self.connection_lost(e)
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        super().connection_made(transport)
+        self._transport = transport
+        for data in self._pending:
+            transport.sendto(data)
+        self._pending = []
+
+    def on_datagram(self, data: bytes, addr: 'socket._RetAddress') -> None:
+        self.touch()
+        self._client.send_datagram(self._head + data)
+
+    def error_received(self, exc: Exception) -> None:
+        pass
+
+    def forward(self, data: bytes) -> None:
+        self.touch()
+        if data == b'':
+            self.abort()
+            return
+        if self._transport is None:
+            self._pending.append(data)
+            return
+        if self._transport.get_write_buffer_size() < self._client._buffer_limit:
+            self._transport.sendto(data)
+
+    def abort(self) -> None:
+        if self._transport is not None:
+            self._transport.close()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.cancel_idle()
+        self._client.unregister_client((PortType.UDP, self._addr))
+        self._client.send(self._head)
+        super().connection_lost(exc)
+
+
+class ZomboidForwardClient(TunnelProtocol):
+    """
+    asyncio engine of the client, speaks the same protocol as `selectors.client.ZomboidForwardClient`.
+    """
+    upstream: Dict[PortType, Type[Union[VirtualTCPClient, VirtualUDPClient]]] = {
+        PortType.TCP: VirtualTCPClient,
+        PortType.UDP: VirtualUDPClient,
+    }
+
+    def __init__(self, conf: Dict, timeout: float) -> None:
+        super().__init__(int(conf['common'].get('buffer_limit') or BUFFER_LIMIT))
+        self.server_addr = (conf['common']['server_addr'].strip(), int(conf['common']['server_port']))
+        self._timeout = timeout
+        self._state = 0
+        self._clients: Dict[Tuple[PortType, 'socket._RetAddress'], Union[VirtualTCPClient, VirtualUDPClient]] = {}
+        self._remote2local: Dict[Tuple[PortType, int], 'socket._RetAddress'] = {}
+
+        for k, v in conf.items():
+            if k == 'common' or k == 'DEFAULT':
+                continue
+            local_ip = v['local_ip']
+            port_type = PortType[(v.get('type') or 'udp').upper()]
+            local_ports = [int(x) for x in v['local_port'].split(',')]
+            remote_ports = [int(x) for x in v['remote_port'].split(',')]
+            for local_port, remote_port in zip(local_ports, remote_ports):
+                self._remote2local[(port_type, remote_port)] = (local_ip, local_port)
+
+        self._token: bytes = conf['common']['token'].strip().encode()
+        del conf['common']['token']
+        self._conf = conf
+        self._idle_timeout = float(conf['common'].get('idle_timeout') or TIME_OUT)
+        self._done: Optional[asyncio.Future] = None
+
+    def frame_received(self, pkg: bytes) -> None:
+        if self._state == 0:
+            self.send(decrypt_token(self._token, pkg))
+            conf = dict(self._conf, common=dict(self._conf['common'], features=list(FEATURES)))
+            self.send(json.dumps(conf).encode())
+            self._state = 1
+            return
+        port_type, port = struct.unpack('!HH', pkg[:4])
+        if port_type == PortType.CTRL:
+            self._on_command(port, pkg)
+            return
+        remote_addr = unpack_addr(pkg[4:HEAD_SIZE])
+        self._forward_to_client(port_type, remote_addr, port, pkg[HEAD_SIZE:])
+
+    def _on_command(self, command: int, pkg: bytes) -> None:
+        if command == Command.HELLO:
+            self._features = set(json.loads(pkg[4:])['features'])
+            logging.info('Protocol features %s', self._features)
+        elif command in (Command.PAUSE, Command.RESUME):
+            port_type, _, remote_addr = unpack_head(pkg[4:])
+            client = self._clients.get((port_type, remote_addr))
+            if not isinstance(client, VirtualTCPClient):
+                return
+            if command == Command.PAUSE:
+                client.pause_reading(Command.PAUSE)
+            else:
+                client.resume_reading(Command.PAUSE)
+
+    def _forward_to_client(self, port_type: PortType, remote_addr: 'socket._RetAddress', port: int, data: bytes) -> None:
+        client_id = (port_type, remote_addr)
+        client = self._clients.get(client_id)
+        if client is None:
+            if data == b'':
+                return
+            logging.info('New %s connection %s', PortType(port_type).name, remote_addr)
+            local_addr = self._remote2local[(port_type, port)]
+            client = self.upstream[port_type](self, pack_head(port_type, port, remote_addr), remote_addr, local_addr)
+            self._clients[client_id] = client
+            client.expire_idle(self._idle_timeout)
+            asyncio.ensure_future(client.start())
+        client.forward(data)
+
+    def unregister_client(self, client_id: Tuple[PortType, 'socket._RetAddress']) -> None:
+        if self._clients.pop(client_id, None) is None:
+            return
+        port_type, remote_addr = client_id
+        logging.info('Close %s connection %s', PortType(port_type).name, remote_addr)
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        super().connection_made(transport)
+        logging.info('Successfully connected to server %s', self.server_addr)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        super().connection_lost(exc)
+        for client in list(self._clients.values()):
+            client.abort()
+        if self._done is not None and not self._done.done():
+            self._done.set_result(None)
+
+    async def _connect(self) -> None:
+        loop = asyncio.get_event_loop()
+        self._done = loop.create_future()
+        logging.info('Attempting to connect %s', self.server_addr)
+        await asyncio.wait_for(loop.create_connection(lambda: self, *self.server_addr), self._timeout)
+        await self._done
+
+    def connect(self) -> None:
+        run(self._connect())
@@ -0,0 +1,342 @@
+import asyncio
+import logging
+import socket
+import time
+from typing import Hashable, List, Optional, Set
+from zomboid_forward.selectors.libs import (
+    Command,
+    LENGTH_HEAD,
+    MAX_PACKAGE_SIZE,
+    BUFFER_LIMIT,
+    UDP_BATCH,
+    pack_buffers,
+    pack_command,
+    init_tcp_keep_alive_opt,
+    recvfrom_many,
+)
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Extensions of `selectors.libs.FEATURES` implemented by this engine
+FEATURES = ('flow_control', )
+# Bytes of UDP frames queued ahead of the stream frames of a congested tunnel, later datagrams are dropped
+DATAGRAM_BUDGET = 256 * 1024
+
+
+def run(main) -> None:
+    """
+    Run the coroutine `main`, on uvloop when it is installed.
+    """
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.run(main)
+
+
+class FrameDecoder:
+    """
+    Incremental counterpart of `pack`, turns the received bytes into complete packages.
+    """
+
+    def __init__(self) -> None:
+        self._buf = bytearray()
+        self._pkg = bytearray()
+
+    def feed(self, data: bytes) -> List[bytes]:
+        buf = self._buf
+        buf += data
+        pkgs: List[bytes] = []
+        offset, size = 0, len(buf)
+        view = memoryview(buf)
+        try:
+            while size - offset >= LENGTH_HEAD.size:
+                pkg_len = LENGTH_HEAD.unpack_from(view, offset)[0]
+                start = offset + LENGTH_HEAD.size
+                end = start + pkg_len
+                if end > size:
+                    break
+                offset = end
+                if pkg_len != MAX_PACKAGE_SIZE and not self._pkg:
+                    pkgs.append(view[start:end].tobytes())
+                    continue
+                self._pkg += view[start:end]
+                if pkg_len != MAX_PACKAGE_SIZE:
+                    pkgs.append(bytes(self._pkg))
+                    self._pkg.clear()
+        finally:
+            view.release()
+        del buf[:offset]
+        return pkgs
+
+
+class PausableMixin:
+    """
+    Reading of the transport is paused while any reason is set, see `Endpoint.pause_reading`.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._transport: Optional[asyncio.Transport] = None
+        self._pause_reasons: Set[Hashable] = set()
+
+    def _reading(self) -> bool:
+        return self._transport is not None and not self._transport.is_closing()
+
+    def pause_reading(self, reason: Hashable) -> None:
+        if not self._pause_reasons and self._reading():
+            self._transport.pause_reading()
+        self._pause_reasons.add(reason)
+
+    def resume_reading(self, reason: Hashable) -> None:
+        if reason not in self._pause_reasons:
+            return
+        self._pause_reasons.discard(reason)
+        if not self._pause_reasons and self._reading():
+            self._transport.resume_reading()
+
+
+class IdleMixin:
+    """
+    Closes the transport after a period without traffic, see `Endpoint.expire_idle`.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._idle_handle: Optional[asyncio.TimerHandle] = None
+        self._last_active = 0.0
+
+    def expire_idle(self, timeout: float) -> None:
+        if timeout <= 0:
+            return
+        self._last_active = time.monotonic()
+        self._idle_handle = asyncio.get_event_loop().call_later(timeout, self._check_idle, timeout)
+
+    def touch(self) -> None:
+        self._last_active = time.monotonic()
+
+    def _check_idle(self, timeout: float) -> None:
+        idle = time.monotonic() - self._last_active
+        if idle < timeout:
+            self._idle_handle = asyncio.get_event_loop().call_later(timeout - idle, self._check_idle, timeout)
+            return
+        self._idle_handle = None
+        logging.info('Idle for %.0fs, closing %s', idle, getattr(self, '_addr', None))
+        self.abort()
+
+    def abort(self) -> None:
+        raise NotImplementedError()
+
+    def cancel_idle(self) -> None:
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+
+
+class DatagramBatchMixin:
+    """
+    Passes the datagrams of the socket to `on_datagram`, up to `UDP_BATCH` per read event, see `recvfrom_many`.
+
+    Selector loops deliver one datagram per event, so a loop busy with streams lets the socket overflow. The rest of
+    a burst is read from a duplicate of the socket. Other loops read their own batches.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._batch_sock: Optional[socket.socket] = None
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        super().connection_made(transport)
+        sock = transport.get_extra_info('socket')
+        if sock is not None and isinstance(asyncio.get_event_loop(), asyncio.SelectorEventLoop):
+            self._batch_sock = sock.dup()
+            self._batch_sock.setblocking(False)
+
+    def datagram_received(self, data: bytes, addr: 'socket._RetAddress') -> None:
+        self.on_datagram(data, addr)
+        if self._batch_sock is None:
+            return
+        try:
+            datagrams = recvfrom_many(self._batch_sock, UDP_BATCH - 1)
+        except OSError:
+            return
+        for data, addr in datagrams:
+            self.on_datagram(data, addr)
+
+    def on_datagram(self, data: bytes, addr: 'socket._RetAddress') -> None:
+        raise NotImplementedError()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        if self._batch_sock is not None:
+            self._batch_sock.close()
+            self._batch_sock = None
+        super().connection_lost(exc)
+
+
+class TunnelProtocol(PausableMixin, asyncio.Protocol):
+    """
+    Framed stream between the client and the server, the asyncio counterpart of `TunnelMixin`.
+
+    Frames sent during one iteration of the event loop are written with a single `writelines`.
+    Local connections that send while the write buffer is above `buffer_limit` are paused until it drains.
+    Meanwhile their frames are held back, so that UDP frames from `send_datagram` are written ahead of them.
+    """
+
+    def __init__(self, buffer_limit: int = BUFFER_LIMIT) -> None:
+        super().__init__()
+        self._buffer_limit = buffer_limit
+        self._decoder = FrameDecoder()
+        self._pending: List[bytes] = []
+        self._datagrams: List[bytes] = []
+        # Bytes of UDP frames queued or written since the write buffer was last below the limit
+        self._datagram_bytes = 0
+        self._flush_handle: Optional[asyncio.Handle] = None
+        self._writing_paused = False
+        self._paused_producers: Set[PausableMixin] = set()
+        self._features: Set[str] = set()
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self._transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            init_tcp_keep_alive_opt(sock)
+        transport.set_write_buffer_limits(high=self._buffer_limit)
+
+    def data_received(self, data: bytes) -> None:
+        try:
+            for pkg in self._decoder.feed(data):
+                self.frame_received(pkg)
+        except Exception as e:
+            logging.error(self._transport.get_extra_info('peername'), exc_info=e)
+            self.close()
+
+    def frame_received(self, pkg: bytes) -> None:
+        raise NotImplementedError()
+
+    def send(self, data: bytes, producer: PausableMixin = None) -> None:
+        """
+        Queue a package, `producer` is paused while the write buffer is full.
+        """
+        if self._transport is None or self._transport.is_closing():
+            return
+        self._pending.extend(pack_buffers(data))
+        self._schedule_flush()
+        if producer is not None and self._writing_paused and producer not in self._paused_producers:
+            self._paused_producers.add(producer)
+            producer.pause_reading(self)
+
+    def send_datagram(self, data: bytes) -> bool:
+        """
+        Queue a UDP frame ahead of the held back stream frames, False if it is dropped because of `DATAGRAM_BUDGET`.
+        """
+        if self._transport is None or self._transport.is_closing():
+            return False
+        buffers = pack_buffers(data)
+        size = sum(len(x) for x in buffers)
+        if self._datagram_bytes + size > DATAGRAM_BUDGET:
+            return False
+        self._datagram_bytes += size
+        self._datagrams.extend(buffers)
+        self._schedule_flush()
+        return True
+
+    def send_command(self, command: Command, body: bytes = b'') -> None:
+        self.send(pack_command(command, body))
+
+    def _schedule_flush(self) -> None:
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_soon(self._flush)
+
+    def _flush(self, force: bool = False) -> None:
+        self._flush_handle = None
+        if self._transport.is_closing():
+            return
+        buffers, self._datagrams = self._datagrams, []
+        if not self._writing_paused or force:
+            self._datagram_bytes = 0
+            buffers += self._pending
+            self._pending = []
+        if buffers:
+            self._transport.writelines(buffers)
+
+    def pause_writing(self) -> None:
+        self._writing_paused = True
+
+    def resume_writing(self) -> None:
+        self._writing_paused = False
+        self._datagram_bytes = 0
+        if self._pending and not self._transport.is_closing():
+            self._schedule_flush()
+        producers, self._paused_producers = self._paused_producers, set()
+        for producer in producers:
+            producer.resume_reading(self)
+
+    def block(self, stream: 'StreamMixin') -> None:
+        """
+        The write buffer of `stream` is full, stop what feeds it.
+        """
+        if 'flow_control' in self._features:
+            # Only pause this stream on the other side instead of the whole tunnel
+            self.send_command(Command.PAUSE, stream._head)
+        else:
+            self.pause_reading(stream)
+
+    def unblock(self, stream: 'StreamMixin') -> None:
+        if 'flow_control' in self._features:
+            self.send_command(Command.RESUME, stream._head)
+        else:
+            self.resume_reading(stream)
+
+    def close(self) -> None:
+        if self._transport is None or self._transport.is_closing():
+            return
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._flush(force=True)
+        self._transport.close()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._pending.clear()
+        self._datagrams.clear()
+        self.resume_writing()
+
+
+class StreamMixin(PausableMixin):
+    """
+    Local TCP connection carried by a tunnel, identified by `_head` in its packages.
+    """
+
+    def __init__(self, tunnel: TunnelProtocol, head: bytes = b'') -> None:
+        super().__init__()
+        self._tunnel = tunnel
+        self._head = head
+        self._blocking = False
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self._transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            init_tcp_keep_alive_opt(sock)
+        transport.set_write_buffer_limits(high=self._tunnel._buffer_limit)
+        if self._pause_reasons:
+            transport.pause_reading()
+
+    def pause_writing(self) -> None:
+        self._blocking = True
+        self._tunnel.block(self)
+
+    def resume_writing(self) -> None:
+        if self._blocking:
+            self._blocking = False
+            self._tunnel.unblock(self)
+
+    def data_received(self, data: bytes) -> None:
+        self._tunnel.send(self._head + data, self)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.resume_writing()
+        self._tunnel.send(self._head)
@@ -0,0 +1,281 @@
+import asyncio
+import json
+import logging
+import secrets
+import socket
+import struct
+from typing import Dict, Optional, Tuple, Type, Union
+from .libs import (
+    FEATURES,
+    TunnelProtocol,
+    StreamMixin,
+    IdleMixin,
+    DatagramBatchMixin,
+    run,
+)
+from zomboid_forward.selectors.libs import (
+    PortType,
+    Command,
+    pack_head,
+    unpack_head,
+    pack_command,
+    BUFFER_LIMIT,
+    HEAD_SIZE,
+    SESSION_ID_SIZE,
+)
+from zomboid_forward.utils import encrypt_token
+from zomboid_forward.config import TIME_OUT
+from zomboid_forward.workers import PortRegistry, Worker
+
+
+class ForwardTCPProtocol(IdleMixin, StreamMixin, asyncio.Protocol):
+
+    def __init__(self, server: 'ForwardTCPServer') -> None:
+        super().__init__(server._transit)
+        self._server = server
+        self._addr: 'socket._RetAddress' = None
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        super().connection_made(transport)
+        self._addr = transport.get_extra_info('peername')[:2]
+        self._head = pack_head(PortType.TCP, self._server.server_addr[1], self._addr)
+        logging.info('New TCP connection %s<==>%s', self._server.server_addr, self._addr)
+        self._server._clients[self._addr] = self
+        self.expire_idle(self._tunnel._server._idle_timeout)
+
+    def data_received(self, data: bytes) -> None:
+        self.touch()
+        super().data_received(data)
+
+    def abort(self) -> None:
+        self._transport.close()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        logging.info('TCP client closed %s', self._addr)
+        self.cancel_idle()
+        self._server._clients.pop(self._addr, None)
+        super().connection_lost(exc)
+
+
+class ForwardTCPServer:
+
+    def __init__(self, transit: 'TransitProtocol', port: int, host: str = '0.0.0.0') -> None:
+        self.server_addr = (host, port)
+        self._transit = transit
+        self._clients: Dict['socket._RetAddress', ForwardTCPProtocol] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        loop = asyncio.get_event_loop()
+        self._server = await loop.create_server(lambda: ForwardTCPProtocol(self), *self.server_addr, reuse_address=True)
+
+    def forward_to(self, data: bytes, addr: 'socket._RetAddress') -> None:
+        client = self._clients.get(addr)
+        if client is None:
+            logging.warning('No corresponding TCP connection %s<==>%s', self.server_addr, addr)
+            self._transit.send(pack_head(PortType.TCP, self.server_addr[1], addr))
+            return
+        if data == b'':
+            # The buffered data is still sent
+            client._transport.close()
+            return
+        client.touch()
+        client._transport.write(data)
+
+    def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+        for client in list(self._clients.values()):
+            client._transport.abort()
+
+
+class ForwardUDPServer(DatagramBatchMixin, asyncio.DatagramProtocol):
+    """
+    Datagrams are dropped instead of pausing anything when the datagram budget of the tunnel or the socket is full.
+    """
+
+    def __init__(self, transit: 'TransitProtocol', port: int, host: str = '0.0.0.0') -> None:
+        super().__init__()
+        self.server_addr = (host, port)
+        self._transit = transit
+        self._transport: Optional[asyncio.DatagramTransport] = None
+        self._latest_address = None
+
+    async def start(self) -> None:
+        loop = asyncio.get_event_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=self.server_addr)
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        super().connection_made(transport)
+        self._transport = transport
+
+    def on_datagram(self, data: bytes, addr: 'socket._RetAddress') -> None:
+        self._transit.send_datagram(pack_head(PortType.UDP, self.server_addr[1], addr) + data)
+
+    def error_received(self, exc: Exception) -> None:
+        if isinstance(exc, ConnectionResetError) and self._latest_address is not None:
+            # [WinError 10054]
+            logging.info('UDP client closed %s', self._latest_address)
+            self._transit.send(pack_head(PortType.UDP, self.server_addr[1], self._latest_address))
+
+    def forward_to(self, data: bytes, addr: 'socket._RetAddress') -> None:
+        if data == b'':
+            # End of a virtual client, there is nothing to close for UDP
+            return
+        if self._transport is None or self._transport.get_write_buffer_size() >= self._transit._buffer_limit:
+            return
+        self._latest_address = addr
+        self._transport.sendto(data, addr)
+
+    def close(self) -> None:
+        if self._transport is not None:
+            self._transport.close()
+
+
+class TransitProtocol(TunnelProtocol):
+    """
+    Tunnel connection of a client, see `selectors.server.TransitClientEndpoint`.
+    """
+
+    downstream_services: Dict[PortType, Type[Union[ForwardTCPServer, ForwardUDPServer]]] = {
+        PortType.TCP: ForwardTCPServer,
+        PortType.UDP: ForwardUDPServer,
+    }
+
+    def __init__(self, server: 'ZomboidForwardServer') -> None:
+        super().__init__(server._buffer_limit)
+        self._server = server
+        self._addr: 'socket._RetAddress' = None
+        self._state = 0
+        self._token = b''
+        self._port_mapping: Dict[Tuple[int, int], Union[ForwardTCPServer, ForwardUDPServer]] = {}
+        self._reserved_ports = set()
+        self._start_task: Optional[asyncio.Task] = None
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        super().connection_made(transport)
+        self._addr = transport.get_extra_info('peername')[:2]
+        logging.info('Successfully connected to client %s', self._addr)
+        self._token, f1, f2 = encrypt_token(self._server._token)
+        self.send(f1 + f2)
+        self._state = 1
+
+    def frame_received(self, pkg: bytes) -> None:
+        if self._state == 1:
+            if self._token != pkg:
+                raise Exception('VERIFICATION FAILED')
+            self._state = 2
+            return
+        if self._state == 2:
+            conf = json.loads(pkg)
+            if 'join' in conf:
+                raise Exception(f'Unable to join session {conf["join"]}')
+            self._init_forward_server(conf)
+            self._negotiate(conf.get('common', {}))
+            self._state = 3
+            return
+
+        port_type, port = struct.unpack('!HH', pkg[:4])
+        if port_type == PortType.CTRL:
+            self._on_command(port, pkg)
+            return
+        _, _, remote_addr = unpack_head(pkg)
+        self._port_mapping[(port_type, port)].forward_to(pkg[HEAD_SIZE:], remote_addr)
+
+    def _negotiate(self, common: Dict) -> None:
+        features = common.get('features')
+        if features is None:
+            # Clients without protocol extensions do not understand control frames
+            return
+        self._features = set(features) & set(FEATURES)
+        hello = json.dumps({
+            'features': sorted(self._features),
+            'session': secrets.token_bytes(SESSION_ID_SIZE).hex(),
+        }).encode()
+        self.send(pack_command(Command.HELLO, hello))
+
+    def _on_command(self, command: int, pkg: bytes) -> None:
+        if command not in (Command.PAUSE, Command.RESUME):
+            return
+        port_type, port, remote_addr = unpack_head(pkg[4:])
+        if port_type != PortType.TCP:
+            return
+        server = self._port_mapping.get((port_type, port))
+        client = server and server._clients.get(remote_addr)
+        if client is None:
+            return
+        if command == Command.PAUSE:
+            client.pause_reading(Command.PAUSE)
+        else:
+            client.resume_reading(Command.PAUSE)
+
+    def _init_forward_server(self, client_config: Dict) -> None:
+        ports = set()
+        for k, v in client_config.items():
+            if k == 'common' or k == 'DEFAULT':
+                continue
+            for x in v['remote_port'].split(','):
+                x = int(x)
+                if x in ports:
+                    raise Exception(f'The port is already occupied:{x}')
+                ports.add(x)
+
+        self._server._port_registry.reserve(ports)
+        self._reserved_ports = ports
+
+        for k, v in client_config.items():
+            if k == 'common' or k == 'DEFAULT':
+                continue
+            port_type = PortType[(v.get('type') or 'udp').upper()]
+            ServerClass = self.downstream_services[port_type]
+            for remote_port in set(int(x) for x in v['remote_port'].split(',')):
+                self._port_mapping[(port_type, remote_port)] = ServerClass(self, remote_port)
+
+        self._start_task = asyncio.ensure_future(self._start_forward_servers())
+
+    async def _start_forward_servers(self) -> None:
+        try:
+            for server in self._port_mapping.values():
+                await server.start()
+        except Exception as e:
+            logging.error('Unable to listen for %s', self._addr, exc_info=e)
+            self.close()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        super().connection_lost(exc)
+        if self._start_task is not None:
+            self._start_task.cancel()
+        for server in self._port_mapping.values():
+            server.close()
+        self._server._port_registry.release(self._reserved_ports)
+        logging.info('Client disconnected %s', self._addr)
+
+
+class ZomboidForwardServer:
+    """
+    asyncio engine of the server, speaks the same protocol as `selectors.server.ZomboidForwardServer`.
+    """
+
+    def __init__(self, conf: Dict, worker: Worker = None) -> None:
+        self.server_addr = (conf['common']['bind_addr'], int(conf['common']['bind_port']))
+        self._worker = worker
+        self._port_registry = PortRegistry() if worker is None else worker.registry
+        self._buffer_limit = int(conf['common'].get('buffer_limit') or BUFFER_LIMIT)
+        self._idle_timeout = float(conf['common'].get('idle_timeout') or TIME_OUT)
+        self._token: bytes = conf['common']['token'].strip().encode()
+        del conf['common']['token']
+
+    async def _serve(self) -> None:
+        loop = asyncio.get_event_loop()
+        if self._worker is not None:
+            server = await loop.create_server(lambda: TransitProtocol(self), sock=self._worker.listener)
+            logging.info('Running as worker %s/%s', self._worker.index, self._worker.count)
+        else:
+            server = await loop.create_server(lambda: TransitProtocol(self), *self.server_addr, reuse_address=True)
+        logging.info('Waiting for client connection...')
+        logging.info('Listening for %s', self.server_addr)
+        async with server:
+            await server.serve_forever()
+
+    def serve_forever(self) -> None:
+        run(self._serve())
@@ -2,18 +2,22 @@
 # -*- coding: utf-8 -*
 
 from zomboid_forward.selectors.client import ZomboidForwardClient
+from zomboid_forward.aio.client import ZomboidForwardClient as AsyncZomboidForwardClient
 from zomboid_forward.utils import init_log, load_config, get_absolute_path
 from zomboid_forward import __version__
 import os
 
 
-def main(config_path, timeout: float = None, level: str = None):
+def main(config_path, timeout: float = None, level: str = None, engine: str = None):
     config = load_config(config_path)
-    client = ZomboidForwardClient(config, timeout or 3)
+    client_class = AsyncZomboidForwardClient if engine == 'asyncio' else ZomboidForwardClient
+    client = client_class(config, timeout or 3)
     init_log(
         config['common'].get('log_file'),
         level or config['common'].get('log_level'),
     )
+    if isinstance(client, ZomboidForwardClient):
+        client.watch_config(config_path)
     client.connect()
 
 
@@ -36,6 +40,13 @@ if __name__ == '__main__':
         "--level",
         help="log level",
     )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=('selectors', 'asyncio'),
+        default='selectors',
+        help="event loop implementation",
+    )
     args = parser.parse_args()
     config_path = args.config
     if config_path:
@@ -44,4 +55,5 @@ if __name__ == '__main__':
         config_path or 'client.ini',
         timeout=args.timeout,
         level=args.level,
+        engine=args.engine,
     )
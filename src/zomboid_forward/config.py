@@ -20,6 +20,8 @@ LENGTH_HEAD_SIZE = 2
 PACKAGE_HEAD_SIZE = 2 * ADDR_SIZE + LENGTH_HEAD_SIZE
 TIME_OUT = 300
 LOG_FORMAT = "%(asctime)s %(levelname)7s %(thread)d --- [%(threadName)15.15s] %(pathname)s:%(lineno)s : %(message)s"
+# Records waiting to be written before new ones are dropped, see `utils.LogPipeline`
+LOG_QUEUE_SIZE = 10000
 BUFFER_SIZE = MAX_PACKAGE_SIZE * 2
 ENCRYPTION_SIZE = 256
 EMPTY_ADDR = ('0.0.0.0', 0)
@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import bisect
+from typing import Callable, Dict, Iterable, List, Tuple
+from zomboid_forward.selectors.libs import PortType, Priority
+
+# Upper bounds in seconds of the loop latency buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+# Upper bounds in seconds of the queueing delay buckets of the tunnels
+QUEUE_DELAY_BUCKETS = (0.0001, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Seconds between two JSON dumps, see `metrics_file`
+DUMP_INTERVAL = 10
+# Why the server refused a tunnel connection: over `accept_rate`, over `max_handshakes`,
+# not a token frame, over `handshake_timeout`, wrong token
+REJECT_REASONS = ('rate', 'capacity', 'handshake', 'timeout', 'token')
+
+# Sample of a collector: name, labels, value
+Sample = Tuple[str, Tuple[Tuple[str, str], ...], float]
+
+
+class Histogram:
+    """
+    Fixed buckets, observing a value is a bisect and two additions.
+    """
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds: Tuple[float, ...]) -> None:
+        self.bounds = bounds
+        # The last one counts the values above every bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self, name: str, labels: Tuple[Tuple[str, str], ...] = ()) -> List[Sample]:
+        samples: List[Sample] = []
+        total = 0
+        for bound, n in zip(self.bounds + (float('inf'), ), self.counts):
+            total += n
+            samples.append((f'{name}_bucket', labels + (('le', '+Inf' if bound == float('inf') else repr(bound)), ), total))
+        samples.append((f'{name}_sum', labels, self.sum))
+        samples.append((f'{name}_count', labels, total))
+        return samples
+
+
+class MappingCounters:
+    """
+    Traffic of one `(port_type, port)` mapping. Upstream is from the players to the forwarded service, downstream back.
+    `rate_limited` counts the datagrams dropped and the reads deferred by the rate limits of the mapping.
+    """
+    __slots__ = ('upstream_bytes', 'upstream_packets', 'downstream_bytes', 'downstream_packets', 'rate_limited')
+
+    def __init__(self) -> None:
+        self.upstream_bytes = 0
+        self.upstream_packets = 0
+        self.downstream_bytes = 0
+        self.downstream_packets = 0
+        self.rate_limited = 0
+
+    def upstream(self, size: int) -> None:
+        self.upstream_bytes += size
+        self.upstream_packets += 1
+
+    def downstream(self, size: int) -> None:
+        self.downstream_bytes += size
+        self.downstream_packets += 1
+
+
+class Metrics:
+    """
+    Counters of one process. The event loop only updates preallocated numbers,
+    the samples are put together by `render` and `dump`.
+    """
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.loop_latency = Histogram(LATENCY_BUCKETS)
+        # Seconds the frames spent in the queues of the tunnels, by `Priority`
+        self.queue_delays = [Histogram(QUEUE_DELAY_BUCKETS) for _ in Priority]
+        self.loop_events = 0
+        self.loop_deferred = 0
+        self.tunnels_rejected = dict.fromkeys(REJECT_REASONS, 0)
+        self.mappings: Dict[Tuple[int, int], MappingCounters] = {}
+        self._collectors: List[Callable[[], Iterable[Sample]]] = []
+
+    def mapping(self, port_type: int, port: int) -> MappingCounters:
+        """
+        Counters of a mapping, kept across the sessions that forward the port.
+        """
+        counters = self.mappings.get((port_type, port))
+        if counters is None:
+            counters = self.mappings[(port_type, port)] = MappingCounters()
+        return counters
+
+    def add_collector(self, collector: Callable[[], Iterable[Sample]]) -> None:
+        """
+        `collector` returns gauges that are only computed when the metrics are read, e.g. queue depths.
+        """
+        self._collectors.append(collector)
+
+    def loop(self, events: int, duration: float, deferred: int = 0) -> None:
+        """
+        One iteration of the event loop that handled `events` in `duration` seconds, waiting excluded,
+        and left `deferred` ready endpoints for the next one.
+        """
+        self.loop_events += events
+        self.loop_deferred += deferred
+        self.loop_latency.observe(duration)
+
+    def samples(self) -> List[Tuple[str, str, List[Sample]]]:
+        """
+        Name, type and samples of every metric.
+        """
+        delays: List[Sample] = []
+        for priority, histogram in zip(Priority, self.queue_delays):
+            delays += histogram.samples('zomboid_forward_queue_delay_seconds', (('class', priority.name.lower()), ))
+
+        traffic: Dict[str, List[Sample]] = {'bytes': [], 'packets': []}
+        limited: List[Sample] = []
+        for (port_type, port), counters in list(self.mappings.items()):
+            mapping = (('type', PortType(port_type).name.lower()), ('port', str(port)))
+            limited.append(('zomboid_forward_mapping_rate_limited_total', mapping, counters.rate_limited))
+            for direction in ('upstream', 'downstream'):
+                labels = mapping + (('direction', direction), )
+                for unit in traffic:
+                    traffic[unit].append((f'zomboid_forward_mapping_{unit}_total', labels, getattr(counters, f'{direction}_{unit}')))
+
+        rejected: List[Sample] = []
+        for reason, n in self.tunnels_rejected.items():
+            rejected.append(('zomboid_forward_tunnels_rejected_total', (('reason', reason), ), n))
+
+        gauges: Dict[str, List[Sample]] = {}
+        for collector in self._collectors:
+            for sample in collector():
+                gauges.setdefault(sample[0], []).append(sample)
+
+        return [
+            ('zomboid_forward_start_time_seconds', 'gauge', [('zomboid_forward_start_time_seconds', (), self.started)]),
+            ('zomboid_forward_loop_latency_seconds', 'histogram', self.loop_latency.samples('zomboid_forward_loop_latency_seconds')),
+            ('zomboid_forward_queue_delay_seconds', 'histogram', delays),
+            ('zomboid_forward_loop_events_total', 'counter', [('zomboid_forward_loop_events_total', (), self.loop_events)]),
+            ('zomboid_forward_loop_deferred_total', 'counter', [('zomboid_forward_loop_deferred_total', (), self.loop_deferred)]),
+            ('zomboid_forward_mapping_bytes_total', 'counter', traffic['bytes']),
+            ('zomboid_forward_mapping_packets_total', 'counter', traffic['packets']),
+            ('zomboid_forward_mapping_rate_limited_total', 'counter', limited),
+            ('zomboid_forward_tunnels_rejected_total', 'counter', rejected),
+        ] + [(name, 'gauge', samples) for name, samples in gauges.items()]
+
+    def render(self) -> str:
+        """
+        Prometheus text exposition format.
+        """
+        lines = []
+        for name, kind, samples in self.samples():
+            lines.append(f'# TYPE {name} {kind}')
+            for sample_name, labels, value in samples:
+                if labels:
+                    label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+                    lines.append(f'{sample_name}{{{label_text}}} {value}')
+                else:
+                    lines.append(f'{sample_name} {value}')
+        lines.append('')
+        return '\n'.join(lines)
+
+    def snapshot(self) -> str:
+        """
+        The samples as JSON, see `write`.
+        """
+        metrics: Dict[str, List[Dict]] = {}
+        for _, _, samples in self.samples():
+            for sample_name, labels, value in samples:
+                metrics.setdefault(sample_name, []).append(dict(labels, value=value))
+        return json.dumps({'time': time.time(), 'metrics': metrics})
+
+    @staticmethod
+    def write(path: str, snapshot: str) -> None:
+        """
+        Replace `path` with a `snapshot` at once, so that readers never see a partial file.
+        Blocks on the disk, the event loop hands it to a thread.
+        """
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(snapshot)
+        os.replace(tmp_path, path)
+
+    def dump(self, path: str) -> None:
+        self.write(path, self.snapshot())
@@ -2,23 +2,78 @@ from .libs import (
     ServerEndpoint,
     init_tcp_keep_alive_opt,
     Endpoint,
-    SteppingReceiverMixin,
     SteppingSenderMixin,
-    unpack_addr,
+    DatagramSenderMixin,
+    TunnelMixin,
     PortType,
-    pack_addr,
-    BUFFER_SIZE,
-    pack,
+    Command,
+    Compression,
+    unpack_addr,
+    pack_head,
+    unpack_head,
+    head_size,
+    address_family,
+    pack_command,
+    pack_buffers,
     unpack,
+    unpack_varint,
+    TimerQueue,
+    EventScheduler,
+    BufferBudget,
+    Compressor,
+    compression_of,
+    priority_of,
+    priority_weights,
+    tracer_of,
+    Priority,
+    decompress_frame,
+    BUFFER_SIZE,
+    RECV_SIZE,
+    MAX_RECV_SIZE,
+    BATCH_SIZE,
+    LOOP_QUANTUM,
+    BUFFER_LIMIT,
+    MEMORY_LIMIT,
+    FEATURES,
+    MAX_TUNNELS,
+    DATAGRAM_HEAD_SIZE,
+    MAX_DATAGRAM_SIZE,
+    RESUME_BUFFER,
+    pack_datagram,
+    unpack_datagram,
+    datagram_keys,
+    ReplayWindow,
+    UDP_TIMEOUT,
+    verify,
+    recv_bytes,
+    recvfrom_many,
 )
 import socket
 import selectors
 import logging
 import struct
+import errno
+import os
+import signal
 import time
-from typing import Type, Dict, Tuple
+import random
+from typing import Type, Dict, Tuple, List, Optional, Set
+from collections import deque
 import json
-from zomboid_forward.utils import decrypt_token
+from .metrics import start_metrics
+from zomboid_forward.utils import decrypt_token, to_bool, load_config, get_absolute_path
+from zomboid_forward.metrics import Metrics
+from zomboid_forward.config import TIME_OUT
+
+# Seconds before the first reconnect attempt, doubled after every failed one up to `reconnect_max_delay`
+RECONNECT_DELAY = 1
+RECONNECT_MAX_DELAY = 30
+# Seconds between two checks of `config_watch` and SIGHUP, see `ZomboidForwardClient.watch_config`
+CONFIG_CHECK_INTERVAL = 1
+# Seconds between two health checks of the idle connections of a `ConnectionPool`
+POOL_CHECK_INTERVAL = 5
+# Seconds an idle pooled connection is kept before it is replaced, see `pool_max_age`
+POOL_MAX_AGE = 60
 
 
 class SteppingConnectMixin(ServerEndpoint):
@@ -40,8 +95,8 @@ class SteppingConnectMixin(ServerEndpoint):
                 # [WinError 10035]
                 yield False
             except OSError as e:
-                # [WinError 10056]
-                if e.errno == 10056:
+                # [WinError 10056], or a socket that was connected beforehand, see `ConnectionPool`
+                if e.errno in (10056, errno.EISCONN):
                     self._connected = True
                 else:
                     raise
@@ -51,7 +106,7 @@ class SteppingConnectMixin(ServerEndpoint):
                 raise socket.timeout()
 
     def _init_sock(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock = socket.socket(address_family(self.server_addr[0]), socket.SOCK_STREAM)
         init_tcp_keep_alive_opt(sock)
         sock.setblocking(False)
         return sock
@@ -65,6 +120,7 @@ class VirtualClient(ServerEndpoint):
         host: str,
         port: int,
         addr: 'socket._RetAddress',
+        tunnel: TunnelMixin = None,
         **kwargs,
     ) -> None:
         super().__init__(
@@ -72,29 +128,59 @@ class VirtualClient(ServerEndpoint):
             port=port,
             host=host,
             timeout=server._timeout,
+            budget=server._budget,
             **kwargs,
         )
         self._server = server
         self._addr = addr
+        # Replies use the connection the stream arrived on, so that they stay in order
+        self._tunnel = tunnel or server
+        self._port_type, port = server._local2remote[(host, port)]
+        # Port mapping of the client, see `ZomboidForwardClient.reload`
+        self._mapping = (self._port_type, port)
+        self._head = pack_head(self._port_type, port, addr, 'ipv6' in server._features)
+        self._compression = server._compression[(self._port_type, port)]
+        self._priority = server._priority[(self._port_type, port)]
+        self._counters = server._metrics.mapping(self._port_type, port)
+        # Set by `Command.OPEN`, replaces the head in the frames of the tunnel
+        self._stream_id: Optional[int] = None
+        self._stream_prefix: Optional[bytes] = None
 
     def transit(self, data: bytes, addr: 'socket._RetAddress') -> None:
-        port_type, port = self._server._local2remote[addr]
-        head = struct.pack('!HH', port_type, port) + pack_addr(self._addr)
-        self._server.buffer.append(head + data)
+        self.touch()
+        if data:
+            self._counters.downstream(len(data))
+        if self._port_type == PortType.UDP and data and self._server.send_datagram(self._head + data):
+            return
+        self._tunnel.enqueue_compressed((self._stream_prefix or self._head) + data, self._compression, self, self._priority)
+
+    def transit_command(self, command: Command) -> None:
+        self._tunnel.enqueue(pack_command(command, self._head))
 
     def sendto_buffer(self, data: bytes, addr: 'socket._RetAddress'):
-        self.buffer.append(data)
+        self._counters.upstream(len(data))
+        self.enqueue(data, self._tunnel)
 
     pass
 
 
 class VirtualTCPClient(VirtualClient, SteppingConnectMixin, SteppingSenderMixin):
 
+    def __init__(self, *args, sock: socket.socket = None, **kwargs) -> None:
+        # An established connection taken from a `ConnectionPool`, used instead of connecting
+        self._pooled_sock = sock
+        super().__init__(*args, **kwargs)
+
+    def _init_sock(self) -> socket:
+        if self._pooled_sock is not None:
+            return self._pooled_sock
+        return super()._init_sock()
+
     def notify_read(self) -> None:
-        data = self._sock.recv(BUFFER_SIZE)
+        data = recv_bytes(self._sock, self._server._recv_size)
         if data == b'':
             # self.close()
-            self._read_closed = True
+            self.close_read()
             return
         self.transit(data, self.server_addr)
 
@@ -103,38 +189,171 @@ class VirtualTCPClient(VirtualClient, SteppingConnectMixin, SteppingSenderMixin)
             return
         if self._state == 0:
             self._state = 1
-            logging.info(f'Successfully connected to server {self._addr}<==>{self.server_addr}')
+            logging.info('Successfully connected to server %s<==>%s', self._addr, self.server_addr)
         next(self._stepping_sender)
 
+    def _pause_producer(self, producer: Endpoint) -> None:
+        if producer is not self._tunnel or 'flow_control' not in producer._features:
+            return super()._pause_producer(producer)
+        if producer in self._paused_producers:
+            return
+        # Only pause this stream on the server instead of the whole tunnel
+        self._paused_producers.add(producer)
+        self.transit_command(Command.PAUSE)
+
+    def _resume_producers(self) -> None:
+        if self._tunnel in self._paused_producers and 'flow_control' in self._tunnel._features:
+            self._paused_producers.discard(self._tunnel)
+            if not self._closed:
+                self.transit_command(Command.RESUME)
+        super()._resume_producers()
+
     def close(self) -> None:
         self._server.unregister_client((PortType.TCP, self._addr))
         return super(ServerEndpoint, self).close()
 
 
-class VirtualUDPClient(VirtualClient, SteppingSenderMixin):
+class PooledConnection(SteppingConnectMixin):
+    """
+    Idle connection of a `ConnectionPool`, only registered for `write` until it is established.
+    """
+
+    def __init__(self, pool: 'ConnectionPool') -> None:
+        client = pool._client
+        super().__init__(selector=client._selector, port=pool.addr[1], host=pool.addr[0], timeout=client._timeout)
+        self._pool = pool
+        self.created = time.monotonic()
 
     def notify_read(self) -> None:
-        data, addr = self._sock.recvfrom(BUFFER_SIZE)
-        self.transit(data, addr)
+        raise NotImplementedError()
+
+    def notify_write(self) -> None:
+        try:
+            if not next(self._stepping_connect):
+                return
+        except OSError as e:
+            logging.debug('Unable to connect %s for the pool: %s', self.server_addr, e)
+            self.close()
+            return
+        self.register(0)
+        self._pool._established(self)
+
+    def healthy(self) -> bool:
+        """
+        Established and not closed by the other side. Data the service sent meanwhile is left for the stream.
+        """
+        if not self._connected or self._closed:
+            return False
+        try:
+            return self._sock.recv(1, socket.MSG_PEEK) != b''
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+
+    def release(self) -> socket.socket:
+        """
+        Hand the socket over, the endpoint is done with.
+        """
+        self.register(0)
+        self._closed = True
+        return self._sock
+
+    def close(self) -> None:
+        self._pool._discard(self)
+        super().close()
+
+
+class ConnectionPool:
+    """
+    Connections to the local service of a TCP mapping established ahead of the streams, see `pool_size`.
+
+    At least `size` idle connections are kept, a new stream takes one and forwards its first frame right away.
+    They are replenished in the background, checked every `POOL_CHECK_INTERVAL` seconds and when they are taken,
+    and replaced after `max_age` seconds, before the service drops them for being idle.
+    """
+
+    def __init__(self, client: 'ZomboidForwardClient', addr: 'socket._RetAddress', size: int, max_age: float = POOL_MAX_AGE) -> None:
+        self.addr = addr
+        self.size = size
+        self.max_age = max_age
+        self._client = client
+        self._idle: deque = deque()
+        self._connecting: Set[PooledConnection] = set()
+        self._timer: Optional[list] = None
+
+    def start(self) -> None:
+        self._fill()
+        self._timer = self._client._timers.call_later(POOL_CHECK_INTERVAL, self._check)
+
+    def take(self) -> Optional[socket.socket]:
+        """
+        A healthy established connection, or None if there is none left.
+        """
+        sock = None
+        while self._idle and sock is None:
+            conn: PooledConnection = self._idle.popleft()
+            if conn.healthy() and time.monotonic() - conn.created < self.max_age:
+                sock = conn.release()
+            else:
+                conn.close()
+        self._fill()
+        return sock
+
+    def _fill(self) -> None:
+        while len(self._idle) + len(self._connecting) < self.size:
+            try:
+                conn = PooledConnection(self)
+            except OSError as e:
+                logging.debug('Unable to connect %s for the pool: %s', self.addr, e)
+                return
+            self._connecting.add(conn)
+            conn.register(selectors.EVENT_WRITE)
+
+    def _established(self, conn: PooledConnection) -> None:
+        self._connecting.discard(conn)
+        self._idle.append(conn)
+
+    def _discard(self, conn: PooledConnection) -> None:
+        self._connecting.discard(conn)
+        if conn in self._idle:
+            self._idle.remove(conn)
+
+    def _check(self) -> None:
+        now = time.monotonic()
+        for conn in list(self._idle):
+            if not conn.healthy() or now - conn.created >= self.max_age:
+                conn.close()
+        for conn in list(self._connecting):
+            if now - conn.created > conn._timeout:
+                conn.close()
+        # Failed connections are only replaced here, so that a service that is down is not tried in a loop
+        self._fill()
+        self._timer = self._client._timers.call_later(POOL_CHECK_INTERVAL, self._check)
+
+    def close(self) -> None:
+        if self._timer is not None:
+            TimerQueue.cancel(self._timer)
+            self._timer = None
+        for conn in list(self._idle) + list(self._connecting):
+            conn.close()
+
+
+class VirtualUDPClient(VirtualClient, DatagramSenderMixin):
+
+    def notify_read(self) -> None:
+        for data, addr in recvfrom_many(self._sock):
+            self.transit(data, addr)
 
     def notify_write(self) -> None:
         next(self._stepping_sender)
 
     def sendto_buffer(self, data: bytes, addr: 'socket._RetAddress'):
-        self.buffer.append((data, addr))
-
-    def _send_to(self, data):
-        # 65507
-        self._latest_address = data[1]
-        send_len = self._sock.sendto(*data)
-        data = (data[0][send_len:], data[1])
-        if data[0]:
-            return data
-        return False
+        self._counters.upstream(len(data))
+        self.enqueue_datagram(data, addr)
 
     def _init_sock(self) -> socket:
-        self.server_addr = None
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock = socket.socket(address_family(self.server_addr[0]), socket.SOCK_DGRAM)
         sock.setblocking(False)
         return sock
 
@@ -143,7 +362,162 @@ class VirtualUDPClient(VirtualClient, SteppingSenderMixin):
         return super().close()
 
 
-class ZomboidForwardClient(SteppingConnectMixin, SteppingReceiverMixin, SteppingSenderMixin):
+class TransitUDPClient(ServerEndpoint, DatagramSenderMixin):
+    """
+    Client side of the UDP transport, see `TransitUDPServerEndpoint`.
+
+    `Command.HELLO` is sent every second until the server answers it, then as keep-alive for NAT mappings and as probe.
+    It tells the server whether the answers arrive. Without an answer for `UDP_TIMEOUT` seconds both sides use the tunnel
+    again, until an answer arrives.
+    """
+    HELLO_INTERVAL = 1
+    KEEP_ALIVE_INTERVAL = 2
+
+    def __init__(self, server: 'ZomboidForwardClient', session_id: bytes, keys: Tuple[bytes, bytes]) -> None:
+        host, port = server._sock.getpeername()[:2]
+        super().__init__(selector=server._selector, port=port, host=host, budget=server._budget)
+        self._server = server
+        self._session_id = session_id
+        # MAC keys of the client and of the server, see `datagram_keys`
+        self._keys = keys
+        self._sent = 0
+        self._window = ReplayWindow()
+        self._ready = False
+        self._answered = 0.0
+        self._latest_address = None
+        self._hello_timer = None
+
+    def _init_sock(self) -> socket:
+        sock = socket.socket(address_family(self.server_addr[0]), socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        return sock
+
+    def start(self) -> None:
+        self.register(selectors.EVENT_READ)
+        self._hello()
+
+    def _lost(self) -> bool:
+        if self._ready and time.monotonic() - self._answered > UDP_TIMEOUT:
+            logging.warning('UDP transport lost %s, using the tunnel', self.server_addr)
+            self._ready = False
+        return not self._ready
+
+    def _hello(self) -> None:
+        self._lost()
+        self.enqueue_datagram(self._pack(pack_command(Command.HELLO, b'\x01' if self._ready else b'\x00')), self.server_addr)
+        interval = self.KEEP_ALIVE_INTERVAL if self._ready else self.HELLO_INTERVAL
+        self._hello_timer = self._server._timers.call_later(interval, self._hello)
+
+    def send(self, data: bytes) -> bool:
+        if self._lost() or len(data) > MAX_DATAGRAM_SIZE - DATAGRAM_HEAD_SIZE:
+            return False
+        self.enqueue_datagram(self._pack(data), self.server_addr)
+        return True
+
+    def _pack(self, data: bytes) -> bytes:
+        self._sent += 1
+        return pack_datagram(self._session_id, self._keys[0], self._sent, data)
+
+    def notify_read(self) -> None:
+        try:
+            datagrams = recvfrom_many(self._sock)
+        except ConnectionResetError:  # [WinError 10054]
+            return
+        for data, addr in datagrams:
+            try:
+                self._on_datagram(data)
+            except Exception as e:
+                logging.debug('Dropped a malformed datagram of %s', addr, exc_info=e)
+
+    def _on_datagram(self, data: bytes) -> None:
+        session_id, counter, body = unpack_datagram(data)
+        if session_id != self._session_id or not verify(self._keys[1], data) or not self._window.accept(counter):
+            return
+        port_type, port = struct.unpack('!HH', body[:4])
+        if port_type == PortType.CTRL:
+            self._answered = time.monotonic()
+            if not self._ready:
+                logging.info('UDP transport ready %s', self.server_addr)
+                self._ready = True
+                # Let the server know right away
+                TimerQueue.cancel(self._hello_timer)
+                self._hello()
+            return
+        tagged = 'ipv6' in self._server._features
+        size = head_size(body, tagged)
+        self._server._forward_to_client(port_type, unpack_addr(body[4:size], tagged), port, body[size:])
+
+    def notify_write(self) -> None:
+        next(self._stepping_sender)
+
+    def close(self) -> None:
+        if self._hello_timer is not None:
+            TimerQueue.cancel(self._hello_timer)
+        return super().close()
+
+
+class ZomboidForwardTunnel(SteppingConnectMixin, TunnelMixin):
+    """
+    Additional connection of a session with `tunnel_count` > 1, it joins the session of `ZomboidForwardClient`.
+    """
+
+    def __init__(self, client: 'ZomboidForwardClient', index: int, session: str) -> None:
+        super().__init__(
+            selector=client._selector,
+            port=client.server_addr[1],
+            host=client.server_addr[0],
+            timeout=client._timeout,
+            timers=client._timers,
+            budget=client._budget,
+            batch_size=client._batch_size,
+            flush_delay=client._flush_delay,
+            recv_size=client._recv_size,
+            compressor=client._compressor,
+            priority_weights=client._priority_weights,
+            queue_delays=client._metrics.queue_delays,
+            tracer=client._tracer,
+        )
+        self._client = client
+        self._index = index
+        self._session = session
+        self._features = client._features
+
+    def notify_read(self) -> None:
+        pkgs = next(self._stepping_receiver)
+        if len(pkgs) == 0:
+            return
+        if self._state == 0:
+            f = pkgs.pop(0)
+            self.enqueue(decrypt_token(self._client._token, f))
+            self.enqueue(json.dumps({'join': self._session, 'index': self._index}).encode())
+            if 'large_frames' in self._features:
+                self.use_large_frames()
+            self._state = 1
+        self._client._dispatch(pkgs, self)
+
+    def notify_write(self) -> None:
+        if not next(self._stepping_connect):
+            return
+        if self._state < 1:
+            self.want_write(False)
+            return
+        next(self._stepping_sender)
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        super().close()
+        self._client.close()
+
+
+class ZomboidForwardClient(SteppingConnectMixin, TunnelMixin):
+    """
+    Tunnel to `ZomboidForwardServer`, with `reconnect` a lost connection is established again with exponential backoff.
+
+    With the `resume` extension the session survives it: local connections and queued frames are kept,
+    the new connection asks the server to resume the session and the frames it missed are sent again.
+    Otherwise the local connections are closed and a new session starts.
+    """
     upstream: Dict[PortType, Type[VirtualClient]] = {
         PortType.TCP: VirtualTCPClient,
         PortType.UDP: VirtualUDPClient,
@@ -153,10 +527,74 @@ class ZomboidForwardClient(SteppingConnectMixin, SteppingReceiverMixin, Stepping
         host = conf['common']['server_addr'].strip()
         port = int(conf['common']['server_port'])
 
-        super().__init__(selector=selectors.DefaultSelector(), port=port, host=host, timeout=timeout)
+        selector = selectors.DefaultSelector()
+        timers = TimerQueue()
+        budget = BufferBudget(
+            limit=int(conf['common'].get('memory_limit') or MEMORY_LIMIT),
+            endpoint_limit=int(conf['common'].get('buffer_limit') or BUFFER_LIMIT),
+        )
+        metrics = Metrics()
+        weights = priority_weights(conf['common'])
+        super().__init__(
+            selector=selector,
+            port=port,
+            host=host,
+            timeout=timeout,
+            timers=timers,
+            budget=budget,
+            batch_size=int(conf['common'].get('batch_size') or BATCH_SIZE),
+            flush_delay=float(conf['common'].get('flush_delay') or 0) / 1000,
+            recv_size=max(BUFFER_SIZE, min(int(conf['common'].get('recv_size') or RECV_SIZE), MAX_RECV_SIZE)),
+            compressor=Compressor(selector),
+            resume_buffer=int(conf['common'].get('resume_buffer') or RESUME_BUFFER),
+            priority_weights=weights,
+            queue_delays=metrics.queue_delays,
+            tracer=tracer_of(conf['common']),
+        )
+        self._metrics = metrics
+        self._priority_weights = weights
+        self._scheduler = EventScheduler(selector, int(conf['common'].get('loop_quantum') or LOOP_QUANTUM))
+        self._await_hello = False
         self._remote2local: Dict[Tuple[PortType, int], 'socket._RetAddress'] = {}
         self._local2remote: Dict['socket._RetAddress', Tuple[PortType, int]] = {}
+        self._compression: Dict[Tuple[PortType, int], Tuple[Optional[Compression], int]] = {}
+        self._priority: Dict[Tuple[PortType, int], Priority] = {}
+        self._pools: Dict[Tuple[PortType, int], ConnectionPool] = {}
+        self._init_mappings(conf)
 
+        self._token: bytes = conf['common']['token'].strip().encode()
+        del conf['common']['token']
+        self._conf = conf
+        self._wanted_features = set(FEATURES)
+        if not to_bool(conf['common'].get('udp_transport')):
+            self._wanted_features.discard('udp_datagrams')
+        self._tunnel_count = max(1, min(int(conf['common'].get('tunnel_count') or 1), MAX_TUNNELS))
+        if self._tunnel_count == 1:
+            self._wanted_features.discard('tunnels')
+        self._reconnect = to_bool(conf['common'].get('reconnect'), True)
+        self._reconnect_max_delay = float(conf['common'].get('reconnect_max_delay') or RECONNECT_MAX_DELAY)
+        self._reconnect_delay = RECONNECT_DELAY
+        self._stopping = False
+        if self._tunnel_count > 1 or not self._reconnect:
+            self._wanted_features.discard('resume')
+        # Session id of `Command.HELLO` when it can be resumed
+        self._session: Optional[str] = None
+        self._tunnels: List[ZomboidForwardTunnel] = []
+        self._udp: TransitUDPClient = None
+        self._streams: Dict[int, VirtualClient] = {}
+        self._idle_timeout = float(conf['common'].get('idle_timeout') or TIME_OUT)
+        self._config_path: Optional[str] = None
+        self._config_mtime = 0
+        self._config_watch = to_bool(conf['common'].get('config_watch'))
+        self._reload_requested = False
+        pass
+
+    def _init_mappings(self, conf: Dict) -> None:
+        """
+        Take the port mapping sections of `conf`. Pools whose settings did not change are kept, the others are replaced
+        and have to be started or closed by the caller.
+        """
+        remote2local, local2remote, compressions, priorities, pools = {}, {}, {}, {}, {}
         for k, v in conf.items():
             if k == 'common' or k == 'DEFAULT':
                 continue
@@ -167,52 +605,320 @@ class ZomboidForwardClient(SteppingConnectMixin, SteppingReceiverMixin, Stepping
 
             local_ports = [int(x) for x in v['local_port'].split(',')]
             remote_ports = [int(x) for x in v['remote_port'].split(',')]
+            compression = compression_of(v)
+            priority = priority_of(v, port_type)
+            pool_size = int(v.get('pool_size') or 0) if port_type == PortType.TCP else 0
+            pool_max_age = float(v.get('pool_max_age') or POOL_MAX_AGE)
 
             for local_port, remote_port in zip(local_ports, remote_ports):
-                self._remote2local[(port_type, remote_port)] = (local_ip, local_port)
-                self._local2remote[(local_ip, local_port)] = (port_type, remote_port)
-
-            pass
+                key = (port_type, remote_port)
+                remote2local[key] = (local_ip, local_port)
+                local2remote[(local_ip, local_port)] = key
+                compressions[key] = compression
+                priorities[key] = priority
+                if pool_size > 0:
+                    pool = self._pools.get(key)
+                    if pool is None or (pool.addr, pool.size, pool.max_age) != ((local_ip, local_port), pool_size, pool_max_age):
+                        pool = ConnectionPool(self, (local_ip, local_port), pool_size, pool_max_age)
+                    pools[key] = pool
+
+        self._remote2local = remote2local
+        self._local2remote = local2remote
+        self._compression = compressions
+        self._priority = priorities
+        self._pools = pools
+
+    def watch_config(self, path: str) -> None:
+        """
+        Apply the port mappings of the configuration file at `path` again on SIGHUP, or when it changes with `config_watch`.
+        """
+        self._config_path = get_absolute_path(path)
+        self._config_mtime = os.stat(self._config_path).st_mtime_ns
+        if hasattr(signal, 'SIGHUP'):
+            # Only a flag, the handler may run in the middle of the loop
+            signal.signal(signal.SIGHUP, lambda *args: setattr(self, '_reload_requested', True))
+        elif not self._config_watch:
+            return
+        self._timers.call_later(CONFIG_CHECK_INTERVAL, self._check_config)
 
-        self._token: bytes = conf['common']['token'].strip().encode()
-        del conf['common']['token']
-        self._conf = conf
-        pass
+    def _check_config(self) -> None:
+        self._timers.call_later(CONFIG_CHECK_INTERVAL, self._check_config)
+        if self._config_watch:
+            try:
+                mtime = os.stat(self._config_path).st_mtime_ns
+            except OSError:
+                mtime = self._config_mtime
+            if mtime != self._config_mtime:
+                self._config_mtime = mtime
+                self._reload_requested = True
+        if self._reload_requested:
+            self._reload_requested = False
+            self.reload()
+
+    def reload(self) -> None:
+        """
+        Replace the port mappings with the ones of the configuration file. The server changes its listeners with
+        `Command.MAPPINGS` in the same session: the connections of the mappings that are kept stay open.
+        Changes of the `[common]` section need a restart.
+        """
+        logging.info('Reloading the port mappings of %s', self._config_path)
+        old_pools = self._pools
+        try:
+            conf = load_config(self._config_path)
+            self._init_mappings(conf)
+        except Exception as e:
+            logging.error('Unable to reload %s', self._config_path, exc_info=e)
+            return
+        for client in list(self._clients.values()):
+            if client._mapping not in self._remote2local:
+                client.close()
+        for pool in old_pools.values():
+            if pool not in self._pools.values():
+                pool.close()
+        for pool in self._pools.values():
+            if pool not in old_pools.values():
+                pool.start()
+        mappings = {k: v for k, v in conf.items() if k != 'common' and k != 'DEFAULT'}
+        self._conf = dict(mappings, common=self._conf['common'])
+        if 'reconfigure' in self._features:
+            self.enqueue(pack_command(Command.MAPPINGS, json.dumps({'mappings': mappings}).encode()))
+        elif self._state >= 2:
+            logging.warning('The server does not support reconfiguration, the new port mappings apply to the next session')
 
     def notify_read(self) -> None:
-        pkgs = next(self._stepping_receiver)
+        try:
+            pkgs = next(self._stepping_receiver)
+        except StopIteration:
+            logging.info('Tunnel closed by %s', self.server_addr)
+            self.close()
+            return
         if len(pkgs) == 0:
             return
         if self._state == 0:
             f = pkgs.pop(0)
             token = decrypt_token(self._token, f)
-            self.buffer.append(token)
-            self.buffer.append(json.dumps(self._conf).encode())
+            if self._session is not None:
+                # Framed like the handshake, the sequenced frames wait for `Command.RESUMED`
+                self.enqueue_control(token, pack_buffers)
+                self.enqueue_control(json.dumps({'resume': self._session, 'received': self._received}).encode(), pack_buffers)
+            else:
+                self._session_key = token
+                self.enqueue(token)
+                conf = dict(self._conf, common=dict(self._conf['common'], features=sorted(self._wanted_features)))
+                self.enqueue(json.dumps(conf).encode())
+            self._await_hello = True
             self._state = 1
 
+        self._dispatch(pkgs, self)
+
+    def _unpack_for_receive(self, data: memoryview) -> Tuple[memoryview, int, bool]:
+        pkg, length, is_finish = self._unpack(data)
+        if self._await_hello and is_finish:
+            # `Command.HELLO` or `Command.RESUMED` is the first frame after the handshake, the server switches the framing right after it
+            self._await_hello = False
+            if pkg[:4] == pack_command(Command.HELLO):
+                if 'large_frames' in json.loads(bytes(pkg[4:]))['features']:
+                    self.use_large_frames(send=False)
+            elif pkg[:4] == pack_command(Command.RESUMED) and 'large_frames' in self._features:
+                self.use_large_frames(send=False)
+        return pkg, length, is_finish
+
+    def _dispatch(self, pkgs: List[bytes], tunnel: TunnelMixin) -> None:
+        tracer = self._tracer
         for pkg in pkgs:
-            port_type, port = struct.unpack('!HH', pkg[:4])
-            remote_addr = unpack_addr(pkg[4:10])
-            self._forward_to_client(port_type, remote_addr, port, pkg[10:])
+            if tracer is not None:
+                tracer.received(pkg, tunnel)
+            self._dispatch_frame(pkg, tunnel)
+            tunnel.count_received(pkg)
+
+    def _dispatch_frame(self, pkg: bytes, tunnel: TunnelMixin) -> None:
+        if pkg[0]:
+            self._dispatch_stream(pkg)
+            return
+        port_type, port = struct.unpack('!HH', pkg[:4])
+        if port_type == PortType.CTRL:
+            self._on_command(port, pkg, tunnel)
+            return
+        tagged = 'ipv6' in self._features
+        size = head_size(pkg, tagged)
+        self._forward_to_client(port_type, unpack_addr(pkg[4:size], tagged), port, pkg[size:], tunnel)
+
+    def _dispatch_stream(self, pkg: bytes) -> None:
+        stream_id, offset = unpack_varint(pkg)
+        client = self._streams.get(stream_id)
+        if client is None:
+            return
+        data = pkg[offset:]
+        if data == b'':
+            client.close_read()
+            return
+        client.touch()
+        client.sendto_buffer(data, client.server_addr)
+
+    def _open_stream(self, pkg: bytes, tunnel: TunnelMixin) -> None:
+        stream_id, offset = unpack_varint(pkg, 4)
+        port_type, port, remote_addr = unpack_head(pkg[offset:], 'ipv6' in self._features)
+        if (port_type, port) not in self._remote2local:
+            return
+        client_id = (port_type, remote_addr)
+        if client_id not in self._clients:
+            self._init_virtual_client(port_type, remote_addr, port, tunnel)
+        client: VirtualClient = self._clients[client_id]
+        client._stream_id = stream_id
+        client._stream_prefix = pkg[4:offset]
+        self._streams[stream_id] = client
+
+    def _on_command(self, command: int, pkg: bytes, tunnel: TunnelMixin = None) -> None:
+        if command == Command.COMPRESSED:
+            self._dispatch_frame(decompress_frame(pkg), tunnel or self)
+        elif command == Command.ACK:
+            (tunnel or self).acknowledge(struct.unpack('!Q', pkg[4:12])[0])
+        elif command == Command.RESUMED:
+            received = json.loads(pkg[4:])['received']
+            replayed = self._sent - received
+            self.replay(received)
+            self._hold = False
+            self._reconnect_delay = RECONNECT_DELAY
+            logging.info('Session resumed, %s frames replayed', replayed)
+            self.want_write()
+        elif command == Command.OPEN:
+            self._open_stream(pkg, tunnel or self)
+        elif command == Command.HELLO:
+            hello = json.loads(pkg[4:])
+            self._features = set(hello['features'])
+            logging.info('Protocol features %s', self._features)
+            self._reconnect_delay = RECONNECT_DELAY
+            if 'large_frames' in self._features:
+                self.use_large_frames(receive=False)
+            if 'resume' in self._features:
+                self._session = hello['session']
+                # Counted from `Command.HELLO` on, like the server does
+                self.start_sequencing()
+            if 'udp_datagrams' in self._features:
+                keys = datagram_keys(self._token, self._session_key)
+                self._udp = TransitUDPClient(self, bytes.fromhex(hello['session']), keys)
+                self._udp.start()
+            if 'tunnels' in self._features:
+                for index in range(1, self._tunnel_count):
+                    tunnel = ZomboidForwardTunnel(self, index, hello['session'])
+                    tunnel.register(selectors.EVENT_READ | selectors.EVENT_WRITE)
+                    self._tunnels.append(tunnel)
+        elif command == Command.MAPPINGS:
+            result = json.loads(bytes(pkg[4:]))
+            if 'error' in result:
+                logging.error('The server rejected the port mappings: %s', result['error'])
+                return
+            if result['failed']:
+                logging.error('The server is unable to forward %s', result['failed'])
+            logging.info('Port mappings added %s, removed %s', result['added'], result['removed'])
+        elif command in (Command.PAUSE, Command.RESUME):
+            port_type, _, remote_addr = unpack_head(pkg[4:], 'ipv6' in self._features)
+            client = self._clients.get((port_type, remote_addr))
+            if client is None:
+                return
+            if command == Command.PAUSE:
+                client.pause_reading(Command.PAUSE)
+            else:
+                client.resume_reading(Command.PAUSE)
 
     def notify_write(self) -> None:
         if not next(self._stepping_connect):
             return
         if self._state < 1:
+            # Wait for the token factors before sending anything
+            self.want_write(False)
             return
         if self._state == 1:
-            logging.info(f'Successfully connected to server {self.server_addr}')
+            logging.info('Successfully connected to server %s', self.server_addr)
             self._state = 2
         next(self._stepping_sender)
 
+    def send_datagram(self, data: bytes) -> bool:
+        """
+        Send a frame over the UDP transport, returns False if it has to go through the tunnel.
+        """
+        return self._udp is not None and self._udp.send(data)
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        if self._reconnect and not self._stopping:
+            if not self._detached:
+                self._connection_lost()
+            return
+        super().close()
+        for tunnel in self._tunnels:
+            tunnel.close()
+        if self._udp is not None:
+            self._udp.close()
+        for pool in self._pools.values():
+            pool.close()
+        self._compressor.close()
+
+    def _connection_lost(self) -> None:
+        self.detach()
+        for tunnel in self._tunnels:
+            tunnel.close()
+        self._tunnels = []
+        if self._session is not None and self._hold and self._state >= 1:
+            logging.warning('Unable to resume session %s', self._session)
+            self._session = None
+            # The server is there, start the new session right away
+            self._reconnect_delay = RECONNECT_DELAY
+        if self._session is None:
+            self._reset_session()
+        delay = self._reconnect_delay * random.uniform(0.5, 1)
+        self._reconnect_delay = min(self._reconnect_delay * 2, self._reconnect_max_delay)
+        logging.warning('Lost connection to %s, reconnecting in %.1fs', self.server_addr, delay)
+        self._timers.call_later(delay, self._reconnect_now)
+
+    def _reset_session(self) -> None:
+        """
+        Drop the local connections and everything queued, the next connection starts a new session.
+        """
+        for client in list(self._clients.values()):
+            client.close()
+        if self._udp is not None:
+            self._udp.close()
+            self._udp = None
+        self._streams.clear()
+        self._features = set()
+        self._pack_for_send = pack_buffers
+        self.reset_queues()
+
+    def _reconnect_now(self) -> None:
+        if self._closed:
+            return
+        logging.info('Attempting to connect %s', self.server_addr)
+        self._state = 0
+        self._unpack = unpack
+        self._connected = False
+        self._hold = self._session is not None
+        self.attach(self._init_sock())
+        self._stepping_connect = self._create_stepping_connect()
+        try:
+            next(self._stepping_connect)
+        except OSError as e:
+            logging.error('Unable to connect %s', self.server_addr, exc_info=e)
+            self.close()
+
     def connect(self):
-        logging.info(f'Attempting to connect {self.server_addr}')
-        self._selector.register(self._sock, selectors.EVENT_WRITE | selectors.EVENT_READ, self)
+        logging.info('Attempting to connect %s', self.server_addr)
+        self.register(selectors.EVENT_WRITE | selectors.EVENT_READ)
+        for pool in self._pools.values():
+            pool.start()
+        metrics_endpoint = None
         try:
-            while True:
-                events = self._selector.select(0.5)
-                for key, mask in events:
-                    endpoint: Endpoint = key.data
+            metrics_endpoint = start_metrics(self._metrics, self._conf['common'], self._selector, self._timers, self._budget)
+            while not self._closed:
+                if not self._selector.get_map():
+                    # Waiting for a reconnect with nothing registered, which `select` rejects on Windows
+                    time.sleep(self._timers.timeout(0.5))
+                    self._timers.run()
+                    continue
+                events = self._scheduler.select(self._timers.timeout(0.5))
+                started = time.monotonic()
+                for endpoint, mask in events:
                     try:
                         if endpoint._closed:
                             continue
@@ -221,11 +927,23 @@ class ZomboidForwardClient(SteppingConnectMixin, SteppingReceiverMixin, Stepping
                         if mask & selectors.EVENT_READ:
                             if not endpoint._read_closed:
                                 endpoint.notify_read()
+                    except ConnectionError as e:
+                        if not isinstance(endpoint, TunnelMixin):
+                            logging.error('%s %s', endpoint._sock, getattr(endpoint, '_addr', None), exc_info=e)
+                        else:
+                            # Not a fault, `close` reconnects and resumes the session
+                            logging.warning('Tunnel %s lost: %s', endpoint.server_addr, e)
+                        endpoint.close()
                     except Exception as e:
-                        addr = getattr(endpoint, '_addr')
-                        logging.error(f"{endpoint._sock} {addr}", exc_info=e)
+                        addr = getattr(endpoint, '_addr', None)
+                        logging.error("%s %s", endpoint._sock, addr, exc_info=e)
                         endpoint.close()
+                self._timers.run()
+                self._metrics.loop(len(events), time.monotonic() - started, self._scheduler.deferred)
         finally:
+            self._stopping = True
+            if metrics_endpoint is not None:
+                metrics_endpoint.close()
             self.close()
             self._selector.close()
 
@@ -234,35 +952,48 @@ class ZomboidForwardClient(SteppingConnectMixin, SteppingReceiverMixin, Stepping
             return
         client: VirtualClient = self._clients[client_id]
         del self._clients[client_id]
+        if client._stream_id is not None:
+            self._streams.pop(client._stream_id, None)
         port_type, remote_addr = client_id
-        logging.info(f'Close {PortType(port_type).name} connection {remote_addr}')
+        logging.info('Close %s connection %s', PortType(port_type).name, remote_addr)
         client.transit(b'', client.server_addr)
         client.close()
 
-    def _forward_to_client(self, port_type: PortType, remote_addr: 'socket._RetAddress', port: int, data: bytes):
+    def _forward_to_client(
+        self,
+        port_type: PortType,
+        remote_addr: 'socket._RetAddress',
+        port: int,
+        data: bytes,
+        tunnel: TunnelMixin = None,
+    ):
+        if (port_type, port) not in self._remote2local:
+            # Removed by `reload`, the server may still have frames of it on their way
+            return
         client_id = (port_type, remote_addr)
         if data == b'':
             # self.unregister_client(client_id)
             if client_id not in self._clients:
                 return
-            self._clients[client_id]._read_closed = True
+            self._clients[client_id].close_read()
             return
         if client_id not in self._clients:
-            self._init_virtual_client(port_type, remote_addr, port)
+            self._init_virtual_client(port_type, remote_addr, port, tunnel)
         client: VirtualClient = self._clients[client_id]
         local_addr = self._remote2local[port_type, port]
+        client.touch()
         client.sendto_buffer(data, local_addr)
 
-    def _init_virtual_client(self, port_type: PortType, remote_addr: 'socket._RetAddress', port: int):
-        logging.info(f'New {PortType(port_type).name} connection {remote_addr}')
+    def _init_virtual_client(self, port_type: PortType, remote_addr: 'socket._RetAddress', port: int, tunnel: TunnelMixin = None):
+        logging.info('New %s connection %s', PortType(port_type).name, remote_addr)
         clientClass = self.upstream[port_type]
         local_addr = self._remote2local[(port_type, port)]
-        client = clientClass(server=self, host=local_addr[0], port=local_addr[1], addr=remote_addr)
-        self._selector.register(client._sock, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+        kwargs = {}
+        pool = self._pools.get((port_type, port))
+        if pool is not None:
+            kwargs['sock'] = pool.take()
+        client = clientClass(server=self, host=local_addr[0], port=local_addr[1], addr=remote_addr, tunnel=tunnel, **kwargs)
+        # EVENT_WRITE until the connection is established, see SteppingConnectMixin
+        client.register(selectors.EVENT_READ | selectors.EVENT_WRITE)
+        client.expire_idle(self._timers, self._idle_timeout)
         self._clients[(port_type, remote_addr)] = client
-
-    def _pack_for_send(self, data: bytes):
-        return pack(data)
-
-    def _unpack_for_receive(self, data: bytes) -> Tuple[bytes, int, bool]:
-        return unpack(data)
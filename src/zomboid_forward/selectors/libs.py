@@ -1,46 +1,826 @@
-from collections import deque
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice, count
+from functools import lru_cache
 import socket
+import zlib
+import lzma
 import abc
 import struct
-from typing import TypeVar, Generic, Tuple, Dict, List
+import heapq
+import hashlib
+import hmac
+import time
+import logging
+from typing import TypeVar, Generic, Tuple, Dict, List, Callable, Optional, Set, Hashable
 import selectors
 from enum import IntEnum
 
 BUFFER_SIZE = 4096
 MAX_PACKAGE_SIZE = BUFFER_SIZE
+# Upper bound of buffers passed to a single `sendmsg`
+IOV_MAX = 1024
+# Bytes coalesced into one tunnel write
+BATCH_SIZE = 64 * 1024
+# Bytes queued in a single endpoint before its producer is paused
+BUFFER_LIMIT = 1024 * 1024
+# Bytes queued in all endpoints of a process before reading is paused
+MEMORY_LIMIT = 64 * 1024 * 1024
+LENGTH_HEAD = struct.Struct('!H')
+# Frames of the `large_frames` extension, one length head per package
+LARGE_LENGTH_HEAD = struct.Struct('!I')
+MAX_FRAME_SIZE = 1024 * 1024
+# Bytes read from a socket at once, see `recv_size`
+RECV_SIZE = 64 * 1024
+MAX_RECV_SIZE = 256 * 1024
+PORT_HEAD = struct.Struct('!H')
+# Head of a frame: port type, port and a legacy address
+HEAD_SIZE = 10
+# First byte of the addresses of the `ipv6` extension, and the size of the address and port following it
+ADDRESS_TAGS = {socket.AF_INET: b'\x04', socket.AF_INET6: b'\x06'}
+ADDRESS_FAMILIES = {tag[0]: family for family, tag in ADDRESS_TAGS.items()}
+ADDRESS_SIZES = {4: 7, 6: 19}
+# Addresses whose encodings are kept, see `pack_addr`
+ADDRESS_CACHE_SIZE = 4096
+MAPPED_PREFIX = '::ffff:'
+# Optional protocol extensions, negotiated with `Command.HELLO`
+FEATURES = ('flow_control', 'udp_datagrams', 'tunnels', 'streams', 'large_frames', 'compression', 'resume', 'ipv6', 'reconfigure')
+# Upper bound of `tunnel_count`
+MAX_TUNNELS = 16
+SESSION_ID_SIZE = 8
+MAC_SIZE = 8
+# Counter of the datagrams of one direction, see `ReplayWindow`
+DATAGRAM_COUNTER = struct.Struct('!Q')
+MAC_OFFSET = SESSION_ID_SIZE + DATAGRAM_COUNTER.size
+DATAGRAM_HEAD_SIZE = MAC_OFFSET + MAC_SIZE
+# Counters below the highest received one that are still accepted once, for datagrams that arrive out of order
+REPLAY_WINDOW = 1024
+# Seconds without an answer, or on the server without a datagram of the client, after which the UDP transport
+# is taken for broken and the frames go through the tunnel until it works again
+UDP_TIMEOUT = 5
+MAX_DATAGRAM_SIZE = 65507
+# Datagrams read or sent per event of a UDP socket, so that a busy one does not starve the others
+UDP_BATCH = 64
+# Frames smaller than `compress_min_size` are sent as they are
+COMPRESS_MIN_SIZE = 512
+# Larger frames are compressed by `Compressor` instead of the event loop
+COMPRESS_INLINE_SIZE = 16 * 1024
+ZLIB_LEVEL = 6
+LZMA_PRESET = 1
+# Seconds the server keeps a session whose tunnel was lost, see `resume_grace`
+RESUME_GRACE = 60
+# Bytes of sent frames kept until the other side acknowledges them, see `resume_buffer`
+RESUME_BUFFER = 4 * 1024 * 1024
+MIN_RESUME_BUFFER = 1024 * 1024
+# Received frames are acknowledged after this many bytes or seconds
+ACK_BYTES = 256 * 1024
+ACK_DELAY = 0.5
+# Seconds of traffic a token bucket holds, see `RateLimiter`
+RATE_BURST = 1
+# Lower bound of the bytes of a bucket, so that every datagram fits in a full one
+MIN_RATE_BURST = 64 * 1024
+# Player addresses whose buckets are kept per port mapping, the least recently seen ones are dropped
+RATE_LIMIT_ADDRESSES = 4096
+# Seconds a tunnel connection may take to authenticate and send its request, see `handshake_timeout`
+HANDSHAKE_TIMEOUT = 10
+# Tunnel connections in the handshake at once, see `max_handshakes`
+MAX_HANDSHAKES = 64
+# Tunnel connections per second of one IP, after a burst that fits a client with the most tunnels reconnecting twice
+ACCEPT_RATE = 2
+ACCEPT_BURST = 2 * MAX_TUNNELS
+# Shares of the tunnel of `Priority.HIGH`, `NORMAL` and `BULK` when all of them have frames queued, see `priority_weights`
+PRIORITY_WEIGHTS = (16, 4, 1)
+# Ready endpoints stepped per iteration of the event loop, see `EventScheduler`
+LOOP_QUANTUM = 256
+# Logger of the frames sampled by `PacketTracer`, and the bytes of a frame it describes
+TRACE_LOGGER = 'zomboid_forward.trace'
+TRACE_HEAD_SIZE = 4 + ADDRESS_SIZES[6]
 
 
 class PortType(IntEnum):
+    CTRL = 0
     UDP = 1
     TCP = 2
 
 
-def pack_addr(addr: 'socket._RetAddress'):
-    return socket.inet_aton(addr[0]) + struct.pack('!H', addr[1])
+class Command(IntEnum):
+    """
+    Control frames, sent with `PortType.CTRL` in place of the port type and the command in place of the port.
+    """
+    HELLO = 1
+    PAUSE = 2
+    RESUME = 3
+    # Stream id followed by the head it stands for, see `pack_varint`
+    OPEN = 4
+    # `Compression` method followed by the compressed frame, see `compress_frame`
+    COMPRESSED = 5
+    # Number of frames received, as `!Q`
+    ACK = 6
+    # Answer to a resume request, JSON with the number of frames received
+    RESUMED = 7
+    # Port mapping sections that replace the ones of the session, as JSON, answered with the outcome
+    MAPPINGS = 8
 
 
-def unpack_addr(data: bytes) -> 'socket._RetAddress':
-    return socket.inet_ntoa(data[:4]), struct.unpack('!H', data[4:])[0]
+class Compression(IntEnum):
+    ZLIB = 1
+    LZMA = 2
 
 
-def pack(data: bytes):
-    pkg = b''
+class Priority(IntEnum):
+    """
+    Classes of `TrafficScheduler`. Frames that belong to no port mapping, e.g. commands, are `CONTROL` ones.
+    """
+    CONTROL = 0
+    HIGH = 1
+    NORMAL = 2
+    BULK = 3
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def pack_addr(addr: 'socket._RetAddress', tagged: bool = False) -> bytes:
+    """
+    Legacy addresses are an IPv4 address and a port. With the `ipv6` extension they are `tagged`
+    with their family first, see `ADDRESS_TAGS`. Addresses repeat on every datagram, so the encodings are cached.
+    """
+    host, port = addr[0], addr[1]
+    if ':' in host:
+        if not tagged:
+            raise ValueError(f'IPv6 address {host} without the ipv6 extension')
+        return ADDRESS_TAGS[socket.AF_INET6] + socket.inet_pton(socket.AF_INET6, host.partition('%')[0]) + PORT_HEAD.pack(port)
+    ip = socket.inet_aton(host) + PORT_HEAD.pack(port)
+    return ADDRESS_TAGS[socket.AF_INET] + ip if tagged else ip
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def unpack_addr(data: bytes, tagged: bool = False) -> 'socket._RetAddress':
+    if not tagged:
+        return socket.inet_ntoa(data[:4]), PORT_HEAD.unpack(data[4:])[0]
+    family = ADDRESS_FAMILIES[data[0]]
+    return socket.inet_ntop(family, data[1:-2]), PORT_HEAD.unpack(data[-2:])[0]
+
+
+def head_size(data: bytes, tagged: bool = False) -> int:
+    """
+    Size of the head at the start of `data`.
+    """
+    return 4 + ADDRESS_SIZES[data[4]] if tagged else HEAD_SIZE
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def pack_head(port_type: int, port: int, addr: 'socket._RetAddress', tagged: bool = False) -> bytes:
+    return struct.pack('!HH', port_type, port) + pack_addr(addr, tagged)
+
+
+def unpack_head(data: bytes, tagged: bool = False) -> Tuple[int, int, 'socket._RetAddress']:
+    port_type, port = struct.unpack('!HH', data[:4])
+    return port_type, port, unpack_addr(data[4:head_size(data, tagged)], tagged)
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def canonical_addr(addr: 'socket._RetAddress') -> 'socket._RetAddress':
+    """
+    Address of a peer of a dual-stack socket as the codec sees it, IPv4 ones unmapped and IPv6 ones without flow info and scope.
+    """
+    host = addr[0]
+    if host.startswith(MAPPED_PREFIX) and '.' in host:
+        host = host[len(MAPPED_PREFIX):]
+    return host, addr[1]
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def socket_addr(addr: 'socket._RetAddress', family: int) -> 'socket._RetAddress':
+    """
+    Inverse of `canonical_addr` for a socket of `family`.
+    """
+    if family == socket.AF_INET6 and '.' in addr[0]:
+        return MAPPED_PREFIX + addr[0], addr[1]
+    return addr
+
+
+def address_family(host: str) -> int:
+    """
+    Family of the sockets reaching or bound to `host`. Names are resolved as `connect` would,
+    IPv4 is kept for the ones that have both kinds of addresses, e.g. `localhost`.
+    """
+    try:
+        families = {info[0] for info in socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)}
+    except socket.gaierror:
+        return socket.AF_INET
+    return socket.AF_INET6 if families == {socket.AF_INET6} else socket.AF_INET
+
+
+def _has_dualstack_ipv6() -> bool:
+    if not socket.has_ipv6 or not hasattr(socket, 'IPV6_V6ONLY'):
+        return False
+    try:
+        with socket.socket(socket.AF_INET6, socket.SOCK_STREAM) as sock:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        return True
+    except OSError:
+        return False
+
+
+DUAL_STACK = _has_dualstack_ipv6()
+# Host of the listeners of the players, IPv4 and IPv6 ones alike where the system allows it
+ANY_HOST = '::' if DUAL_STACK else '0.0.0.0'
+
+
+def bind_socket(kind: int, host: str, port: int, reuse_port: bool = False) -> socket.socket:
+    """
+    Non-blocking socket of type `kind` bound to `host`. `::` also accepts IPv4 peers, as mapped addresses.
+    """
+    family = address_family(host)
+    sock = socket.socket(family, kind)
+    try:
+        if kind == socket.SOCK_STREAM:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if family == socket.AF_INET6 and DUAL_STACK and host in ('', '::'):
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        sock.setblocking(False)
+        sock.bind((host, port))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def pack_command(command: Command, body: bytes = b'') -> bytes:
+    return struct.pack('!HH', PortType.CTRL, command) + body
+
+
+def pack_varint(value: int) -> bytes:
+    """
+    LEB128 encoding of stream ids. Ids start at 1, so the first byte of a stream frame is never 0,
+    while frames with a head or a command always start with 0.
+    """
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def unpack_varint(data: bytes, offset: int = 0) -> Tuple[int, int]:
+    """
+    Returns the value and the offset after it.
+    """
+    value = shift = 0
+    while True:
+        b = data[offset]
+        offset += 1
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            return value, offset
+        shift += 7
+
+
+def sign(key: bytes, data: bytes) -> bytes:
+    return hashlib.blake2s(data, key=key, digest_size=MAC_SIZE).digest()
+
+
+def datagram_keys(token: bytes, digest: bytes) -> Tuple[bytes, bytes]:
+    """
+    MAC keys of the datagrams sent by the client and by the server. The digest of the handshake is sent in the clear,
+    the keys also depend on the token.
+    """
+    return hashlib.sha256(b'client' + token + digest).digest(), hashlib.sha256(b'server' + token + digest).digest()
+
+
+def pack_datagram(session_id: bytes, key: bytes, counter: int, data: bytes) -> bytes:
+    """
+    Datagram of the UDP transport: session id, counter of the sender, MAC of both and of the frame, frame.
+    """
+    head = session_id + DATAGRAM_COUNTER.pack(counter)
+    return head + sign(key, head + data) + data
+
+
+def unpack_datagram(data: bytes) -> Tuple[bytes, int, bytes]:
+    """
+    Session id, counter and frame of a datagram, check it with `verify` before using them.
+    """
+    if len(data) < DATAGRAM_HEAD_SIZE:
+        raise ValueError(f'Datagram of {len(data)} bytes')
+    return data[:SESSION_ID_SIZE], DATAGRAM_COUNTER.unpack_from(data, SESSION_ID_SIZE)[0], data[DATAGRAM_HEAD_SIZE:]
+
+
+def verify(key: bytes, data: bytes) -> bool:
+    return hmac.compare_digest(sign(key, data[:MAC_OFFSET] + data[DATAGRAM_HEAD_SIZE:]), data[MAC_OFFSET:DATAGRAM_HEAD_SIZE])
+
+
+class ReplayWindow:
+    """
+    Counters of the datagrams received from the other side, each one is accepted once.
+    Counters more than `REPLAY_WINDOW` below the highest one are refused, a game has no use for datagrams that late.
+    """
+    __slots__ = ('highest', 'seen')
+
+    def __init__(self) -> None:
+        self.highest = 0
+        # Bit n is set when `highest - n` was received
+        self.seen = 1
+
+    def accept(self, counter: int) -> bool:
+        if counter > self.highest:
+            shift = counter - self.highest
+            self.seen = (self.seen << shift | 1) & ((1 << REPLAY_WINDOW) - 1) if shift < REPLAY_WINDOW else 1
+            self.highest = counter
+            return True
+        offset = self.highest - counter
+        if offset >= REPLAY_WINDOW or self.seen >> offset & 1:
+            return False
+        self.seen |= 1 << offset
+        return True
+
+
+def pack_buffers(data: bytes) -> List[bytes]:
+    """
+    Split `data` into frame headers and payload views without copying the payload.
+    """
+    view = memoryview(data)
+    buffers = []
     for i in range(0, len(data) + 1, MAX_PACKAGE_SIZE):
-        chunk = data[i:i + MAX_PACKAGE_SIZE]
-        pkg += (struct.pack('!H', len(chunk)) + chunk)
-    return pkg
+        chunk = view[i:i + MAX_PACKAGE_SIZE]
+        buffers.append(LENGTH_HEAD.pack(len(chunk)))
+        if chunk:
+            buffers.append(chunk)
+    return buffers
+
+
+def compression_of(section: Dict) -> Tuple[Optional[Compression], int]:
+    """
+    Method and minimum frame size set by `compress` and `compress_min_size` in a port mapping.
+    """
+    name = (section.get('compress') or 'none').strip().upper()
+    method = None if name == 'NONE' else Compression[name]
+    return method, int(section.get('compress_min_size') or COMPRESS_MIN_SIZE)
+
+
+def priority_of(section: Dict, port_type: PortType) -> Priority:
+    """
+    Class of the frames of a port mapping set by `priority`, UDP ones are `high` and TCP ones `normal` by default.
+    """
+    name = (section.get('priority') or '').strip().upper()
+    if not name:
+        return Priority.HIGH if port_type == PortType.UDP else Priority.NORMAL
+    priority = Priority[name]
+    if priority == Priority.CONTROL:
+        raise ValueError(f'Invalid priority {name.lower()}')
+    return priority
+
+
+def priority_weights(common: Dict) -> Tuple[float, ...]:
+    """
+    Weights of the `high`, `normal` and `bulk` classes set by `priority_weights`, e.g. `16,4,1`.
+    """
+    value = common.get('priority_weights')
+    if not value:
+        return PRIORITY_WEIGHTS
+    weights = tuple(float(x) for x in value.split(','))
+    if len(weights) != len(PRIORITY_WEIGHTS) or min(weights) <= 0:
+        raise ValueError(f'Invalid priority_weights {value}')
+    return weights
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def fill(self, now: float) -> float:
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.tokens = tokens
+        self.stamp = now
+        return tokens
+
+
+class RateLimiter:
+    """
+    Token buckets of a port mapping, bytes and packets per second of all players and of each player IP.
+    A rate of 0 means no limit.
+
+    The buckets of the players are kept for the `max_addresses` most recently seen addresses,
+    so that spoofed sources cannot grow them without bound. A player whose buckets were dropped starts with full ones.
+    """
+
+    def __init__(self, rates: Tuple[float, float], player_rates: Tuple[float, float], max_addresses: int = RATE_LIMIT_ADDRESSES) -> None:
+        self._mapping = self._buckets(rates)
+        self._player_rates = player_rates if any(player_rates) else None
+        self._players: 'OrderedDict[str, Tuple[Optional[TokenBucket], Optional[TokenBucket]]]' = OrderedDict()
+        self._max_addresses = max_addresses
+
+    @staticmethod
+    def _buckets(rates: Tuple[float, float]) -> Tuple[Optional[TokenBucket], Optional[TokenBucket]]:
+        byte_rate, packet_rate = rates
+        return (
+            TokenBucket(byte_rate, max(byte_rate * RATE_BURST, MIN_RATE_BURST)) if byte_rate else None,
+            TokenBucket(packet_rate, max(packet_rate * RATE_BURST, 1)) if packet_rate else None,
+        )
+
+    def _player(self, host: str) -> Tuple[Optional[TokenBucket], Optional[TokenBucket]]:
+        players = self._players
+        buckets = players.get(host)
+        if buckets is None:
+            buckets = players[host] = self._buckets(self._player_rates)
+            if len(players) > self._max_addresses:
+                players.popitem(last=False)
+        else:
+            players.move_to_end(host)
+        return buckets
+
+    def allow(self, host: str, size: int, now: float) -> bool:
+        """
+        Take a datagram of `size` bytes from the buckets, False if one of them has not enough tokens and it has to be dropped.
+        """
+        byte_bucket, packet_bucket = self._mapping
+        if self._player_rates is None:
+            player_bytes = player_packets = None
+        else:
+            player_bytes, player_packets = self._player(host)
+        for bucket, amount in ((byte_bucket, size), (packet_bucket, 1), (player_bytes, size), (player_packets, 1)):
+            if bucket is not None and bucket.fill(now) < amount:
+                return False
+        for bucket, amount in ((byte_bucket, size), (packet_bucket, 1), (player_bytes, size), (player_packets, 1)):
+            if bucket is not None:
+                bucket.tokens -= amount
+        return True
+
+    def delay(self, host: str, size: int, now: float) -> float:
+        """
+        Take `size` bytes of a stream from the byte buckets, even if they go into debt.
+        Returns the seconds until they are out of it, reading should wait that long.
+        """
+        buckets = [self._mapping[0]]
+        if self._player_rates is not None:
+            buckets.append(self._player(host)[0])
+        wait = 0.0
+        for bucket in buckets:
+            if bucket is None:
+                continue
+            tokens = bucket.tokens = bucket.fill(now) - size
+            if tokens < 0:
+                wait = max(wait, -tokens / bucket.rate)
+        return wait
+
+
+def rate_limiter_of(section: Dict) -> Optional[RateLimiter]:
+    """
+    Limits of a port mapping set by `rate_limit`, `packet_limit`, `player_rate_limit` and `player_packet_limit`, None without any.
+    """
+    rates = tuple(float(section.get(key) or 0) for key in ('rate_limit', 'packet_limit', 'player_rate_limit', 'player_packet_limit'))
+    if min(rates) < 0:
+        raise ValueError(f'Invalid rate limit {rates}')
+    if not any(rates):
+        return None
+    return RateLimiter(rates[:2], rates[2:])
+
+
+def compress_frame(method: Compression, data: bytes) -> bytes:
+    """
+    Wrap `data` in a `Command.COMPRESSED` frame, or return it as it is if that does not make it smaller.
+    """
+    if method == Compression.ZLIB:
+        body = zlib.compress(data, ZLIB_LEVEL)
+    else:
+        body = lzma.compress(data, preset=LZMA_PRESET, check=lzma.CHECK_NONE)
+    head = pack_command(Command.COMPRESSED, bytes((method, )))
+    if len(head) + len(body) >= len(data):
+        return data
+    return head + body
+
+
+def decompress_frame(pkg: bytes) -> bytes:
+    method = Compression(pkg[4])
+    if method == Compression.ZLIB:
+        decompressor = zlib.decompressobj()
+    else:
+        decompressor = lzma.LZMADecompressor()
+    # Bounded, a frame never expands to more than `MAX_FRAME_SIZE`
+    data = decompressor.decompress(pkg[5:], MAX_FRAME_SIZE + 1)
+    if not decompressor.eof or len(data) > MAX_FRAME_SIZE:
+        raise ValueError(f'Invalid {method.name} frame')
+    if data[:4] == pkg[:4]:
+        raise ValueError('Nested compressed frame')
+    return data
+
+
+# Control frames that are not counted by the `resume` extension
+UNSEQUENCED = (pack_command(Command.ACK), pack_command(Command.RESUMED))
+
+
+def pack(data: bytes):
+    return b''.join(pack_buffers(data))
+
+
+def pack_large_buffers(data: bytes) -> List[bytes]:
+    return [LARGE_LENGTH_HEAD.pack(len(data)), data]
+
+
+def unpack_large(data: bytes) -> Tuple[bytes, int, bool]:
+    data_len = len(data)
+    if data_len < LARGE_LENGTH_HEAD.size:
+        return b'', 0, False
+    pkg_len = LARGE_LENGTH_HEAD.unpack_from(data)[0]
+    if pkg_len > MAX_FRAME_SIZE:
+        raise ValueError(f'Frame of {pkg_len} bytes exceeds {MAX_FRAME_SIZE}')
+    end = LARGE_LENGTH_HEAD.size + pkg_len
+    if data_len < end:
+        return b'', 0, False
+    return data[LARGE_LENGTH_HEAD.size:end], end, True
 
 
 def unpack(data: bytes) -> Tuple[bytes, int, bool]:
     data_len = len(data)
     if data_len < 2:
         return b'', 0, False
-    pkg_len = struct.unpack('!H', data[:2])[0]
+    pkg_len = struct.unpack_from('!H', data)[0]
     if data_len < 2 + pkg_len:
         return b'', 0, False
     return data[2:2 + pkg_len], 2 + pkg_len, pkg_len != MAX_PACKAGE_SIZE
 
 
+class FrameTrace:
+    """
+    Frame logged by `PacketTracer`. Only the head is kept, and it is described when the record is logged.
+    """
+    __slots__ = ('direction', 'peer', 'head', 'size', 'tagged')
+
+    def __init__(self, direction: str, peer: 'socket._RetAddress', pkg: bytes, tagged: bool) -> None:
+        self.direction = direction
+        self.peer = peer
+        # A copy, the frame may be a view of a buffer that is reused
+        self.head = bytes(pkg[:TRACE_HEAD_SIZE])
+        self.size = len(pkg)
+        self.tagged = tagged
+
+    def __str__(self) -> str:
+        try:
+            frame = self._describe()
+        except (ValueError, KeyError, IndexError, struct.error):
+            frame = 'unknown frame'
+        return f'{self.direction} {self.peer} {frame}, {self.size} bytes'
+
+    def _describe(self) -> str:
+        head = self.head
+        if head[0]:
+            return f'stream {unpack_varint(head)[0]}'
+        port_type, port = struct.unpack('!HH', head[:4])
+        if port_type == PortType.CTRL:
+            return f'command {Command(port).name}'
+        _, _, addr = unpack_head(head, self.tagged)
+        return f'{PortType(port_type).name} {port} {addr}'
+
+
+class PacketTracer:
+    """
+    Logs one in `sample` frames of each direction of the tunnels at INFO, whatever the level of the other loggers, see `trace_sample`.
+    Frames that are not sampled cost a countdown.
+    """
+    __slots__ = ('sample', '_sent', '_received', '_logger')
+
+    def __init__(self, sample: int) -> None:
+        self.sample = sample
+        self._sent = self._received = sample
+        self._logger = logging.getLogger(TRACE_LOGGER)
+        self._logger.setLevel(logging.INFO)
+
+    def sent(self, pkg: bytes, tunnel: 'TunnelMixin') -> None:
+        self._sent -= 1
+        if not self._sent:
+            self._sent = self.sample
+            self._log('sent to', pkg, tunnel)
+
+    def received(self, pkg: bytes, tunnel: 'TunnelMixin') -> None:
+        self._received -= 1
+        if not self._received:
+            self._received = self.sample
+            self._log('received from', pkg, tunnel)
+
+    def _log(self, direction: str, pkg: bytes, tunnel: 'TunnelMixin') -> None:
+        peer = getattr(tunnel, '_addr', None) or getattr(tunnel, 'server_addr', None)
+        self._logger.info('%s', FrameTrace(direction, peer, pkg, 'ipv6' in tunnel._features))
+
+
+def tracer_of(common: Dict) -> Optional[PacketTracer]:
+    """
+    Tracer of the frames set by `trace_sample`, none when it is 0.
+    """
+    sample = int(common.get('trace_sample') or 0)
+    return PacketTracer(sample) if sample > 0 else None
+
+
+class ReceiveBuffer:
+    """
+    Byte buffer with read/write offsets that is filled by `recv_into`.
+
+    Unread data is only moved when the free space at the tail runs out,
+    so the cost of receiving is linear in the number of bytes received.
+    """
+
+    def __init__(self, size: int = BUFFER_SIZE * 4) -> None:
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    def view(self) -> memoryview:
+        """
+        Unread data, only valid until the next `recv_into`.
+        """
+        return self._view[self._start:self._end]
+
+    def consume(self, length: int) -> None:
+        self._start += length
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def _reserve(self, size: int) -> None:
+        if len(self._buf) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if pending + size > len(self._buf):
+            buf = bytearray(max(len(self._buf) * 2, pending + size))
+            buf[:pending] = self._view[self._start:self._end]
+            self._buf, self._view = buf, memoryview(buf)
+        else:
+            self._view[:pending] = self._view[self._start:self._end]
+        self._start, self._end = 0, pending
+
+    def recv_into(self, sock: socket.socket, size: int = BUFFER_SIZE) -> int:
+        self._reserve(size)
+        n = sock.recv_into(self._view[self._end:self._end + size], size)
+        self._end += n
+        return n
+
+
+# Shared by all endpoints of the (single threaded) event loop
+_scratch = memoryview(bytearray(max(MAX_RECV_SIZE, MAX_DATAGRAM_SIZE)))
+
+
+def recv_bytes(sock: socket.socket, size: int = RECV_SIZE) -> bytes:
+    """
+    `recv` into a preallocated buffer, so that large reads do not allocate `size` bytes every time.
+    """
+    n = sock.recv_into(_scratch, size)
+    return _scratch[:n].tobytes()
+
+
+def recvfrom_many(sock: socket.socket, limit: int = UDP_BATCH) -> List[Tuple[bytes, 'socket._RetAddress']]:
+    """
+    `recvfrom` of the datagrams waiting on `sock`, at most `limit`, into the preallocated buffer.
+
+    A burst costs one selector wakeup instead of one per datagram.
+    """
+    datagrams = []
+    try:
+        while len(datagrams) < limit:
+            n, addr = sock.recvfrom_into(_scratch, MAX_DATAGRAM_SIZE)
+            datagrams.append((_scratch[:n].tobytes(), addr))
+    except BlockingIOError:
+        pass
+    except ConnectionResetError:  # [WinError 10054]
+        if not datagrams:
+            raise
+    return datagrams
+
+
+def send_buffers(sock: socket.socket, buffers: deque) -> int:
+    """
+    Scatter-gather send, fully sent buffers are dropped and a partially sent one is replaced by a view of its rest.
+    """
+    if hasattr(sock, 'sendmsg'):
+        sent = sock.sendmsg(list(islice(buffers, IOV_MAX)))
+    else:
+        # Windows
+        sent = sock.send(b''.join(islice(buffers, IOV_MAX)))
+    rest = sent
+    while buffers and rest >= len(buffers[0]):
+        rest -= len(buffers.popleft())
+    if rest:
+        buffers[0] = memoryview(buffers[0])[rest:]
+    return sent
+
+
+class TimerQueue:
+    """
+    Deadlines checked by the event loop on every iteration.
+    """
+
+    def __init__(self) -> None:
+        self._heap: List[list] = []
+        self._counter = count()
+
+    def call_later(self, delay: float, callback: Callable[[], None]) -> list:
+        timer = [time.monotonic() + delay, next(self._counter), callback]
+        heapq.heappush(self._heap, timer)
+        return timer
+
+    @staticmethod
+    def cancel(timer: list) -> None:
+        timer[2] = None
+
+    def timeout(self, default: float) -> float:
+        """
+        Time to wait in `select`, so that no deadline is missed.
+        """
+        heap = self._heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+        if not heap:
+            return default
+        return max(0, min(default, heap[0][0] - time.monotonic()))
+
+    def run(self) -> None:
+        heap, now = self._heap, time.monotonic()
+        while heap and heap[0][0] <= now:
+            callback = heapq.heappop(heap)[2]
+            if callback is None:
+                continue
+            try:
+                callback()
+            except Exception as e:
+                logging.error(callback, exc_info=e)
+
+
+class EventScheduler:
+    """
+    Order in which the event loop steps the ready endpoints.
+
+    A step is bounded by the endpoint: one read of `recv_size`, `UDP_BATCH` datagrams, one write of `batch_size`.
+    `Endpoint.urgent` ones, the tunnels, are stepped first on every iteration. The others take turns, at most `quantum`
+    of them per iteration and the least recently stepped first. When some are left over the next `select` does not wait,
+    so they are served on the next iteration, after the timers and the tunnels.
+
+    The bound of a step is the only budget of an endpoint, the turns are fair in steps rather than in bytes.
+    """
+
+    def __init__(self, selector: 'selectors.BaseSelector', quantum: int = LOOP_QUANTUM) -> None:
+        self.quantum = max(1, quantum)
+        # Ready endpoints left for the next iteration by the last `select`
+        self.deferred = 0
+        self._selector = selector
+        self._iteration = 0
+
+    def select(self, timeout: Optional[float]) -> List[Tuple['Endpoint', int]]:
+        events = self._selector.select(0 if self.deferred else timeout)
+        self._iteration += 1
+        urgent, others = [], []
+        for key, mask in events:
+            endpoint = key.data
+            (urgent if endpoint.urgent else others).append((endpoint, mask))
+        self.deferred = max(0, len(others) - self.quantum)
+        if self.deferred:
+            others.sort(key=lambda event: event[0]._stepped)
+            del others[self.quantum:]
+        for endpoint, _ in others:
+            endpoint._stepped = self._iteration
+        return urgent + others
+
+
+class BufferBudget:
+    """
+    Byte budget shared by all endpoints of a process.
+
+    Producers that enqueue data while the budget is exhausted have their reading paused
+    until the queued bytes fall back under half of the limit.
+    """
+
+    def __init__(self, limit: int = MEMORY_LIMIT, endpoint_limit: int = BUFFER_LIMIT) -> None:
+        self.limit = limit
+        self.endpoint_limit = endpoint_limit
+        self.used = 0
+        self._paused: Set['Endpoint'] = set()
+
+    @property
+    def exhausted(self) -> bool:
+        return self.used > self.limit
+
+    def charge(self, size: int, producer: 'Endpoint' = None) -> None:
+        self.used += size
+        if producer is not None and self.used > self.limit and producer not in self._paused:
+            self._paused.add(producer)
+            producer.pause_reading(self)
+
+    def release(self, size: int) -> None:
+        self.used -= size
+        if self._paused and self.used <= self.limit // 2:
+            paused, self._paused = self._paused, set()
+            for producer in paused:
+                producer.resume_reading(self)
+
+
 def init_tcp_keep_alive_opt(sock: socket.socket):
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
     # 35s~305s
@@ -51,14 +831,25 @@ def init_tcp_keep_alive_opt(sock: socket.socket):
 
 
 class Endpoint(abc.ABC):
+    # Stepped ahead of the others on every iteration, see `EventScheduler`
+    urgent = False
 
-    def __init__(self, sock: socket.socket, selector: 'selectors.BaseSelector', **kwargs) -> None:
+    def __init__(self, sock: socket.socket, selector: 'selectors.BaseSelector', budget: BufferBudget = None, **kwargs) -> None:
         self.buffer = deque()
         self._sock = sock
         self._selector = selector
+        self._budget = budget
         self._state = 0
         self._closed = False
         self._read_closed = False
+        self._events = 0
+        self._buffered = 0
+        self._pause_reasons: Set[Hashable] = set()
+        self._paused_producers: Set['Endpoint'] = set()
+        self._idle_timer: Optional[list] = None
+        self._last_active = 0.0
+        # Iteration of the last step, see `EventScheduler`
+        self._stepped = 0
 
     @abc.abstractmethod
     def notify_read(self) -> None:
@@ -74,15 +865,139 @@ class Endpoint(abc.ABC):
         """
         ...
 
+    def register(self, events: int) -> None:
+        """
+        Set the selector interest of the endpoint, registering or unregistering the socket as needed.
+        """
+        if self._closed or events == self._events:
+            return
+        if not self._events:
+            self._selector.register(self._sock, events, self)
+        elif not events:
+            self._selector.unregister(self._sock)
+        else:
+            self._selector.modify(self._sock, events, self)
+        self._events = events
+
+    def want_write(self, enable: bool = True) -> None:
+        """
+        Subscribe to `write` events only while there is something to send.
+        """
+        if enable:
+            self.register(self._events | selectors.EVENT_WRITE)
+        else:
+            self.register(self._events & ~selectors.EVENT_WRITE)
+
+    def _sizeof(self, data) -> int:
+        return len(data)
+
+    def is_full(self) -> bool:
+        budget = self._budget
+        return budget is not None and (self._buffered >= budget.endpoint_limit or budget.exhausted)
+
+    def enqueue(self, data, producer: 'Endpoint' = None) -> None:
+        """
+        Queue data for sending, `producer` is paused when the buffer gets full.
+        """
+        if self._closed:
+            return
+        self.buffer.append(data)
+        self._charge(self._sizeof(data), producer)
+        self.want_write()
+
+    def _charge(self, size: int, producer: 'Endpoint' = None) -> None:
+        self._buffered += size
+        budget = self._budget
+        if budget is not None:
+            budget.charge(size, producer)
+            if producer is not None and self._buffered > budget.endpoint_limit:
+                self._pause_producer(producer)
+
+    def _dequeue(self):
+        data = self.buffer.popleft()
+        self._release(self._sizeof(data))
+        return data
+
+    def _release(self, size: int) -> None:
+        self._buffered -= size
+        if self._budget is not None:
+            self._budget.release(size)
+            if self._paused_producers and self._buffered <= self._budget.endpoint_limit // 2:
+                self._resume_producers()
+
+    def _pause_producer(self, producer: 'Endpoint') -> None:
+        if producer in self._paused_producers:
+            return
+        self._paused_producers.add(producer)
+        producer.pause_reading(self)
+
+    def _resume_producers(self) -> None:
+        producers, self._paused_producers = self._paused_producers, set()
+        for producer in producers:
+            producer.resume_reading(self)
+
+    def pause_reading(self, reason: Hashable) -> None:
+        """
+        Stop reading until `resume_reading` is called with the same reason.
+        """
+        self._pause_reasons.add(reason)
+        self.register(self._events & ~selectors.EVENT_READ)
+
+    def resume_reading(self, reason: Hashable) -> None:
+        self._pause_reasons.discard(reason)
+        if not self._pause_reasons and not self._read_closed:
+            self.register(self._events | selectors.EVENT_READ)
+
+    def expire_idle(self, timers: TimerQueue, timeout: float) -> None:
+        """
+        Close the endpoint after `timeout` seconds without a call to `touch`.
+
+        Traffic only updates a timestamp, the timer is re-armed when it fires early,
+        so an endpoint costs at most one timer per `timeout`.
+        """
+        if timeout <= 0:
+            return
+        self._last_active = time.monotonic()
+        self._idle_timer = timers.call_later(timeout, lambda: self._check_idle(timers, timeout))
+
+    def touch(self) -> None:
+        self._last_active = time.monotonic()
+
+    def _check_idle(self, timers: TimerQueue, timeout: float) -> None:
+        self._idle_timer = None
+        if self._closed:
+            return
+        idle = time.monotonic() - self._last_active
+        if idle < timeout:
+            self._idle_timer = timers.call_later(timeout - idle, lambda: self._check_idle(timers, timeout))
+            return
+        logging.info('Idle for %.0fs, closing %s', idle, getattr(self, '_addr', self._sock))
+        self.close()
+
+    def close_read(self) -> None:
+        """
+        Stop reading, the endpoint is closed once the buffer is flushed.
+        """
+        self._read_closed = True
+        self.register(self._events & ~selectors.EVENT_READ | selectors.EVENT_WRITE)
+
     def close(self) -> None:
         """
         Close endpoint related resources.
         """
         if self._closed:
             return
+        if self._events:
+            self._selector.unregister(self._sock)
         self._closed = True
-        self._selector.unregister(self._sock)
+        if self._idle_timer is not None:
+            TimerQueue.cancel(self._idle_timer)
+            self._idle_timer = None
         self._sock.close()
+        self._resume_producers()
+        if self._budget is not None:
+            self._budget.release(self._buffered)
+        self._buffered = 0
 
     pass
 
@@ -93,7 +1008,7 @@ TS = TypeVar("TS", bound='ServerEndpoint')
 class ClientEndpoint(Endpoint, Generic[TS]):
 
     def __init__(self, server: TS, sock: 'socket.socket', addr: 'socket._RetAddress', **kwargs) -> None:
-        super().__init__(sock=sock, selector=server._selector, **kwargs)
+        super().__init__(sock=sock, selector=server._selector, budget=server._budget, **kwargs)
         self._server = server
         self._addr = addr
 
@@ -108,10 +1023,7 @@ class ServerEndpoint(Endpoint):
         super().__init__(sock=self._init_sock(), selector=selector, **kwargs)
 
     def _init_sock(self) -> socket:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.setblocking(False)
-        sock.bind(self.server_addr)
+        sock = bind_socket(socket.SOCK_STREAM, *self.server_addr)
         sock.listen()
         return sock
 
@@ -134,32 +1046,37 @@ class ServerEndpoint(Endpoint):
 
 
 class SteppingReceiverMixin(Endpoint):
+    _recv_size = BUFFER_SIZE
 
     def __init__(self, sock: socket.socket, selector: 'selectors.BaseSelector', **kwargs) -> None:
         super().__init__(sock=sock, selector=selector, **kwargs)
         self._stepping_receiver = self._create_receiver()
 
-    def _unpack_for_receive(self, data: bytes) -> Tuple[bytes, int, bool]:
+    def _unpack_for_receive(self, data: memoryview) -> Tuple[memoryview, int, bool]:
         return data, len(data), True
 
     def _create_receiver(self):
-        pkg_buf, data_buf = b'', b''
+        pkg_buf, data_buf = bytearray(), ReceiveBuffer()
         while True:
             # [WinError 10054]
-            data = self._sock.recv(BUFFER_SIZE)
-            if not data:
+            if not data_buf.recv_into(self._sock, self._recv_size):
                 break
             pkgs: List[bytes] = []
-            data_buf += data
+            view = data_buf.view()
+            offset = 0
             while True:
-                pkg, length, is_finish = self._unpack_for_receive(data_buf)
+                pkg, length, is_finish = self._unpack_for_receive(view[offset:])
                 if length == 0:
                     break
+                offset += length
+                if is_finish and not pkg_buf:
+                    pkgs.append(bytes(pkg))
+                    continue
                 pkg_buf += pkg
-                data_buf = data_buf[length:]
                 if is_finish:
-                    pkgs.append(pkg_buf)
-                    pkg_buf = b''
+                    pkgs.append(bytes(pkg_buf))
+                    pkg_buf.clear()
+            data_buf.consume(offset)
             yield pkgs
 
 
@@ -175,7 +1092,7 @@ class SteppingSenderMixin(Endpoint):
     def _create_sender(self):
         while True:
             try:
-                data = self.buffer.popleft()
+                data = self._dequeue()
                 data = self._pack_for_send(data)
                 while data:
                     data = self._send_to(data)
@@ -185,8 +1102,477 @@ class SteppingSenderMixin(Endpoint):
                     # check again
                     if len(self.buffer) == 0:
                         self.close()
+                else:
+                    self.want_write(False)
                 yield
 
     def _send_to(self, data):
         sended_len = self._sock.send(data)
-        return data[sended_len:]
+        if sended_len == len(data):
+            return None
+        return memoryview(data)[sended_len:]
+
+
+class DatagramSenderMixin(SteppingSenderMixin):
+    """
+    Buffer of `(data, addr)` pairs, datagrams are dropped instead of pausing the producer when it is full.
+
+    Every write event sends up to `UDP_BATCH` of them.
+    """
+
+    def enqueue_datagram(self, data: bytes, addr: 'socket._RetAddress') -> bool:
+        if self.is_full():
+            return False
+        self.enqueue((data, addr))
+        return True
+
+    def _sizeof(self, data) -> int:
+        return len(data[0])
+
+    def _create_sender(self):
+        while True:
+            sent = 0
+            try:
+                for data, addr in islice(self.buffer, UDP_BATCH):
+                    # 65507
+                    self._latest_address = addr
+                    self._sock.sendto(data, addr)
+                    sent += 1
+            except BlockingIOError:
+                pass
+            finally:
+                for _ in range(sent):
+                    self._dequeue()
+            if not self.buffer:
+                if self._read_closed:
+                    self.close()
+                else:
+                    self.want_write(False)
+            yield
+
+
+class Compressor(Endpoint):
+    """
+    Compresses large frames in a worker thread, `zlib` and `lzma` release the GIL while they work.
+
+    Results are handed back through a socket pair, so that the callbacks run on the event loop.
+    """
+
+    def __init__(self, selector: 'selectors.BaseSelector') -> None:
+        sock, self._wakeup = socket.socketpair()
+        sock.setblocking(False)
+        super().__init__(sock=sock, selector=selector)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='compress')
+        self._results = deque()
+
+    def submit(self, method: Compression, data: bytes, callback: Callable[[bytes], None]) -> None:
+        """
+        Call `callback` with the result of `compress_frame` once it is done.
+        """
+        self.register(selectors.EVENT_READ)
+        self._executor.submit(self._compress, method, data, callback)
+
+    def _compress(self, method: Compression, data: bytes, callback: Callable[[bytes], None]) -> None:
+        try:
+            frame = compress_frame(method, data)
+        except Exception as e:
+            logging.error('Unable to compress %s bytes', len(data), exc_info=e)
+            frame = data
+        self._results.append((callback, frame))
+        try:
+            self._wakeup.send(b'\0')
+        except OSError:
+            # Closed together with the event loop
+            pass
+
+    def notify_read(self) -> None:
+        try:
+            self._sock.recv(BUFFER_SIZE)
+        except BlockingIOError:
+            pass
+        while self._results:
+            callback, frame = self._results.popleft()
+            try:
+                callback(frame)
+            except Exception as e:
+                logging.error(callback, exc_info=e)
+
+    def notify_write(self) -> None:
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._executor.shutdown(wait=False)
+        super().close()
+        self._wakeup.close()
+
+
+class TrafficScheduler:
+    """
+    Queue of a tunnel with one FIFO per `Priority`, so that bulk transfers do not hold game traffic back.
+
+    `Priority.CONTROL` goes first. The other classes share the tunnel by start-time fair queueing: every class
+    has a virtual clock that a frame advances by its size divided by the weight of the class, and the class with
+    the earliest clock is served next. An idle class starts again at the clock of the last frame served, so a few
+    small frames go ahead of megabytes of queued bulk data, while a class that floods the tunnel only gets its share.
+
+    Items are the queued frames of `TunnelMixin`, the ones still being compressed block their class only.
+    The seconds every frame spent in the queue are observed by `delays`, one histogram per class.
+    """
+
+    def __init__(self, weights: Tuple[float, ...] = PRIORITY_WEIGHTS, delays: List = None) -> None:
+        self._queues = [deque() for _ in Priority]
+        self._times = [deque() for _ in Priority]
+        self._weights = (0, ) + tuple(weights)
+        self._clocks = [0.0] * len(Priority)
+        self._clock = 0.0
+        self._len = 0
+        self.delays = delays
+
+    def __len__(self) -> int:
+        return self._len
+
+    def append(self, item: list, priority: Priority = Priority.CONTROL) -> None:
+        queue = self._queues[priority]
+        if not queue and self._clocks[priority] < self._clock:
+            self._clocks[priority] = self._clock
+        queue.append(item)
+        self._times[priority].append(time.monotonic())
+        self._len += 1
+
+    def requeue(self, items: List[Tuple[list, Priority]]) -> None:
+        """
+        Put `(item, priority)` pairs back in front of their classes, in the same order.
+        """
+        now = time.monotonic()
+        for item, priority in reversed(items):
+            self._queues[priority].appendleft(item)
+            self._times[priority].appendleft(now)
+        self._len += len(items)
+
+    def select(self) -> Optional[Priority]:
+        """
+        Class of the next item, None if there is none or all of them are still being compressed.
+        """
+        queues = self._queues
+        if queues[0] and queues[0][0][0] is not None:
+            return Priority.CONTROL
+        selected, earliest = None, 0.0
+        for priority in (Priority.HIGH, Priority.NORMAL, Priority.BULK):
+            queue = queues[priority]
+            if queue and queue[0][0] is not None and (selected is None or self._clocks[priority] < earliest):
+                selected, earliest = priority, self._clocks[priority]
+        return selected
+
+    def pop(self, priority: Priority) -> list:
+        item = self._queues[priority].popleft()
+        queued = self._times[priority].popleft()
+        self._len -= 1
+        if priority:
+            self._clock = self._clocks[priority]
+            self._clocks[priority] += item[-1] / self._weights[priority]
+        if not self._len:
+            # Keep the clocks small
+            self._clocks = [0.0] * len(self._clocks)
+            self._clock = 0.0
+        if self.delays is not None:
+            self.delays[priority].observe(time.monotonic() - queued)
+        return item
+
+    def clear(self) -> None:
+        for queue in self._queues + self._times:
+            queue.clear()
+        self._clocks = [0.0] * len(self._clocks)
+        self._clock = 0.0
+        self._len = 0
+
+
+class TunnelMixin(SteppingReceiverMixin, SteppingSenderMixin):
+    """
+    Framed stream between `ZomboidForwardClient` and `TransitClientEndpoint`.
+
+    Every write event coalesces up to `batch_size` bytes of queued frames into one `sendmsg`.
+    With `flush_delay` (seconds) small batches wait at most that long for more frames.
+    Packages are framed when they are queued, so `use_large_frames` applies from the next one on.
+    Frames are queued by `TrafficScheduler` in the `Priority` class of their port mapping, weighted by `priority_weights`.
+    A package compressed by `compressor` keeps its place in its class, the sender waits for it.
+    The packages of the port mappings and the received frames are sampled by `tracer`.
+
+    With the `resume` extension both sides count the frames they receive and acknowledge them with `Command.ACK`.
+    Sent frames are kept until they are acknowledged, at most `resume_buffer` bytes, so that a session can
+    continue on a new connection with `replay`. `Command.ACK` and `Command.RESUMED` bypass the queue and the count.
+    """
+    urgent = True
+
+    def __init__(
+        self,
+        sock: socket.socket,
+        selector: 'selectors.BaseSelector',
+        timers: TimerQueue = None,
+        batch_size: int = BATCH_SIZE,
+        flush_delay: float = 0,
+        recv_size: int = BUFFER_SIZE,
+        compressor: Compressor = None,
+        resume_buffer: int = RESUME_BUFFER,
+        priority_weights: Tuple[float, ...] = PRIORITY_WEIGHTS,
+        queue_delays: List = None,
+        tracer: PacketTracer = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(sock=sock, selector=selector, **kwargs)
+        self.buffer = TrafficScheduler(priority_weights, queue_delays)
+        self._timers = timers
+        self._compressor = compressor
+        self._tracer = tracer
+        # Frames sent before anything of `buffer`, outside of the count
+        self._control = deque()
+        # Between `detach` and a new connection
+        self._detached = False
+        # Only `_control` is sent until the other side confirmed the resume
+        self._hold = False
+        self._sequenced = False
+        self._resume_buffer = max(MIN_RESUME_BUFFER, resume_buffer)
+        self._retransmit = deque()
+        self._retransmit_size = 0
+        self._sent = 0
+        self._acked = 0
+        self._received = 0
+        self._unacked_bytes = 0
+        self._ack_timer: Optional[list] = None
+        self._batch_size = batch_size
+        self._flush_delay = flush_delay if timers else 0
+        self._flush_timer: Optional[list] = None
+        self._features: Set[str] = set()
+        self._recv_size = recv_size
+        self._pack_for_send = pack_buffers
+        self._unpack = unpack
+
+    def use_large_frames(self, send: bool = True, receive: bool = True) -> None:
+        """
+        Switch to the framing of the `large_frames` extension.
+        """
+        if send:
+            self._pack_for_send = pack_large_buffers
+        if receive:
+            self._unpack = unpack_large
+
+    def enqueue(self, data: bytes, producer: Endpoint = None, priority: Priority = Priority.CONTROL) -> None:
+        buffers = self._pack_for_send(data)
+        self._enqueue_item((buffers, sum(len(b) for b in buffers)), producer, priority)
+
+    def _enqueue_item(self, item, producer: Optional[Endpoint], priority: Priority) -> None:
+        if self._closed:
+            return
+        self.buffer.append(item, priority)
+        self._charge(self._sizeof(item), producer)
+        self.want_write()
+
+    def enqueue_compressed(
+        self,
+        data: bytes,
+        compression: Tuple[Optional[Compression], int],
+        producer: Endpoint = None,
+        priority: Priority = Priority.NORMAL,
+    ) -> None:
+        """
+        Queue a package with the `compression` and the `priority` of its port mapping, see `compression_of` and `priority_of`.
+        """
+        if self._tracer is not None:
+            self._tracer.sent(data, self)
+        method, min_size = compression
+        if method is None or len(data) < min_size or 'compression' not in self._features:
+            self.enqueue(data, producer, priority)
+            return
+        if len(data) < COMPRESS_INLINE_SIZE or self._compressor is None:
+            self.enqueue(compress_frame(method, data), producer, priority)
+            return
+        if self._closed:
+            return
+        # Placeholder of buffers, queued size and framed size, filled in by `_compressed`
+        item = [None, len(data), 0]
+        self._enqueue_item(item, producer, priority)
+        pack_for_send = self._pack_for_send
+        self._compressor.submit(method, data, lambda frame: self._compressed(item, pack_for_send(frame)))
+
+    def _compressed(self, item: list, buffers: List[bytes]) -> None:
+        item[0], item[2] = buffers, sum(len(b) for b in buffers)
+        if not self._closed:
+            self.want_write()
+
+    def _sizeof(self, data: Tuple[List[bytes], int]) -> int:
+        return data[1]
+
+    def enqueue_control(self, data: bytes, pack_for_send: Callable[[bytes], List[bytes]] = None) -> None:
+        """
+        Send a frame ahead of the queue and outside of the count of the `resume` extension.
+        """
+        buffers = (pack_for_send or self._pack_for_send)(data)
+        self._control.append((buffers, sum(len(b) for b in buffers)))
+        self.want_write()
+
+    def start_sequencing(self) -> None:
+        """
+        Count the frames from here on, see `replay`.
+        """
+        self._sequenced = True
+
+    def count_received(self, pkg: bytes) -> None:
+        if not self._sequenced or not pkg[0] and pkg[:4] in UNSEQUENCED:
+            return
+        self._received += 1
+        self._unacked_bytes += len(pkg)
+        if self._unacked_bytes >= ACK_BYTES:
+            self._send_ack()
+        elif self._ack_timer is None:
+            self._ack_timer = self._timers.call_later(ACK_DELAY, self._send_ack)
+
+    def _send_ack(self) -> None:
+        if self._ack_timer is not None:
+            TimerQueue.cancel(self._ack_timer)
+            self._ack_timer = None
+        self._unacked_bytes = 0
+        if not self._detached and not self._closed:
+            self.enqueue_control(pack_command(Command.ACK, struct.pack('!Q', self._received)))
+
+    def acknowledge(self, received: int) -> None:
+        """
+        The other side got `received` frames, they no longer need to be kept.
+        """
+        retransmit = self._retransmit
+        while self._acked < received and retransmit:
+            self._retransmit_size -= retransmit.popleft()[0][-1]
+            self._acked += 1
+        if self.buffer:
+            self.want_write()
+
+    def replay(self, received: int) -> None:
+        """
+        Queue the frames the other side did not get again, in front of the others.
+        """
+        if not self._acked <= received <= self._sent:
+            raise Exception(f'Unable to resume from frame {received}, frames {self._acked} to {self._sent} are kept')
+        self.acknowledge(received)
+        items, self._retransmit = self._retransmit, deque()
+        self._retransmit_size = 0
+        self._sent = received
+        if not items:
+            return
+        self.buffer.requeue(list(items))
+        size = sum(self._sizeof(item) for item, _ in items)
+        self._buffered += size
+        if self._budget is not None:
+            self._budget.charge(size)
+        self.want_write()
+
+    def detach(self) -> None:
+        """
+        Close the connection but keep the queues, until `attach`.
+        """
+        if self._events:
+            self._selector.unregister(self._sock)
+            self._events = 0
+        self._sock.close()
+        self._detached = True
+        self._control.clear()
+        for timer in (self._flush_timer, self._ack_timer):
+            if timer is not None:
+                TimerQueue.cancel(timer)
+        self._flush_timer = self._ack_timer = None
+
+    def attach(self, sock: socket.socket) -> None:
+        """
+        Continue on a new connection, starting with fresh receiving and sending state.
+        """
+        self._sock = sock
+        self._detached = False
+        self._stepping_receiver = self._create_receiver()
+        self._stepping_sender = self._create_sender()
+        self.register(selectors.EVENT_WRITE | (0 if self._pause_reasons else selectors.EVENT_READ))
+
+    def reset_queues(self) -> None:
+        """
+        Drop everything queued or kept for the `resume` extension.
+        """
+        if self._budget is not None:
+            self._budget.release(self._buffered)
+        self._buffered = 0
+        self.buffer.clear()
+        self._control.clear()
+        self._retransmit.clear()
+        self._retransmit_size = self._sent = self._acked = self._received = self._unacked_bytes = 0
+        self._sequenced = self._hold = False
+        self._resume_producers()
+
+    def register(self, events: int) -> None:
+        if self._detached:
+            return
+        super().register(events)
+
+    def want_write(self, enable: bool = True) -> None:
+        if enable and self._flush_timer is not None and self._buffered < self._batch_size:
+            # `_flush` will take care of it
+            return
+        super().want_write(enable)
+
+    def _flush(self) -> None:
+        self._flush_timer = None
+        self.want_write()
+
+    def close(self) -> None:
+        for timer in (self._flush_timer, self._ack_timer):
+            if timer is not None:
+                TimerQueue.cancel(timer)
+        self._flush_timer = self._ack_timer = None
+        super().close()
+
+    def _create_sender(self):
+        pending, pending_len, since = deque(), 0, None
+        while True:
+            while self._control:
+                buffers, size = self._control.popleft()
+                pending.extend(buffers)
+                pending_len += size
+            while self.buffer and pending_len < self._batch_size and not self._hold:
+                if self._sequenced and self._retransmit_size >= self._resume_buffer:
+                    # Wait for `Command.ACK`
+                    break
+                priority = self.buffer.select()
+                if priority is None:
+                    # Still being compressed
+                    break
+                item = self.buffer.pop(priority)
+                self._release(self._sizeof(item))
+                if self._sequenced:
+                    self._retransmit.append((item, priority))
+                    self._retransmit_size += item[-1]
+                    self._sent += 1
+                pending.extend(item[0])
+                # The framed size, which differs from the queued one for compressed packages
+                pending_len += item[-1]
+
+            if not pending:
+                since = None
+                if self._read_closed and not self.buffer:
+                    self.close()
+                else:
+                    self.want_write(False)
+                yield
+                continue
+
+            if self._flush_delay and pending_len < self._batch_size:
+                now = time.monotonic()
+                if since is None:
+                    since = now
+                if now - since < self._flush_delay:
+                    self.want_write(False)
+                    if self._flush_timer is None:
+                        self._flush_timer = self._timers.call_later(since + self._flush_delay - now, self._flush)
+                    yield
+                    continue
+
+            pending_len -= send_buffers(self._sock, pending)
+            yield
+
+    def _unpack_for_receive(self, data: memoryview) -> Tuple[memoryview, int, bool]:
+        return self._unpack(data)
@@ -0,0 +1,143 @@
+import socket
+import logging
+import selectors
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional
+from .libs import (
+    ServerEndpoint,
+    ClientEndpoint,
+    SteppingSenderMixin,
+    TimerQueue,
+    BufferBudget,
+    BUFFER_SIZE,
+)
+from zomboid_forward.metrics import Metrics, Sample, DUMP_INTERVAL
+from zomboid_forward.utils import LogPipeline
+
+# Seconds a scraper may take to send its request
+REQUEST_TIMEOUT = 10
+
+
+class MetricsClientEndpoint(ClientEndpoint['MetricsEndpoint'], SteppingSenderMixin):
+    """
+    Answers the first request with the metrics and closes the connection, like an HTTP/1.0 server.
+    """
+
+    def __init__(self, server: 'MetricsEndpoint', sock: socket.socket, addr: 'socket._RetAddress', **kwargs) -> None:
+        super().__init__(server=server, sock=sock, addr=addr, **kwargs)
+        self._request = bytearray()
+
+    def notify_read(self) -> None:
+        data = self._sock.recv(BUFFER_SIZE)
+        self._request += data
+        if data and b'\r\n\r\n' not in self._request and len(self._request) < BUFFER_SIZE * 4:
+            return
+        body = self._server._metrics.render().encode()
+        head = f'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\n\r\n'
+        self.enqueue(head.encode() + body)
+        self.close_read()
+
+    def notify_write(self) -> None:
+        next(self._stepping_sender)
+
+    def close(self) -> None:
+        self._server.unregister_client(self._addr)
+        super().close()
+
+
+class MetricsEndpoint(ServerEndpoint):
+    """
+    Local HTTP listener serving the metrics in the Prometheus text format.
+    """
+
+    def __init__(self, selector: 'selectors.BaseSelector', timers: TimerQueue, metrics: Metrics, port: int, host: str) -> None:
+        super().__init__(selector=selector, port=port, host=host)
+        self._timers = timers
+        self._metrics = metrics
+
+    def notify_read(self) -> None:
+        try:
+            sock, addr = self._sock.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        client = MetricsClientEndpoint(self, sock, addr)
+        self.register_client(client)
+        client.register(selectors.EVENT_READ)
+        client.expire_idle(self._timers, REQUEST_TIMEOUT)
+
+
+def queue_samples(selector: 'selectors.BaseSelector', budget: BufferBudget) -> List[Sample]:
+    """
+    Registered endpoints and their queued bytes by class, and the bytes queued in the whole process.
+    """
+    depth: Dict[str, List[int]] = {}
+    for key in list(selector.get_map().values()):
+        endpoint = key.data
+        stats = depth.setdefault(type(endpoint).__name__, [0, 0, 0])
+        stats[0] += 1
+        stats[1] += endpoint._buffered
+        stats[2] = max(stats[2], endpoint._buffered)
+    samples: List[Sample] = [('zomboid_forward_memory_queued_bytes', (), budget.used)]
+    for name, (n, total, peak) in sorted(depth.items()):
+        labels = (('endpoint', name), )
+        samples.append(('zomboid_forward_endpoints', labels, n))
+        samples.append(('zomboid_forward_endpoint_queued_bytes', labels, total))
+        samples.append(('zomboid_forward_endpoint_queued_bytes_max', labels, peak))
+    return samples
+
+
+def log_samples() -> List[Sample]:
+    """
+    Records dropped because the logging thread fell behind, see `LogPipeline`.
+    """
+    dropped = sum(handler.dropped for handler in logging.getLogger().handlers if isinstance(handler, LogPipeline))
+    return [('zomboid_forward_log_dropped_records', (), dropped)]
+
+
+def start_metrics(
+    metrics: Metrics,
+    common: Dict,
+    selector: 'selectors.BaseSelector',
+    timers: TimerQueue,
+    budget: BufferBudget,
+    index: int = None,
+) -> Optional[MetricsEndpoint]:
+    """
+    Serve the metrics on `metrics_port` and dump them to `metrics_file` every `metrics_interval` seconds.
+    The snapshot is taken on the event loop and written by a thread, a snapshot is skipped while the previous one is still being written.
+
+    `index` is the worker index of a `WorkerPool`, every worker uses its own port and file.
+    """
+    metrics.add_collector(lambda: queue_samples(selector, budget))
+    metrics.add_collector(log_samples)
+    endpoint = None
+    port = int(common.get('metrics_port') or 0)
+    if port:
+        endpoint = MetricsEndpoint(selector, timers, metrics, port + (index or 0), common.get('metrics_addr') or '127.0.0.1')
+        endpoint.register(selectors.EVENT_READ)
+        logging.info('Metrics on http://%s:%s/metrics', endpoint.server_addr[0], endpoint.server_addr[1])
+
+    path = common.get('metrics_file')
+    if path:
+        if index is not None:
+            path = f'{path}.{index}'
+        interval = float(common.get('metrics_interval') or DUMP_INTERVAL)
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='metrics')
+        writing: Optional[Future] = None
+
+        def write(snapshot: str) -> None:
+            try:
+                Metrics.write(path, snapshot)
+            except OSError as e:
+                logging.error('Unable to write metrics to %s', path, exc_info=e)
+
+        def dump() -> None:
+            nonlocal writing
+            timers.call_later(interval, dump)
+            if writing is not None and not writing.done():
+                return
+            writing = executor.submit(write, metrics.snapshot())
+
+        timers.call_later(interval, dump)
+    return endpoint
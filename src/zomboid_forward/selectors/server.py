@@ -1,92 +1,248 @@
 import socket
 import abc
 import struct
-from typing import Type, Dict, Tuple
+from typing import Type, Dict, Tuple, List, Optional, Set
+from itertools import count
 import selectors
 import json
 import logging
+import secrets
+import time
+from collections import OrderedDict
 from .libs import (
     ServerEndpoint,
-    unpack_addr,
     PortType,
-    pack_addr,
+    Command,
+    pack_head,
+    unpack_head,
+    head_size,
+    canonical_addr,
+    socket_addr,
+    bind_socket,
+    pack_command,
+    pack_buffers,
+    pack_varint,
+    unpack_varint,
     ClientEndpoint,
     SteppingSenderMixin,
-    SteppingReceiverMixin,
+    DatagramSenderMixin,
+    TunnelMixin,
     init_tcp_keep_alive_opt,
     Endpoint,
+    TimerQueue,
+    EventScheduler,
+    BufferBudget,
+    Compressor,
+    compression_of,
+    priority_of,
+    rate_limiter_of,
+    RateLimiter,
+    TokenBucket,
+    priority_weights,
+    tracer_of,
+    Priority,
+    decompress_frame,
     BUFFER_SIZE,
-    pack,
-    unpack,
+    RECV_SIZE,
+    MAX_RECV_SIZE,
+    BATCH_SIZE,
+    LOOP_QUANTUM,
+    BUFFER_LIMIT,
+    MEMORY_LIMIT,
+    FEATURES,
+    MAX_TUNNELS,
+    SESSION_ID_SIZE,
+    DATAGRAM_HEAD_SIZE,
+    MAX_DATAGRAM_SIZE,
+    RESUME_GRACE,
+    RESUME_BUFFER,
+    RATE_LIMIT_ADDRESSES,
+    HANDSHAKE_TIMEOUT,
+    MAX_HANDSHAKES,
+    ACCEPT_RATE,
+    ACCEPT_BURST,
+    pack_datagram,
+    unpack_datagram,
+    verify,
+    datagram_keys,
+    ReplayWindow,
+    UDP_TIMEOUT,
+    recv_bytes,
+    recvfrom_many,
+    ANY_HOST,
 )
-from zomboid_forward.utils import encrypt_token
+from .metrics import start_metrics
+from zomboid_forward.utils import encrypt_token, to_bool
+from zomboid_forward.metrics import Metrics, MappingCounters
+from zomboid_forward.config import TIME_OUT
+from zomboid_forward.workers import PortRegistry, Worker
+
+
+def mappings_of(client_config: Dict) -> Dict[Tuple[PortType, int], Dict]:
+    """
+    Section of every `(port_type, remote_port)` of the port mapping sections of a client configuration.
+    A remote port is only forwarded once, whatever its type.
+    """
+    mappings: Dict[Tuple[PortType, int], Dict] = {}
+    ports = set()
+    for k, v in client_config.items():
+        if k == 'common' or k == 'DEFAULT':
+            continue
+        port_type = PortType[(v.get('type') or 'udp').upper()]
+        for x in v['remote_port'].split(','):
+            x = int(x)
+            if x in ports:
+                raise Exception(f'The port is already occupied:{x}')
+            ports.add(x)
+            mappings[(port_type, x)] = v
+    return mappings
 
 
 class ForwardServer(ServerEndpoint):
+    """
+    Listener of the players. The addresses of its peers are canonical, see `canonical_addr`.
+    """
 
-    def __init__(self, transit_endpoint: 'TransitClientEndpoint', port: int, host: str = '0.0.0.0', **kwargs) -> None:
-        super().__init__(selector=transit_endpoint._selector, port=port, host=host, **kwargs)
+    def __init__(self, transit_endpoint: 'TransitClientEndpoint', port: int, host: str = ANY_HOST, **kwargs) -> None:
+        super().__init__(selector=transit_endpoint._selector, port=port, host=host, budget=transit_endpoint._budget, **kwargs)
         self._transit_endpoint = transit_endpoint
+        self._recv_size = transit_endpoint._server._recv_size
+        # Stream id prefix and tunnel of every address, see `TransitClientEndpoint.open_stream`
+        self._streams: Dict['socket._RetAddress', Tuple[bytes, 'TransitClientEndpoint', int]] = {}
+        # `compress` and `priority` of the port mapping, see `compression_of` and `priority_of`
+        self._compression = (None, 0)
+        self._priority = Priority.NORMAL
+        # Limits of the players of the port mapping, see `rate_limiter_of`
+        self._limiter: Optional[RateLimiter] = None
+        self._counters: MappingCounters = None
+
+    def transit(self, addr: 'socket._RetAddress', data: bytes, port_type: PortType, producer: Endpoint = None) -> None:
+        transit = self._transit_endpoint
+        tagged = 'ipv6' in transit._features
+        if not tagged and ':' in addr[0]:
+            # The client cannot address IPv6 players
+            return
+        if data:
+            self._counters.upstream(len(data))
+        if port_type == PortType.UDP and data and transit._udp_addr is not None:
+            if transit.send_datagram(pack_head(port_type, self.server_addr[1], addr, tagged) + data):
+                return
+        stream = self._streams.get(addr)
+        if stream is None:
+            if 'streams' not in transit._features:
+                tunnel = transit.tunnel_for(port_type, addr)
+                tunnel.enqueue_compressed(pack_head(port_type, self.server_addr[1], addr, tagged) + data, self._compression, producer, self._priority)
+                return
+            if not data:
+                # Never opened or already closed by the other side
+                return
+            stream = transit.open_stream(self, port_type, addr)
+        stream[1].enqueue_compressed(stream[0] + data, self._compression, producer, self._priority)
+        if not data:
+            self.close_stream(addr)
 
-    def transit(self, addr: 'socket._RetAddress', data: bytes, port_type: PortType) -> None:
-        head = struct.pack('!HH', port_type, self.server_addr[1]) + pack_addr(addr)
-        self._transit_endpoint.buffer.append(head + data)
+    def close_stream(self, addr: 'socket._RetAddress') -> None:
+        stream = self._streams.pop(addr, None)
+        if stream is not None:
+            self._transit_endpoint._stream_table.pop(stream[2], None)
+
+    def transit_command(self, command: Command, addr: 'socket._RetAddress', port_type: PortType) -> None:
+        head = pack_head(port_type, self.server_addr[1], addr, 'ipv6' in self._transit_endpoint._features)
+        self._transit_endpoint.tunnel_for(port_type, addr).enqueue(pack_command(command, head))
 
     @classmethod
     def dispatch(cls, transit_endpoint: 'TransitClientEndpoint', data: bytes):
-        port_type, port = struct.unpack('!HH', data[:4])
-        server = transit_endpoint._port_mapping[(port_type, port)]
-        remote_addr = unpack_addr(data[4:10])
-        server._forward_to(data[10:], remote_addr)
+        tagged = 'ipv6' in transit_endpoint._features
+        port_type, port, remote_addr = unpack_head(data, tagged)
+        server = transit_endpoint._port_mapping.get((port_type, port))
+        if server is None:
+            # Removed by `Command.MAPPINGS` while the frame was on its way
+            return
+        server._forward_to(data[head_size(data, tagged):], remote_addr, transit_endpoint)
 
     @abc.abstractmethod
-    def _forward_to(self, data: bytes, addr: 'socket._RetAddress'):
+    def _forward_to(self, data: bytes, addr: 'socket._RetAddress', producer: Endpoint = None):
         ...
 
-    def register_server(self, selector: 'selectors.BaseSelector'):
-        return selector.register(self._sock, selectors.EVENT_READ, self)
+    def register_server(self):
+        self.register(selectors.EVENT_READ)
 
 
 class ForwardTCPServerEndpoint(ForwardServer):
 
     def notify_read(self) -> None:
         sock, addr = self._sock.accept()
-        logging.info(f'New TCP connection {self.server_addr}<==>{addr}')
+        addr = canonical_addr(addr)
+        if ':' in addr[0] and 'ipv6' not in self._transit_endpoint._features:
+            logging.warning('Refused IPv6 connection %s, the client does not support it', addr)
+            sock.close()
+            return
+        logging.info('New TCP connection %s<==>%s', self.server_addr, addr)
         sock.setblocking(False)
         init_tcp_keep_alive_opt(sock)
 
         client = ForwardTCPClientEndpoint(self, sock, addr)
         self.register_client(client)
-        self._selector.register(client._sock, selectors.EVENT_WRITE | selectors.EVENT_READ, client)
+        client.register(selectors.EVENT_READ)
+        transit = self._transit_endpoint
+        client.expire_idle(transit._timers, transit._server._idle_timeout)
 
-    def _forward_to(self, data: bytes, addr: 'socket._RetAddress'):
+    def _forward_to(self, data: bytes, addr: 'socket._RetAddress', producer: Endpoint = None):
         if addr not in self._clients:
-            logging.warning(f'No corresponding TCP connection {self.server_addr}<==>{addr}')
+            logging.warning('No corresponding TCP connection %s<==>%s', self.server_addr, addr)
             self.transit(addr, b'', PortType.TCP)
             return
         client = self._clients[addr]
         if data == b'':
             # client.close()
-            client._read_closed = True
+            client.close_read()
             return
-        client.buffer.append(data)
+        client.touch()
+        self._counters.downstream(len(data))
+        client.enqueue(data, producer)
 
 
 class ForwardTCPClientEndpoint(ClientEndpoint['ForwardTCPServerEndpoint'], SteppingSenderMixin):
 
     def notify_read(self) -> None:
-        data = self._sock.recv(BUFFER_SIZE)
+        data = recv_bytes(self._sock, self._server._recv_size)
         if data == b'':
-            self._read_closed = True
+            self.close_read()
             # self.close()
             return
-        self._server.transit(self._addr, data, PortType.TCP)
+        self.touch()
+        self._server.transit(self._addr, data, PortType.TCP, self)
+        limiter = self._server._limiter
+        if limiter is not None:
+            wait = limiter.delay(self._addr[0], len(data), time.monotonic())
+            if wait > 0:
+                # Over the limit, the player is slowed down by TCP flow control
+                self._server._counters.rate_limited += 1
+                self.pause_reading(limiter)
+                self._server._transit_endpoint._timers.call_later(wait, lambda: self.resume_reading(limiter))
 
     def notify_write(self) -> None:
         next(self._stepping_sender)
 
+    def _pause_producer(self, producer: Endpoint) -> None:
+        if not isinstance(producer, TransitClientEndpoint) or 'flow_control' not in producer._features:
+            return super()._pause_producer(producer)
+        if producer in self._paused_producers:
+            return
+        # Only pause this stream on the client instead of the whole tunnel
+        self._paused_producers.add(producer)
+        self._server.transit_command(Command.PAUSE, self._addr, PortType.TCP)
+
+    def _resume_producers(self) -> None:
+        tunnels = [p for p in self._paused_producers if isinstance(p, TransitClientEndpoint) and 'flow_control' in p._features]
+        if tunnels:
+            self._paused_producers.difference_update(tunnels)
+            if not self._closed:
+                self._server.transit_command(Command.RESUME, self._addr, PortType.TCP)
+        super()._resume_producers()
+
     def close(self) -> None:
-        logging.info(f'TCP client closed {self._addr}')
+        logging.info('TCP client closed %s', self._addr)
         self._server.transit(self._addr, b'', PortType.TCP)
         self._server.unregister_client(self._addr)
         return super().close()
@@ -94,65 +250,183 @@ class ForwardTCPClientEndpoint(ClientEndpoint['ForwardTCPServerEndpoint'], Stepp
     pass
 
 
-class ForwardUDPServerEndpoint(ForwardServer, SteppingSenderMixin):
+class ForwardUDPServerEndpoint(ForwardServer, DatagramSenderMixin):
     """
     Note:
         notify_read 和 notify_write 不能并行执行
     """
 
-    def __init__(self, transit_endpoint: 'TransitClientEndpoint', port: int, host: str = '0.0.0.0', **kwargs) -> None:
+    def __init__(self, transit_endpoint: 'TransitClientEndpoint', port: int, host: str = ANY_HOST, **kwargs) -> None:
         super().__init__(transit_endpoint=transit_endpoint, port=port, host=host, **kwargs)
         self._latest_address = None
+        self._family = self._sock.family
 
     def notify_read(self) -> None:
         try:
-            data, addr = self._sock.recvfrom(BUFFER_SIZE)
-            self.transit(addr, data, PortType.UDP)
+            datagrams = recvfrom_many(self._sock)
         except ConnectionResetError:  # [WinError 10054]
-            logging.info(f'UDP client closed {self._latest_address}')
+            logging.info('UDP client closed %s', self._latest_address)
             # Notify to close
-            self.transit(self._latest_address, b'', PortType.UDP)
+            self.transit(canonical_addr(self._latest_address), b'', PortType.UDP)
+            return
+        dual_stack = self._family == socket.AF_INET6
+        limiter = self._limiter
+        now = time.monotonic()
+        for data, addr in datagrams:
+            if dual_stack:
+                addr = canonical_addr(addr)
+            if limiter is not None and not limiter.allow(addr[0], len(data), now):
+                self._counters.rate_limited += 1
+                continue
+            self.transit(addr, data, PortType.UDP, self)
 
     def notify_write(self) -> None:
         next(self._stepping_sender)
 
     def _init_sock(self) -> socket:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setblocking(False)
-        sock.bind(self.server_addr)
-        return sock
+        return bind_socket(socket.SOCK_DGRAM, *self.server_addr)
+
+    def _forward_to(self, data: bytes, addr: 'socket._RetAddress', producer: Endpoint = None):
+        if data == b'':
+            # End of a virtual client, there is nothing to close for UDP
+            return
+        self._counters.downstream(len(data))
+        self.enqueue_datagram(data, socket_addr(addr, self._family))
 
-    def register_server(self, selector: selectors.BaseSelector):
-        return selector.register(self._sock, selectors.EVENT_READ | selectors.EVENT_WRITE, self)
 
-    def _forward_to(self, data: bytes, addr: 'socket._RetAddress'):
-        self.buffer.append((data, addr))
+class TransitUDPServerEndpoint(ServerEndpoint, DatagramSenderMixin):
+    """
+    UDP transport of the tunnels, carries `PortType.UDP` frames next to the TCP connection.
 
-    def _send_to(self, data):
-        # 65507
-        self._latest_address = data[1]
-        send_len = self._sock.sendto(*data)
-        data = (data[0][send_len:], data[1])
-        if data[0]:
-            return data
-        return False
+    Every datagram starts with the session id announced in `Command.HELLO`, a counter of its direction and a MAC
+    keyed with `datagram_keys`. Each counter is accepted once, see `ReplayWindow`. The client address is learned from
+    its datagrams, and its `Command.HELLO` datagrams are answered as acknowledgement and keep-alive. Frames are only
+    sent this way while the client gets the answers and its datagrams keep arriving, see `UDP_TIMEOUT`.
+    """
 
+    def __init__(self, server: 'ZomboidForwardServer') -> None:
+        self._server_worker = server._worker
+        super().__init__(selector=server._selector, port=server.server_addr[1], host=server.server_addr[0], budget=server._budget)
+        self._server = server
+        self._latest_address = None
 
-class TransitClientEndpoint(ClientEndpoint['ZomboidForwardServer'], SteppingSenderMixin, SteppingReceiverMixin):
+    def _init_sock(self) -> socket:
+        if self._server_worker is not None:
+            return self._server_worker.udp_sock
+        return bind_socket(socket.SOCK_DGRAM, *self.server_addr)
+
+    def notify_read(self) -> None:
+        try:
+            datagrams = recvfrom_many(self._sock)
+        except ConnectionResetError:  # [WinError 10054]
+            return
+        for data, addr in datagrams:
+            try:
+                self._on_datagram(data, addr)
+            except Exception as e:
+                # Only this datagram, the endpoint is shared by every session
+                logging.debug('Dropped a malformed datagram of %s', addr, exc_info=e)
+
+    def _on_datagram(self, data: bytes, addr: 'socket._RetAddress') -> None:
+        session_id, counter, body = unpack_datagram(data)
+        transit = self._server._sessions.get(session_id)
+        if transit is None or 'udp_datagrams' not in transit._features or not verify(transit._udp_keys[0], data):
+            return
+        if not transit._udp_window.accept(counter):
+            # Replayed, possibly from another address, or too late
+            return
+        transit._udp_addr = addr
+        transit._udp_seen = time.monotonic()
+        port_type = struct.unpack('!H', body[:2])[0]
+        if port_type == PortType.CTRL:
+            # The client tells whether it gets the answers
+            transit._udp_ready = body[4:5] == b'\x01'
+            self.enqueue_datagram(transit.pack_datagram(pack_command(Command.HELLO)), addr)
+            return
+        ForwardServer.dispatch(transit, body)
+
+    def notify_write(self) -> None:
+        next(self._stepping_sender)
+
+
+class TransitClientEndpoint(ClientEndpoint['ZomboidForwardServer'], TunnelMixin):
+    """
+    Tunnel connection of a client.
+
+    A session may consist of several connections (`tunnel_count`). The first one owns the
+    port mapping, the others join it by session id. Once all of them joined, or after
+    `JOIN_TIMEOUT`, the session is sealed: the forward servers start listening and every
+    stream is bound to one connection by hashing `(port_type, addr)`.
+
+    With the `resume` extension a lost connection only suspends the session for `resume_grace`
+    seconds: the forward servers, their connections and the queued frames are kept until the
+    client comes back with a resume request on a new connection, see `TunnelMixin.replay`.
+    """
 
     downstream_services: Dict[PortType, Type[ForwardServer]] = {
         PortType.TCP: ForwardTCPServerEndpoint,
         PortType.UDP: ForwardUDPServerEndpoint,
     }
+    JOIN_TIMEOUT = 5
 
     def __init__(self, server, sock, addr, **kwargs) -> None:
         super().__init__(server=server, sock=sock, addr=addr, **kwargs)
         self._port_mapping: Dict[Tuple[int, int], 'ForwardServer'] = {}
+        self._session_id = server._new_session_id()
+        self._reserved_ports = set()
+        self._udp_addr: 'socket._RetAddress' = None
+        # MAC keys of the client and of the server, and the counters of the UDP transport
+        self._udp_keys: Tuple[bytes, bytes] = None
+        self._udp_sent = 0
+        self._udp_window = ReplayWindow()
+        self._udp_seen = 0.0
+        self._udp_ready = False
+        self._primary = self
+        self._slots: List[Optional['TransitClientEndpoint']] = [self]
+        self._tunnels: List['TransitClientEndpoint'] = [self]
+        self._seal_timer = None
+        self._stream_ids = count(1)
+        self._stream_table: Dict[int, Tuple[ForwardServer, 'socket._RetAddress']] = {}
+        self._grace_timer = None
+        self._expired = False
+        self._handshake_timer = None
+        self._token_checked = False
+
+    def start_handshake(self, timeout: float) -> None:
+        """
+        Count the connection against `max_handshakes` and close it if it is not done within `timeout` seconds.
+        """
+        self._server._admission.pending.add(self)
+        if timeout > 0:
+            self._handshake_timer = self._timers.call_later(timeout, self._handshake_expired)
+
+    def _handshake_expired(self) -> None:
+        self._handshake_timer = None
+        self._reject('timeout')
+
+    def _finish_handshake(self) -> None:
+        if self._handshake_timer is not None:
+            TimerQueue.cancel(self._handshake_timer)
+            self._handshake_timer = None
+        self._server._admission.pending.discard(self)
+
+    def _reject(self, reason: str) -> None:
+        self._server._metrics.tunnels_rejected[reason] += 1
+        logging.warning('Rejected client %s: %s', self._addr, reason)
+        self.close()
+
+    def _unpack_for_receive(self, data: memoryview) -> Tuple[memoryview, int, bool]:
+        if self._state == 1 and not self._token_checked and len(data) >= 2:
+            # Anything but a token frame is refused as soon as its length is read, before it is buffered
+            if struct.unpack_from('!H', data)[0] != len(self._token):
+                raise ValueError('Not a token frame')
+            self._token_checked = True
+        return super()._unpack_for_receive(data)
 
     def notify_write(self) -> None:
         if self._state == 0:
             self._token, f1, f2 = encrypt_token(self._server._token)
-            self.buffer.append(f1 + f2)
+            self.enqueue(f1 + f2)
             self._state = 1
 
         next(self._stepping_sender)
@@ -161,107 +435,577 @@ class TransitClientEndpoint(ClientEndpoint['ZomboidForwardServer'], SteppingSend
         if self._state == 0:
             return
 
-        pkgs = next(self._stepping_receiver)
+        try:
+            pkgs = next(self._stepping_receiver)
+        except StopIteration:
+            logging.info('Tunnel closed by %s', self._addr)
+            self.close()
+            return
+        except ValueError:
+            if self._state != 1:
+                raise
+            self._reject('handshake')
+            return
 
         if len(pkgs) == 0:
             return
         if self._state == 1:
             pkg = pkgs.pop(0)
             if self._token != pkg:
-                raise Exception('VERIFICATION FAILED')
+                self._reject('token')
+                return
             self._state = 2
+            self._udp_keys = datagram_keys(self._server._token, self._token)
 
         if len(pkgs) == 0:
             return
         if self._state == 2:
             conf = json.loads(pkgs.pop(0))
-            self._init_forward_server(conf)
-            for s in self._port_mapping.values():
-                s.register_server(self._selector)
             self._state = 3
+            self._finish_handshake()
+            if 'join' in conf or 'resume' in conf:
+                self._on_request(conf)
+                if self._closed:
+                    # Handed over, or taken over by the resumed session
+                    return
+            else:
+                self._init_forward_server(conf)
+                self._negotiate(conf.get('common', {}))
 
         # if self._state < 3:
         #     return
 
+        tracer = self._tracer
         for pkg in pkgs:
-            port_type = struct.unpack('!H', pkg[:2])[0]
-            self.downstream_services[port_type].dispatch(self, pkg)
+            if tracer is not None:
+                tracer.received(pkg, self)
+            self._dispatch(pkg)
+            self.count_received(pkg)
+
+    def _dispatch(self, pkg: bytes) -> None:
+        if pkg[0]:
+            self._dispatch_stream(pkg)
+            return
+        port_type = struct.unpack('!H', pkg[:2])[0]
+        if port_type == PortType.CTRL:
+            self._on_command(pkg)
+            return
+        self.downstream_services[port_type].dispatch(self, pkg)
+
+    def _dispatch_stream(self, pkg: bytes) -> None:
+        stream_id, offset = unpack_varint(pkg)
+        stream = self._primary._stream_table.get(stream_id)
+        if stream is None:
+            return
+        server, addr = stream
+        data = pkg[offset:]
+        if not data:
+            server.close_stream(addr)
+        server._forward_to(data, addr, self)
+
+    def open_stream(self, server: ForwardServer, port_type: PortType, addr: 'socket._RetAddress') -> Tuple[bytes, 'TransitClientEndpoint', int]:
+        """
+        Announce a stream with `Command.OPEN`, its frames then start with the stream id instead of the head.
+        """
+        stream_id = next(self._stream_ids)
+        prefix = pack_varint(stream_id)
+        tunnel = self.tunnel_for(port_type, addr)
+        head = pack_head(port_type, server.server_addr[1], addr, 'ipv6' in self._features)
+        # In the class of the stream, so that it goes before the first frame
+        tunnel.enqueue(pack_command(Command.OPEN, prefix + head), priority=server._priority)
+        self._stream_table[stream_id] = (server, addr)
+        stream = server._streams[addr] = (prefix, tunnel, stream_id)
+        return stream
+
+    def _negotiate(self, common: Dict) -> None:
+        features = common.get('features')
+        if features is None:
+            # Clients without protocol extensions do not understand control frames
+            self._seal()
+            return
+        self._features = set(features) & self._server._features
+        self._server._sessions[self._session_id] = self
+        tunnel_count = 1
+        if 'tunnels' in self._features:
+            tunnel_count = max(1, min(int(common.get('tunnel_count') or 1), MAX_TUNNELS))
+        if tunnel_count > 1:
+            # The order of the streams cannot be kept across the connections of a resumed session
+            self._features.discard('resume')
+        hello = json.dumps({
+            'features': sorted(self._features),
+            'session': self._session_id.hex(),
+        }).encode()
+        self.enqueue(pack_command(Command.HELLO, hello))
+        if 'large_frames' in self._features:
+            # Every frame after `Command.HELLO`, the client sends nothing until it got it
+            self.use_large_frames()
+        if 'resume' in self._features:
+            # `Command.HELLO` is the first counted frame
+            self.start_sequencing()
+
+        if tunnel_count == 1:
+            self._seal()
+            return
+        self._slots += [None] * (tunnel_count - 1)
+        self._seal_timer = self._timers.call_later(self.JOIN_TIMEOUT, self._seal)
+
+    def _on_request(self, request: Dict) -> None:
+        """
+        Request of a connection that continues an existing session instead of opening one.
+        """
+        session = request.get('join') or request['resume']
+        session_id = bytes.fromhex(session)
+        worker = self._server._worker
+        if worker is not None and session_id[:1] and session_id[0] != worker.index:
+            if session_id[0] >= worker.count:
+                raise Exception(f'Unknown session {session}')
+            # The connection landed on another worker than the one owning the session
+            logging.debug('Handing tunnel %s over to worker %s', self._addr, session_id[0])
+            worker.handoff(session_id[0], self._sock, json.dumps(request).encode())
+            self.close()
+            return
+        if 'join' in request:
+            self._join(session_id, request)
+        else:
+            self._resume(session_id, request)
+
+    def _join(self, session_id: bytes, request: Dict) -> None:
+        primary = self._server._sessions.get(session_id)
+        index = int(request['index'])
+        if primary is None or primary._seal_timer is None or not 0 < index < len(primary._slots) or primary._slots[index]:
+            raise Exception(f'Unable to join session {request["join"]}')
+        logging.info('Tunnel %s joined session %s', index, primary._addr)
+        self._primary = primary
+        self._features = primary._features
+        self._port_mapping = primary._port_mapping
+        primary._slots[index] = self
+        if 'large_frames' in self._features:
+            self.use_large_frames()
+        if all(primary._slots):
+            primary._seal()
+
+    def _resume(self, session_id: bytes, request: Dict) -> None:
+        session = self._server._sessions.get(session_id)
+        if session is None or 'resume' not in session._features:
+            raise Exception(f'Unable to resume session {request["resume"]}')
+        # The session takes over the connection
+        if self._events:
+            self._selector.unregister(self._sock)
+            self._events = 0
+        self._closed = True
+        self._server.unregister_client(self._addr)
+        try:
+            session._attach(self._sock, self._addr, int(request['received']))
+        except Exception:
+            self._sock.close()
+            raise
+
+    def _attach(self, sock: socket.socket, addr: 'socket._RetAddress', received: int) -> None:
+        if not self._detached:
+            # The old connection is half-open, the client already gave up on it
+            self._suspend()
+        replayed = self._sent - received
+        self.replay(received)
+        TimerQueue.cancel(self._grace_timer)
+        self._grace_timer = None
+        logging.info('Session %s resumed from %s, %s frames replayed', self._addr, addr, replayed)
+        self._server.unregister_client(self._addr)
+        self._addr = addr
+        self._server.register_client(self)
+        self.attach(sock)
+        resumed = json.dumps({'received': self._received}).encode()
+        # Framed like the handshake, the client switches to `large_frames` after it
+        self.enqueue_control(pack_command(Command.RESUMED, resumed), pack_buffers)
+
+    def _suspend(self) -> None:
+        grace = self._server._resume_grace
+        logging.info('Tunnel %s lost, keeping the session for %.0fs', self._addr, grace)
+        self.detach()
+        self._grace_timer = self._timers.call_later(grace, self._expire)
+
+    def _expire(self) -> None:
+        logging.info('Session %s expired', self._addr)
+        self._grace_timer = None
+        self._expired = True
+        self.close()
+
+    def _seal(self) -> None:
+        if self._seal_timer is not None:
+            TimerQueue.cancel(self._seal_timer)
+            self._seal_timer = None
+        self._tunnels = [t for t in self._slots if t is not None]
+        if len(self._slots) > 1:
+            logging.info('Session %s uses %s/%s tunnels', self._addr, len(self._tunnels), len(self._slots))
+        for s in self._port_mapping.values():
+            s.register_server()
+
+    def tunnel_for(self, port_type: PortType, addr: 'socket._RetAddress') -> 'TransitClientEndpoint':
+        """
+        Connection of the session that carries the stream, so that its frames stay in order.
+        """
+        tunnels = self._tunnels
+        if len(tunnels) == 1:
+            return self
+        return tunnels[hash((port_type, addr)) % len(tunnels)]
+
+    def send_datagram(self, data: bytes) -> bool:
+        """
+        Send a frame over the UDP transport, returns False if it has to go through the tunnel.
+        """
+        if self._udp_addr is None or not self._udp_ready or len(data) > MAX_DATAGRAM_SIZE - DATAGRAM_HEAD_SIZE:
+            return False
+        if time.monotonic() - self._udp_seen > UDP_TIMEOUT:
+            logging.warning('UDP transport of %s lost, using the tunnel', self._addr)
+            self._udp_ready = False
+            return False
+        self._server._udp_endpoint.enqueue_datagram(self.pack_datagram(data), self._udp_addr)
+        return True
+
+    def pack_datagram(self, data: bytes) -> bytes:
+        self._udp_sent += 1
+        return pack_datagram(self._session_id, self._udp_keys[1], self._udp_sent, data)
+
+    def _on_command(self, pkg: bytes) -> None:
+        command = struct.unpack('!H', pkg[2:4])[0]
+        if command == Command.COMPRESSED:
+            self._dispatch(decompress_frame(pkg))
+        elif command == Command.ACK:
+            self.acknowledge(struct.unpack('!Q', pkg[4:12])[0])
+        elif command == Command.MAPPINGS and 'reconfigure' in self._features:
+            result = self._primary._reconfigure(json.loads(bytes(pkg[4:]))['mappings'])
+            self.enqueue(pack_command(Command.MAPPINGS, json.dumps(result).encode()))
+        elif command in (Command.PAUSE, Command.RESUME):
+            port_type, port, remote_addr = unpack_head(pkg[4:], 'ipv6' in self._features)
+            server = self._port_mapping.get((port_type, port))
+            client = server and server._clients.get(remote_addr)
+            if client is None:
+                return
+            if command == Command.PAUSE:
+                client.pause_reading(Command.PAUSE)
+            else:
+                client.resume_reading(Command.PAUSE)
 
     def close(self) -> None:
+        if self._closed:
+            return
+        self._finish_handshake()
+        if 'resume' in self._features and self._server._resume_grace > 0 and not self._expired:
+            if not self._detached:
+                self._suspend()
+            return
+        if self._grace_timer is not None:
+            TimerQueue.cancel(self._grace_timer)
+            self._grace_timer = None
+        super().close()
+        self._server.unregister_client(self._addr)
+        if self._primary is not self:
+            # The session cannot keep the order of the streams of this connection
+            self._primary.close()
+            return
+        if self._seal_timer is not None:
+            TimerQueue.cancel(self._seal_timer)
         for s in self._port_mapping.values():
             s.close()
-            self._server._used_ports.remove(s.server_addr[1])
-        super().close()
+        self._server._port_registry.release(self._reserved_ports)
+        for t in self._slots:
+            if t is not None:
+                t.close()
+        self._server._sessions.pop(self._session_id, None)
 
     def _init_forward_server(self, client_config: Dict):
-        ports = set()
-        for k, v in client_config.items():
-            if k == 'common' or k == 'DEFAULT':
-                continue
-            for x in v['remote_port'].split(','):
-                x = int(x)
-                if x in ports:
-                    raise Exception(f'The port is already occupied:{x}')
-                ports.add(x)
-            pass
-
-        duplicate_port = ports & self._server._used_ports
-        if duplicate_port:
-            raise Exception(f'The port is already occupied:{duplicate_port}')
-
-        for k, v in client_config.items():
-            if k == 'common' or k == 'DEFAULT':
-                continue
+        mappings = mappings_of(client_config)
+        ports = {port for _, port in mappings}
+        self._reserve_ports(ports)
+        self._reserved_ports = ports
 
-            server_type = v.get('type') or 'udp'
-            port_type = PortType[server_type.upper()]
-            ServerClass = self.downstream_services[port_type]
+        for (port_type, remote_port), section in mappings.items():
+            server = self._port_mapping[(port_type, remote_port)] = self.downstream_services[port_type](self, remote_port)
+            self._configure_forward_server(server, section)
 
-            remote_ports = set(int(x) for x in v['remote_port'].split(','))
+    def _reserve_ports(self, ports: Set[int]) -> None:
+        for session in list(self._server._sessions.values()):
+            if session._detached and session._reserved_ports & ports:
+                # Nobody is going to resume it, the client came back with a new session
+                session._expire()
+        self._server._port_registry.reserve(ports)
 
-            for remote_port in remote_ports:
-                self._port_mapping[(port_type, remote_port)] = ServerClass(self, remote_port)
+    def _configure_forward_server(self, server: ForwardServer, section: Dict) -> None:
+        port_type = PortType.TCP if isinstance(server, ForwardTCPServerEndpoint) else PortType.UDP
+        server._compression = compression_of(section)
+        server._priority = priority_of(section, port_type)
+        server._limiter = rate_limiter_of(section)
+        server._counters = self._server._metrics.mapping(port_type, server.server_addr[1])
 
-            pass
+    def _reconfigure(self, client_config: Dict) -> Dict:
+        """
+        Replace the port mappings of the session with the sections of `Command.MAPPINGS`.
 
-        self._server._used_ports |= ports
+        Removed mappings are closed with their connections, new ones start listening, and the others
+        keep their connections and only take the new settings. Mappings that fail to listen are skipped.
+        """
+        try:
+            mappings = mappings_of(client_config)
+        except Exception as e:
+            return {'error': str(e)}
+        removed = [key for key in self._port_mapping if key not in mappings]
+        for key in removed:
+            server = self._port_mapping.pop(key)
+            for addr in list(server._streams):
+                server.close_stream(addr)
+            server.close()
+        released = self._reserved_ports - {port for _, port in mappings}
+        self._server._port_registry.release(released)
+        self._reserved_ports -= released
 
-    def _pack_for_send(self, data: bytes):
-        return pack(data)
+        added, failed = [], {}
+        for key, section in mappings.items():
+            port_type, port = key
+            server = self._port_mapping.get(key)
+            if server is None:
+                reserved = port not in self._reserved_ports
+                try:
+                    if reserved:
+                        self._reserve_ports({port})
+                        self._reserved_ports.add(port)
+                    server = self.downstream_services[port_type](self, port)
+                except Exception as e:
+                    logging.error('Unable to forward %s port %s', port_type.name, port, exc_info=e)
+                    if reserved and port in self._reserved_ports:
+                        self._server._port_registry.release({port})
+                        self._reserved_ports.discard(port)
+                    failed[f'{port_type.name.lower()}/{port}'] = str(e)
+                    continue
+                self._port_mapping[key] = server
+                added.append(key)
+                if self._seal_timer is None:
+                    # Otherwise `_seal` starts it with the others
+                    server.register_server()
+            self._configure_forward_server(server, section)
+        result = {
+            'added': [f'{port_type.name.lower()}/{port}' for port_type, port in added],
+            'removed': [f'{PortType(port_type).name.lower()}/{port}' for port_type, port in removed],
+            'failed': failed,
+        }
+        logging.info('Session %s reconfigured, added %s, removed %s', self._addr, result['added'], result['removed'])
+        return result
 
-    def _unpack_for_receive(self, data: bytes) -> Tuple[bytes, int, bool]:
-        return unpack(data)
 
-    pass
+class HandoffEndpoint(Endpoint):
+    """
+    Receives the tunnel connections that joined or resumed a session of this worker on another worker.
+    """
+
+    def __init__(self, server: 'ZomboidForwardServer') -> None:
+        super().__init__(sock=server._worker.inbox, selector=server._selector)
+        self._server = server
+
+    def notify_read(self) -> None:
+        try:
+            sock, data = self._server._worker.receive()
+        except Exception as e:
+            logging.error('Unable to take over a tunnel', exc_info=e)
+            return
+        try:
+            addr = sock.getpeername()
+        except OSError:
+            sock.close()
+            return
+        server = self._server
+        client = TransitClientEndpoint(
+            server,
+            sock,
+            addr,
+            timers=server._timers,
+            batch_size=server._batch_size,
+            flush_delay=server._flush_delay,
+            recv_size=server._recv_size,
+            compressor=server._compressor,
+            resume_buffer=server._resume_buffer,
+            priority_weights=server._priority_weights,
+            queue_delays=server._metrics.queue_delays,
+            tracer=server._tracer,
+        )
+        # The handshake was completed by the worker that accepted it
+        client._state = 3
+        server.register_client(client)
+        client.register(selectors.EVENT_READ)
+        try:
+            client._on_request(json.loads(data))
+        except Exception as e:
+            logging.error(client._sock, exc_info=e)
+            client.close()
+
+    def notify_write(self) -> None:
+        raise NotImplementedError()
+
+
+class AdmissionControl:
+    """
+    Decides on a tunnel connection right after it is accepted, before anything is allocated for it.
+
+    One IP may open `rate` connections per second after a burst of `ACCEPT_BURST`, and at most `limit`
+    connections may be in the handshake at once, so that scanners and half-open connections cannot
+    take the place of real tunnels. A rate or limit of 0 means no limit.
+    """
+
+    def __init__(self, rate: float, limit: int, max_addresses: int = RATE_LIMIT_ADDRESSES) -> None:
+        if rate < 0 or limit < 0:
+            raise ValueError(f'Invalid admission limits {rate}, {limit}')
+        self._rate = rate
+        self._limit = limit
+        self._max_addresses = max_addresses
+        self._hosts: 'OrderedDict[str, TokenBucket]' = OrderedDict()
+        # Connections between `TransitClientEndpoint.start_handshake` and the request of the client
+        self.pending: Set['TransitClientEndpoint'] = set()
+
+    def admit(self, host: str, now: float) -> Optional[str]:
+        """
+        None if a connection of `host` may start the handshake, otherwise the reason to refuse it.
+        A rate token is only spent on admitted connections, refusals at capacity do not count against the IP.
+        """
+        if self._limit and len(self.pending) >= self._limit:
+            return 'capacity'
+        if self._rate:
+            hosts = self._hosts
+            bucket = hosts.get(host)
+            if bucket is None:
+                bucket = hosts[host] = TokenBucket(self._rate, max(self._rate, ACCEPT_BURST))
+                if len(hosts) > self._max_addresses:
+                    hosts.popitem(last=False)
+            else:
+                hosts.move_to_end(host)
+            if bucket.fill(now) < 1:
+                return 'rate'
+            bucket.tokens -= 1
+        return None
 
 
 class ZomboidForwardServer(ServerEndpoint):
+    """
+    Accepts the tunnels of the clients.
+
+    With `worker` it runs as one of the processes of a `WorkerPool`, using the listening sockets and the port registry of the pool.
+    """
 
-    def __init__(self, conf: Dict) -> None:
-        super().__init__(selector=selectors.DefaultSelector(), port=int(conf['common']['bind_port']), host=conf['common']['bind_addr'])
-        self._used_ports = set()
+    def __init__(self, conf: Dict, worker: Worker = None) -> None:
+        self._worker = worker
+        budget = BufferBudget(
+            limit=int(conf['common'].get('memory_limit') or MEMORY_LIMIT),
+            endpoint_limit=int(conf['common'].get('buffer_limit') or BUFFER_LIMIT),
+        )
+        super().__init__(
+            selector=selectors.DefaultSelector(),
+            port=int(conf['common']['bind_port']),
+            host=conf['common']['bind_addr'],
+            budget=budget,
+        )
+        self._port_registry = PortRegistry() if worker is None else worker.registry
+        self._timers = TimerQueue()
+        self._scheduler = EventScheduler(self._selector, int(conf['common'].get('loop_quantum') or LOOP_QUANTUM))
+        self._batch_size = int(conf['common'].get('batch_size') or BATCH_SIZE)
+        self._flush_delay = float(conf['common'].get('flush_delay') or 0) / 1000
+        self._recv_size = max(BUFFER_SIZE, min(int(conf['common'].get('recv_size') or RECV_SIZE), MAX_RECV_SIZE))
+        self._idle_timeout = float(conf['common'].get('idle_timeout') or TIME_OUT)
+        self._resume_grace = float(conf['common'].get('resume_grace') or RESUME_GRACE)
+        self._resume_buffer = int(conf['common'].get('resume_buffer') or RESUME_BUFFER)
+        self._priority_weights = priority_weights(conf['common'])
+        self._tracer = tracer_of(conf['common'])
+        self._handshake_timeout = float(conf['common'].get('handshake_timeout') or HANDSHAKE_TIMEOUT)
+        self._admission = AdmissionControl(
+            float(conf['common'].get('accept_rate') or ACCEPT_RATE),
+            int(conf['common'].get('max_handshakes') or MAX_HANDSHAKES),
+        )
+        self._compressor = Compressor(self._selector)
+        self._metrics = Metrics()
+        self._metrics.add_collector(lambda: [('zomboid_forward_handshakes_pending', (), len(self._admission.pending))])
+        self._common = conf['common']
+        self._features = set(FEATURES)
+        self._sessions: Dict[bytes, TransitClientEndpoint] = {}
+        self._udp_endpoint: TransitUDPServerEndpoint = None
+        if to_bool(conf['common'].get('udp_transport')) and (worker is None or worker.udp_sock is not None):
+            self._udp_endpoint = TransitUDPServerEndpoint(self)
+        else:
+            self._features.discard('udp_datagrams')
+        if self._resume_grace <= 0:
+            self._features.discard('resume')
         self._token: bytes = conf['common']['token'].strip().encode()
         del conf['common']['token']
 
+    def _init_sock(self) -> socket:
+        if self._worker is not None:
+            return self._worker.listener
+        return super()._init_sock()
+
+    def _new_session_id(self) -> bytes:
+        if self._worker is None:
+            return secrets.token_bytes(SESSION_ID_SIZE)
+        # The first byte routes joining tunnels and UDP transport datagrams to this worker
+        return bytes([self._worker.index]) + secrets.token_bytes(SESSION_ID_SIZE - 1)
+
     def notify_read(self) -> None:
-        sock, addr = self._sock.accept()
-        logging.info(f'Successfully connected to client {addr}')
+        try:
+            sock, addr = self._sock.accept()
+        except BlockingIOError:
+            return
+        # Before the token factors are generated, refusing costs no more than the accept
+        reason = self._admission.admit(addr[0], time.monotonic())
+        if reason is not None:
+            sock.close()
+            self._metrics.tunnels_rejected[reason] += 1
+            logging.debug('Rejected client %s: %s', addr, reason)
+            return
+        logging.info('Successfully connected to client %s', addr)
         sock.setblocking(False)
         init_tcp_keep_alive_opt(sock)
 
-        client = TransitClientEndpoint(self, sock, addr)
+        client = TransitClientEndpoint(
+            self,
+            sock,
+            addr,
+            timers=self._timers,
+            batch_size=self._batch_size,
+            flush_delay=self._flush_delay,
+            recv_size=self._recv_size,
+            compressor=self._compressor,
+            resume_buffer=self._resume_buffer,
+            priority_weights=self._priority_weights,
+            queue_delays=self._metrics.queue_delays,
+            tracer=self._tracer,
+        )
         self.register_client(client)
-        self._selector.register(client._sock, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+        client.start_handshake(self._handshake_timeout)
+        # EVENT_WRITE is needed once to send the token factors
+        client.register(selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+    def close(self) -> None:
+        # Sessions are closed for good on shutdown
+        self._resume_grace = 0
+        super().close()
 
     def serve_forever(self):
         logging.info('Waiting for client connection...')
-        logging.info(f'Listening for {self.server_addr}')
+        logging.info('Listening for %s', self.server_addr)
+        metrics_endpoint = None
         try:
-            self._selector.register(self._sock, selectors.EVENT_READ, self)
+            self.register(selectors.EVENT_READ)
+            metrics_endpoint = start_metrics(
+                self._metrics,
+                self._common,
+                self._selector,
+                self._timers,
+                self._budget,
+                None if self._worker is None else self._worker.index,
+            )
+            if self._udp_endpoint is not None:
+                logging.info('UDP transport on %s', self._udp_endpoint.server_addr)
+                self._udp_endpoint.register(selectors.EVENT_READ)
+            if self._worker is not None:
+                logging.info('Running as worker %s/%s', self._worker.index, self._worker.count)
+                HandoffEndpoint(self).register(selectors.EVENT_READ)
             while True:
-                events = self._selector.select(0.5)
-                for key, mask in events:
-                    endpoint: Endpoint = key.data
+                events = self._scheduler.select(self._timers.timeout(0.5))
+                started = time.monotonic()
+                for endpoint, mask in events:
                     if endpoint._closed:
                         continue
                     try:
@@ -270,9 +1014,23 @@ class ZomboidForwardServer(ServerEndpoint):
                         if mask & selectors.EVENT_READ:
                             if not endpoint._read_closed:
                                 endpoint.notify_read()
+                    except ConnectionError as e:
+                        if not isinstance(endpoint, TunnelMixin):
+                            logging.error(endpoint._sock, exc_info=e)
+                        else:
+                            # Not a fault, `close` suspends the session when it can be resumed
+                            logging.warning('Tunnel %s lost: %s', endpoint._addr, e)
+                        endpoint.close()
                     except Exception as e:
                         logging.error(endpoint._sock, exc_info=e)
                         endpoint.close()
+                self._timers.run()
+                self._metrics.loop(len(events), time.monotonic() - started, self._scheduler.deferred)
         finally:
+            if metrics_endpoint is not None:
+                metrics_endpoint.close()
+            if self._udp_endpoint is not None:
+                self._udp_endpoint.close()
+            self._compressor.close()
             self.close()
             self._selector.close()
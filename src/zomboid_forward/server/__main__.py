@@ -2,14 +2,33 @@
 # -*- coding: utf-8 -*
 
 from zomboid_forward.selectors.server import ZomboidForwardServer
-from zomboid_forward.utils import init_log, load_config, get_absolute_path
+from zomboid_forward.aio.server import ZomboidForwardServer as AsyncZomboidForwardServer
+from zomboid_forward.utils import init_log, load_config, get_absolute_path, to_bool
+from zomboid_forward.workers import WorkerPool
 from zomboid_forward import __version__
+import logging
 import os
 
 
-def main(config_path, level: str = None):
+def main(config_path, level: str = None, workers: int = None, engine: str = None):
     config = load_config(config_path)
-    server = ZomboidForwardServer(config)
+    server_class = AsyncZomboidForwardServer if engine == 'asyncio' else ZomboidForwardServer
+    workers = int(workers or config['common'].get('workers') or 1)
+    if workers > 1:
+        init_log(
+            config['common'].get('log_file'),
+            level or config['common'].get('log_level'),
+        )
+        if WorkerPool.supported():
+            pool = WorkerPool(
+                workers,
+                (config['common']['bind_addr'], int(config['common']['bind_port'])),
+                udp_transport=to_bool(config['common'].get('udp_transport')),
+            )
+            pool.run(lambda worker: server_class(config, worker).serve_forever())
+            return
+        logging.warning('Worker processes are not supported on this platform, running a single process')
+    server = server_class(config)
     init_log(
         config['common'].get('log_file'),
         level or config['common'].get('log_level'),
@@ -30,6 +49,19 @@ if __name__ == '__main__':
         "--level",
         help="log level",
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        help="number of worker processes",
+    )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=('selectors', 'asyncio'),
+        default='selectors',
+        help="event loop implementation",
+    )
     args = parser.parse_args()
     config_path = args.config
     if config_path:
@@ -37,4 +69,6 @@ if __name__ == '__main__':
     main(
         config_path or 'server.ini',
         level=args.level,
+        workers=args.workers,
+        engine=args.engine,
     )
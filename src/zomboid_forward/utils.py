@@ -2,12 +2,15 @@ import logging
 import hashlib
 import secrets
 import os
+import queue
 import configparser
-from logging.handlers import RotatingFileHandler
+from typing import List, Optional
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from zomboid_forward.config import (
     ENCRYPTION_SIZE,
     LOG_FORMAT,
     LOG_LEVEL,
+    LOG_QUEUE_SIZE,
     ENCODING,
     BASE_PATH,
 )
@@ -30,6 +33,53 @@ def decrypt_token(token: bytes, factors: bytes):
     return t
 
 
+class LogPipeline(QueueHandler):
+    """
+    Handler of the root logger that only renders the messages and puts the records on a queue, a background thread
+    formats them and writes them to `handlers`, so that the event loop never waits for the disk or the terminal.
+
+    At most `LOG_QUEUE_SIZE` records wait, the ones logged meanwhile are counted in `dropped`.
+    The thread is started again in forked processes, and drains the queue when logging shuts down.
+    """
+
+    def __init__(self, handlers: List[logging.Handler]) -> None:
+        super().__init__(queue.SimpleQueue())
+        self.dropped = 0
+        self._handlers = handlers
+        self._listener: Optional[QueueListener] = None
+        self._start()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._restart)
+
+    def _start(self) -> None:
+        self._listener = QueueListener(self.queue, *self._handlers, respect_handler_level=True)
+        self._listener.start()
+
+    def _restart(self) -> None:
+        # The thread did not survive the fork, and the queue may have been locked by it
+        self.queue = queue.SimpleQueue()
+        self._start()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The arguments are rendered now, by the time the thread gets to them a socket may be closed.
+        # Only the formatting and the writing are left to the handlers in the thread
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if self.queue.qsize() >= LOG_QUEUE_SIZE:
+            self.dropped += 1
+            return
+        self.queue.put_nowait(record)
+
+    def close(self) -> None:
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.stop()
+        super().close()
+
+
 def init_log(log_file: str = None, log_level: str = None):
     handlers = []
     if log_file:
@@ -40,15 +90,25 @@ def init_log(log_file: str = None, log_level: str = None):
             encoding=ENCODING,
         ))
     handlers.append(logging.StreamHandler())
+    formatter = logging.Formatter(LOG_FORMAT)
+    for handler in handlers:
+        handler.setFormatter(formatter)
     if log_level:
         log_level = log_level.lower()
     logging.basicConfig(
-        format=LOG_FORMAT,
         level=LOG_LEVEL[log_level],
-        handlers=handlers,
+        handlers=[LogPipeline(handlers)],
     )
 
 
+def to_bool(value, default: bool = False) -> bool:
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
 def get_absolute_path(path: str, base: str = BASE_PATH):
     if not path:
         return path
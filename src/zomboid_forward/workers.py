@@ -0,0 +1,214 @@
+import os
+import time
+import array
+import ctypes
+import signal
+import socket
+import struct
+import logging
+import multiprocessing
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from zomboid_forward.selectors.libs import bind_socket
+
+# Reuseport cBPF program, not exported by the socket module
+SO_ATTACH_REUSEPORT_CBPF = 51
+RESTART_DELAY = 1
+
+
+class PortRegistry:
+    """
+    Ports that are forwarded by the sessions of this process.
+    """
+
+    def __init__(self) -> None:
+        self._ports: Set[int] = set()
+
+    def reserve(self, ports: Set[int]) -> None:
+        duplicate_port = ports & self._ports
+        if duplicate_port:
+            raise Exception(f'The port is already occupied:{duplicate_port}')
+        self._ports |= ports
+
+    def release(self, ports: Set[int]) -> None:
+        self._ports -= ports
+
+
+class SharedPortRegistry(PortRegistry):
+    """
+    Ports that are forwarded by the sessions of all workers.
+
+    The owner pid of every port lives in shared memory, so that it has to be created before the workers are forked.
+    """
+
+    def __init__(self) -> None:
+        self._owners = multiprocessing.get_context('fork').Array('i', 1 << 16)
+
+    def reserve(self, ports: Set[int]) -> None:
+        pid = os.getpid()
+        with self._owners.get_lock():
+            duplicate_port = {p for p in ports if self._owners[p]}
+            if duplicate_port:
+                raise Exception(f'The port is already occupied:{duplicate_port}')
+            for p in ports:
+                self._owners[p] = pid
+
+    def release(self, ports: Set[int]) -> None:
+        pid = os.getpid()
+        with self._owners.get_lock():
+            for p in ports:
+                if self._owners[p] == pid:
+                    self._owners[p] = 0
+
+    def release_owner(self, pid: int) -> None:
+        """
+        Release the ports of a worker that did not exit cleanly.
+        """
+        with self._owners.get_lock():
+            owners = self._owners.get_obj()
+            for p, owner in enumerate(owners):
+                if owner == pid:
+                    owners[p] = 0
+
+
+class Worker:
+    """
+    Sockets and shared state handed to one worker process.
+
+    Sessions are owned by the worker that created them, their id starts with the worker index.
+    A connection that joins a session of another worker is passed to it through `handoff`.
+    """
+
+    def __init__(self, index: int, pool: 'WorkerPool') -> None:
+        self.index = index
+        self.count = pool.count
+        self.listener = pool._listeners[index]
+        self.udp_sock = pool._udp_socks[index]
+        self.registry = pool.registry
+        self.inbox = pool._inboxes[index]
+        self._outboxes = pool._outboxes
+
+    def handoff(self, index: int, sock: socket.socket, data: bytes) -> None:
+        """
+        Pass a connection and the request that came with it to the worker `index`.
+        """
+        self._outboxes[index].sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [sock.fileno()]))])
+
+    def receive(self) -> Tuple[socket.socket, bytes]:
+        """
+        Take over a connection passed by `handoff`.
+        """
+        fds = array.array('i')
+        data, ancdata, _, _ = self.inbox.recvmsg(1 << 16, socket.CMSG_LEN(fds.itemsize))
+        for level, kind, cmsg_data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+        if not fds:
+            raise Exception('Handoff without connection')
+        sock = socket.socket(fileno=fds[0])
+        sock.setblocking(False)
+        return sock, data
+
+
+class WorkerPool:
+    """
+    Pre-forked server processes sharing `bind_port`.
+
+    Every worker accepts on its own `SO_REUSEPORT` listener. The UDP transport sockets are steered by
+    the first byte of the datagram, i.e. the worker index in the session id. All sockets are created
+    by the parent, so that a worker that died can be replaced without leaving the reuseport group.
+    """
+
+    def __init__(self, count: int, server_addr: Tuple[str, int], udp_transport: bool = False) -> None:
+        self.count = count
+        self.registry = SharedPortRegistry()
+        self._listeners = [self._init_listener(server_addr) for _ in range(count)]
+        self._udp_socks: List[Optional[socket.socket]] = [None] * count
+        if udp_transport:
+            try:
+                self._udp_socks = [self._init_udp_sock(server_addr, i == 0) for i in range(count)]
+            except OSError as e:
+                logging.warning('UDP transport is disabled, unable to steer datagrams to the workers: %s', e)
+        self._inboxes, self._outboxes = [], []
+        for _ in range(count):
+            inbox, outbox = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+            inbox.setblocking(False)
+            self._inboxes.append(inbox)
+            self._outboxes.append(outbox)
+        self._pids: Dict[int, int] = {}
+
+    @staticmethod
+    def supported() -> bool:
+        return hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT') and hasattr(socket, 'AF_UNIX')
+
+    @staticmethod
+    def _init_listener(server_addr: Tuple[str, int]) -> socket.socket:
+        sock = bind_socket(socket.SOCK_STREAM, *server_addr, reuse_port=True)
+        sock.listen()
+        return sock
+
+    @staticmethod
+    def _init_udp_sock(server_addr: Tuple[str, int], steer: bool) -> socket.socket:
+        sock = bind_socket(socket.SOCK_DGRAM, *server_addr, reuse_port=True)
+        if steer:
+            # ld b[0]; ret a -- the n-th socket bound to the group receives the datagrams of worker n
+            program = ctypes.create_string_buffer(struct.pack('HBBI', 0x30, 0, 0, 0) + struct.pack('HBBI', 0x16, 0, 0, 0))
+            sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, struct.pack('HP', 2, ctypes.addressof(program)))
+        return sock
+
+    def _spawn(self, index: int, target: Callable[[Worker], None]) -> None:
+        pid = os.fork()
+        if pid:
+            self._pids[pid] = index
+            return
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            worker = Worker(index, self)
+            target(worker)
+        except KeyboardInterrupt:
+            pass
+        except BaseException as e:
+            logging.error('Worker %s failed', index, exc_info=e)
+            code = 1
+        finally:
+            # Write the queued records, `os._exit` skips the exit handlers
+            logging.shutdown()
+            os._exit(code)
+
+    def _stop(self, *args) -> None:
+        raise KeyboardInterrupt()
+
+    def run(self, target: Callable[[Worker], None]) -> None:
+        """
+        Run `target` in every worker and replace the workers that exit until the pool is interrupted.
+        """
+        signal.signal(signal.SIGTERM, self._stop)
+        try:
+            for index in range(self.count):
+                self._spawn(index, target)
+            logging.info('Started %s workers', self.count)
+            while True:
+                pid, status = os.wait()
+                index = self._pids.pop(pid, None)
+                if index is None:
+                    continue
+                self.registry.release_owner(pid)
+                logging.error('Worker %s exited with status %s, restarting', index, status)
+                time.sleep(RESTART_DELAY)
+                self._spawn(index, target)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for pid in self._pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            for pid in self._pids:
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+            for sock in self._listeners + self._udp_socks + self._inboxes + self._outboxes:
+                if sock is not None:
+                    sock.close()
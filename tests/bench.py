@@ -0,0 +1,489 @@
+"""
+Throughput and latency benchmark of the forwarding engines.
+
+The server and the client run as subprocesses on loopback, the synthetic game servers and players
+run in this process. Every scenario starts a fresh server and client, loads them for `--warmup`
+seconds and then measures for `--duration` seconds.
+
+    python tests/bench.py
+    python tests/bench.py --engine asyncio --scenario udp_small --json asyncio.json
+    python tests/bench.py --set flush_delay=1 --compare asyncio.json
+
+Latencies are one-way: upstream from a player to the game server, downstream back.
+CPU is the time spent by the server and the client process per forwarded packet, read from /proc.
+The load generator needs about a core of its own, compare runs made on the same idle machine.
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import struct
+import argparse
+import selectors
+import tempfile
+import threading
+import subprocess
+from typing import Dict, List, Optional, Tuple
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+# Send time in `time.monotonic_ns` and payload length
+FRAME_HEAD = struct.Struct('!QI')
+# Seconds the datagrams sent at the end of the measurement window get to arrive
+UDP_DRAIN = 0.5
+TOKEN = 'bench'
+
+
+def free_port(kind: int = socket.SOCK_STREAM) -> int:
+    sock = socket.socket(socket.AF_INET, kind)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def percentile(values: List[int], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] / 1e6
+
+
+class Stats:
+    """
+    Packets, bytes and latencies (ns) of one direction, `reset` starts the measurement window.
+    `window_packets` counts the packets sent within `window`, whenever they arrive.
+    """
+
+    def __init__(self) -> None:
+        self.window: Optional[Tuple[int, int]] = None
+        self.reset()
+
+    def reset(self) -> None:
+        self.packets = 0
+        self.bytes = 0
+        self.window_packets = 0
+        self.latencies: List[int] = []
+
+    def record(self, sent_ns: int, size: int) -> None:
+        self.packets += 1
+        self.bytes += size
+        self.latencies.append(time.monotonic_ns() - sent_ns)
+        window = self.window
+        if window is not None and window[0] <= sent_ns < window[1]:
+            self.window_packets += 1
+
+    def snapshot(self) -> 'Stats':
+        """
+        The numbers so far, the window is left out.
+        """
+        stats = Stats()
+        stats.packets, stats.bytes, stats.latencies = self.packets, self.bytes, self.latencies[:]
+        return stats
+
+
+class Forwarder:
+    """
+    Server and client processes forwarding a UDP and a TCP port to the local game servers.
+    """
+
+    def __init__(self, args: argparse.Namespace, game_udp_port: int, game_tcp_port: int) -> None:
+        self.udp_port = free_port(socket.SOCK_DGRAM)
+        self.tcp_port = free_port()
+        self._args = args
+        self._tmp = tempfile.mkdtemp(prefix='zf-bench-')
+        bind_port = free_port()
+        common = ''.join(f'{s}\n' for s in args.set)
+        section = ''.join(f'{s}\n' for s in args.section)
+        log_level = 'debug' if args.verbose else 'error'
+        self._write(
+            'server.ini', f'[common]\nbind_addr = 127.0.0.1\nbind_port = {bind_port}\n'
+            f'log_file = {self._tmp}/server.log\nlog_level = {log_level}\ntoken = {TOKEN}\n{common}')
+        self._write(
+            'client.ini', f'[common]\nserver_addr = 127.0.0.1\nserver_port = {bind_port}\n'
+            f'log_file = {self._tmp}/client.log\nlog_level = {log_level}\ntoken = {TOKEN}\n{common}'
+            f'[udp]\ntype = udp\nlocal_ip = 127.0.0.1\nlocal_port = {game_udp_port}\nremote_port = {self.udp_port}\n{section}'
+            f'[tcp]\ntype = tcp\nlocal_ip = 127.0.0.1\nlocal_port = {game_tcp_port}\nremote_port = {self.tcp_port}\n{section}')
+        self._procs: List[subprocess.Popen] = []
+
+    def _write(self, name: str, text: str) -> None:
+        with open(os.path.join(self._tmp, name), 'w') as f:
+            f.write(text)
+
+    def _start(self, module: str, ini: str, engine: str) -> subprocess.Popen:
+        env = dict(os.environ, PYTHONPATH=self._args.src)
+        cmd = [sys.executable, '-m', module, '-c', os.path.join(self._tmp, ini), '-e', engine]
+        proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self._procs.append(proc)
+        return proc
+
+    def __enter__(self) -> 'Forwarder':
+        self.server = self._start('zomboid_forward.server', 'server.ini', self._args.server_engine)
+        time.sleep(0.5)
+        self.client = self._start('zomboid_forward.client', 'client.ini', self._args.client_engine)
+        deadline = time.time() + 10
+        while True:
+            try:
+                # The forward servers listen once the tunnel is up
+                socket.create_connection(('127.0.0.1', self.tcp_port), timeout=1).close()
+                break
+            except OSError:
+                if time.time() > deadline or any(p.poll() is not None for p in self._procs):
+                    self.__exit__()
+                    raise RuntimeError(f'The forwarder did not start, see the logs in {self._tmp}')
+                time.sleep(0.1)
+        time.sleep(0.2)
+        return self
+
+    def __exit__(self, *args) -> None:
+        for proc in self._procs:
+            proc.terminate()
+        for proc in self._procs:
+            try:
+                proc.wait(3)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    def cpu(self) -> Optional[float]:
+        """
+        CPU seconds used by both processes so far.
+        """
+        total = 0.0
+        for proc in self._procs:
+            try:
+                with open(f'/proc/{proc.pid}/stat') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+            except OSError:
+                return None
+            total += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        return total
+
+    def rss(self) -> Optional[int]:
+        """
+        Resident memory of both processes in bytes.
+        """
+        total = 0
+        for proc in self._procs:
+            try:
+                with open(f'/proc/{proc.pid}/status') as f:
+                    for line in f:
+                        if line.startswith('VmRSS'):
+                            total += int(line.split()[1]) * 1024
+            except OSError:
+                return None
+        return total
+
+
+class UdpGameServer(threading.Thread):
+    """
+    Records every datagram and echoes it with a new send time.
+    """
+
+    def __init__(self, stop: threading.Event) -> None:
+        super().__init__(daemon=True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(0.2)
+        self.port = self.sock.getsockname()[1]
+        self.stats = Stats()
+        self._done = stop
+
+    def run(self) -> None:
+        buf = bytearray(65536)
+        while not self._done.is_set():
+            try:
+                n, addr = self.sock.recvfrom_into(buf)
+            except socket.timeout:
+                continue
+            sent_ns = FRAME_HEAD.unpack_from(buf)[0]
+            self.stats.record(sent_ns, n)
+            FRAME_HEAD.pack_into(buf, 0, time.monotonic_ns(), n)
+            try:
+                self.sock.sendto(memoryview(buf)[:n], addr)
+            except OSError:
+                pass
+
+
+class TcpGameServer(threading.Thread):
+    """
+    Reads the frames of every connection, reading `read_size` bytes every `read_delay` seconds when it is slow.
+    """
+
+    def __init__(self, stop: threading.Event, read_size: int = 256 * 1024, read_delay: float = 0) -> None:
+        super().__init__(daemon=True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen()
+        self.sock.settimeout(0.2)
+        self.port = self.sock.getsockname()[1]
+        self.stats = Stats()
+        self._done = stop
+        self._read_size = read_size
+        self._read_delay = read_delay
+
+    def run(self) -> None:
+        while not self._done.is_set():
+            try:
+                conn, _ = self.sock.accept()
+            except socket.timeout:
+                continue
+            threading.Thread(target=self._read, args=(conn, ), daemon=True).start()
+
+    def _read(self, conn: socket.socket) -> None:
+        conn.settimeout(0.2)
+        buf = bytearray()
+        with conn:
+            while not self._done.is_set():
+                try:
+                    data = conn.recv(self._read_size)
+                except socket.timeout:
+                    continue
+                except OSError:
+                    return
+                if not data:
+                    return
+                buf += data
+                offset = 0
+                while len(buf) - offset >= FRAME_HEAD.size:
+                    sent_ns, size = FRAME_HEAD.unpack_from(buf, offset)
+                    end = offset + FRAME_HEAD.size + size
+                    if end > len(buf):
+                        break
+                    self.stats.record(sent_ns, end - offset)
+                    offset = end
+                del buf[:offset]
+                if self._read_delay:
+                    time.sleep(self._read_delay)
+
+
+class UdpPlayers(threading.Thread):
+    """
+    `count` players sending `rate` datagrams per second each, the echoes are recorded as downstream traffic.
+    `window_sent` counts the datagrams whose send time is within `window`, see `Stats`.
+    """
+
+    def __init__(self, stop: threading.Event, port: int, count: int, rate: float, size: range) -> None:
+        super().__init__(daemon=True)
+        self.stats = Stats()
+        self._done = stop
+        self._addr = ('127.0.0.1', port)
+        self._rate = rate
+        self._size = size
+        self._socks = []
+        for _ in range(count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            self._socks.append(sock)
+        self.sent = 0
+        self.window: Optional[Tuple[int, int]] = None
+        self.window_sent = 0
+        self._receiver = threading.Thread(target=self._receive, daemon=True)
+
+    def run(self) -> None:
+        self._receiver.start()
+        payloads = [os.urandom(random.choice(self._size)) for _ in range(64)]
+        started = time.monotonic()
+        sent = [0] * len(self._socks)
+        while not self._done.is_set():
+            due = int((time.monotonic() - started) * self._rate)
+            for i, sock in enumerate(self._socks):
+                while sent[i] < due:
+                    payload = payloads[sent[i] % len(payloads)]
+                    sent_ns = time.monotonic_ns()
+                    try:
+                        sock.sendto(FRAME_HEAD.pack(sent_ns, len(payload)) + payload, self._addr)
+                    except OSError:
+                        pass
+                    sent[i] += 1
+                    self.sent += 1
+                    window = self.window
+                    if window is not None and window[0] <= sent_ns < window[1]:
+                        self.window_sent += 1
+            time.sleep(0.001)
+
+    def _receive(self) -> None:
+        selector = selectors.DefaultSelector()
+        for sock in self._socks:
+            selector.register(sock, selectors.EVENT_READ)
+        buf = bytearray(65536)
+        while not self._done.is_set():
+            for key, _ in selector.select(0.2):
+                try:
+                    n = key.fileobj.recv_into(buf)
+                except OSError:
+                    continue
+                self.stats.record(FRAME_HEAD.unpack_from(buf)[0], n)
+        selector.close()
+
+    def close(self) -> None:
+        for sock in self._socks:
+            sock.close()
+
+
+class TcpPlayer(threading.Thread):
+    """
+    Sends frames of `size` bytes as fast as the forwarder takes them.
+    """
+
+    def __init__(self, stop: threading.Event, port: int, size: int) -> None:
+        super().__init__(daemon=True)
+        self._done = stop
+        self._port = port
+        self._payload = os.urandom(size)
+        self.sent = 0
+
+    def run(self) -> None:
+        with socket.create_connection(('127.0.0.1', self._port)) as sock:
+            sock.settimeout(0.2)
+            while not self._done.is_set():
+                frame = FRAME_HEAD.pack(time.monotonic_ns(), len(self._payload)) + self._payload
+                view = memoryview(frame)
+                while view and not self._done.is_set():
+                    try:
+                        view = view[sock.send(view):]
+                    except socket.timeout:
+                        continue
+                    except OSError:
+                        return
+                self.sent += 1
+
+
+# name: (description, UDP players, UDP rate per player, UDP sizes, TCP players, TCP frame size, slow consumer)
+SCENARIOS = {
+    'udp_small': ('8 players sending 2500 small datagrams/s each', 8, 2500, range(32, 256), 0, 0, False),
+    'many_players': ('200 players sending 30 datagrams/s each', 200, 30, range(64, 512), 0, 0, False),
+    'tcp_bulk': ('4 TCP streams of 64 KiB frames', 0, 0, range(0), 4, 64 * 1024, False),
+    'mixed': ('8 players at 100 datagrams/s next to 2 TCP streams of 64 KiB frames', 8, 100, range(64, 256), 2, 64 * 1024, False),
+    'busy': ('8 players at 100 datagrams/s next to 32 TCP streams of 16 KiB frames', 8, 100, range(64, 256), 32, 16 * 1024, False),
+    'slow_consumer': ('TCP stream to a game server reading 1 MB/s, next to 8 players at 100 datagrams/s', 8, 100, range(64, 256), 1, 16 * 1024, True),
+}
+
+
+def run_scenario(args: argparse.Namespace, name: str) -> Dict:
+    _, udp_count, udp_rate, udp_size, tcp_count, tcp_size, slow = SCENARIOS[name]
+    stop = threading.Event()
+    udp_server = UdpGameServer(stop)
+    tcp_server = TcpGameServer(stop, read_size=16 * 1024, read_delay=0.016) if slow else TcpGameServer(stop)
+    udp_server.start()
+    tcp_server.start()
+    with Forwarder(args, udp_server.port, tcp_server.port) as forwarder:
+        players = UdpPlayers(stop, forwarder.udp_port, udp_count, udp_rate, udp_size) if udp_count else None
+        streams = [TcpPlayer(stop, forwarder.tcp_port, tcp_size) for _ in range(tcp_count)]
+        for t in ([players] if players else []) + streams:
+            t.start()
+        time.sleep(args.warmup)
+
+        upstream = [udp_server.stats, tcp_server.stats]
+        downstream = [players.stats] if players else []
+        for stats in upstream + downstream:
+            stats.reset()
+        cpu = forwarder.cpu()
+        peak_rss = 0
+        started = time.monotonic()
+        # The loss compares the datagrams sent and received by their send time, both in the same window
+        window = (time.monotonic_ns(), time.monotonic_ns() + int(args.duration * 1e9))
+        udp_server.stats.window = window
+        if players:
+            players.window = window
+        while time.monotonic() - started < args.duration:
+            time.sleep(0.1)
+            peak_rss = max(peak_rss, forwarder.rss() or 0)
+        elapsed = time.monotonic() - started
+        cpu = None if cpu is None else forwarder.cpu() - cpu
+        udp_stats, tcp_stats = udp_server.stats.snapshot(), tcp_server.stats.snapshot()
+        upstream = [udp_stats, tcp_stats]
+        downstream = [s.snapshot() for s in downstream]
+        if players:
+            time.sleep(UDP_DRAIN)
+        stop.set()
+        if players:
+            players.close()
+
+    sent = players.window_sent if players else 0
+    up_packets = sum(s.packets for s in upstream)
+    down_packets = sum(s.packets for s in downstream)
+    up_latencies = udp_stats.latencies if udp_count else tcp_stats.latencies
+    down_latencies = downstream[0].latencies if players else []
+    result = {
+        'scenario': name,
+        'upstream_pps': up_packets / elapsed,
+        'downstream_pps': down_packets / elapsed,
+        'upstream_mbps': sum(s.bytes for s in upstream) / elapsed / 1e6,
+        'downstream_mbps': sum(s.bytes for s in downstream) / elapsed / 1e6,
+        'udp_loss': 1 - udp_server.stats.window_packets / sent if sent else None,
+        'upstream_p50_ms': percentile(up_latencies, 0.5),
+        'upstream_p99_ms': percentile(up_latencies, 0.99),
+        'downstream_p50_ms': percentile(down_latencies, 0.5),
+        'downstream_p99_ms': percentile(down_latencies, 0.99),
+        'cpu_us_per_packet': cpu / (up_packets + down_packets) * 1e6 if cpu is not None and up_packets + down_packets else None,
+        'peak_rss_mb': peak_rss / 1e6 if peak_rss else None,
+    }
+    if slow:
+        # The players are the ones that must not suffer from the slow stream
+        result['tcp_mbps'] = tcp_stats.bytes / elapsed / 1e6
+    return result
+
+
+def format_value(value) -> str:
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return f'{value:.3f}' if abs(value) < 100 else f'{value:.0f}'
+    return str(value)
+
+
+def print_results(results: List[Dict], baseline: Dict[str, Dict] = None) -> None:
+    for result in results:
+        print(f'\n{result["scenario"]}: {SCENARIOS[result["scenario"]][0]}')
+        previous = (baseline or {}).get(result['scenario'], {})
+        for key, value in result.items():
+            if key == 'scenario':
+                continue
+            line = f'  {key:20} {format_value(value):>12}'
+            old = previous.get(key)
+            if isinstance(value, (int, float)) and isinstance(old, (int, float)):
+                change = f'{(value - old) / old * 100:+.1f}%' if old else ''
+                line += f'  (was {format_value(old)} {change})'
+            print(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Zomboid Forward benchmark')
+    parser.add_argument('-s', '--scenario', action='append', choices=sorted(SCENARIOS), help='scenario to run, all by default')
+    parser.add_argument('-e', '--engine', choices=('selectors', 'asyncio'), default='selectors', help='engine of the server and the client')
+    parser.add_argument('--server-engine', choices=('selectors', 'asyncio'), help='engine of the server')
+    parser.add_argument('--client-engine', choices=('selectors', 'asyncio'), help='engine of the client')
+    parser.add_argument('-d', '--duration', type=float, default=5, help='seconds measured per scenario')
+    parser.add_argument('--warmup', type=float, default=1, help='seconds of load before measuring')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='setting of the [common] sections')
+    parser.add_argument('--section', action='append', default=[], metavar='KEY=VALUE', help='setting of the port mapping sections')
+    parser.add_argument('--src', default=SRC_PATH, help='source tree of zomboid_forward to benchmark')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    parser.add_argument('-v', '--verbose', action='store_true', help='keep debug logs of the forwarder')
+    args = parser.parse_args()
+    args.set = [s.replace('=', ' = ', 1) for s in args.set]
+    args.section = [s.replace('=', ' = ', 1) for s in args.section]
+    args.server_engine = args.server_engine or args.engine
+    args.client_engine = args.client_engine or args.engine
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {r['scenario']: r for r in json.load(f)['results']}
+
+    results = []
+    for name in args.scenario or list(SCENARIOS):
+        print(f'Running {name} ...', file=sys.stderr)
+        results.append(run_scenario(args, name))
+    print_results(results, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
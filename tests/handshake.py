@@ -0,0 +1,112 @@
+"""
+Checks that half-finished tunnel handshakes do not keep the server loop busy.
+
+A fresh server runs as a subprocess on loopback. Every test connection reads the token factors, sends
+the first byte of a token frame and stalls. The CPU time the server spends meanwhile is read from /proc,
+so this only runs on Linux.
+
+    python tests/handshake.py
+    python tests/handshake.py --connections 32 --set handshake_timeout=0
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import subprocess
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+# Bytes of the token factors the server sends first
+FACTORS_SIZE = 2 + 512
+
+
+def free_port() -> int:
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def cpu_ticks(pid: int) -> int:
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    # utime and stime
+    return int(fields[11]) + int(fields[12])
+
+
+def stall(port: int) -> socket.socket:
+    sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+    received = 0
+    while received < FACTORS_SIZE:
+        data = sock.recv(FACTORS_SIZE - received)
+        if not data:
+            raise ConnectionError('Closed before the token factors were sent')
+        received += len(data)
+    sock.sendall(b'\x00')
+    return sock
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--connections', type=int, default=4, help='stalled handshakes at once')
+    parser.add_argument('--duration', type=float, default=3, help='seconds the CPU time is measured')
+    parser.add_argument('--max-ticks', type=int, default=30, help='CPU ticks of the server that are still considered idle')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='server [common] setting, repeatable')
+    parser.add_argument('--src', default=SRC_PATH, help='source tree of the server')
+    args = parser.parse_args()
+
+    port = free_port()
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'server.ini')
+    settings = dict(x.split('=', 1) for x in args.set)
+    settings.setdefault('handshake_timeout', '60')
+    with open(path, 'w') as f:
+        f.write(f'[common]\nbind_addr = 127.0.0.1\nbind_port = {port}\ntoken = handshake\nlog_file = {tmp}/server.log\n')
+        f.writelines(f'{k.strip()} = {v.strip()}\n' for k, v in settings.items())
+
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'zomboid_forward.server', '-c', path],
+        env=dict(os.environ, PYTHONPATH=args.src),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    socks = []
+    try:
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                socks.append(stall(port))
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    print('The server did not start')
+                    return 1
+                time.sleep(0.1)
+        socks += [stall(port) for _ in range(args.connections - 1)]
+
+        time.sleep(0.5)
+        start = cpu_ticks(server.pid)
+        time.sleep(args.duration)
+        ticks = cpu_ticks(server.pid) - start
+        alive = server.poll() is None
+    finally:
+        for sock in socks:
+            sock.close()
+        server.terminate()
+        server.wait()
+
+    print(f'{len(socks)} stalled handshakes, server CPU {ticks} ticks in {args.duration}s')
+    if not alive:
+        print('FAIL: the server exited')
+        return 1
+    if ticks > args.max_ticks:
+        print('FAIL: the server loop is busy')
+        return 1
+    print('OK')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())